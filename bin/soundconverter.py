@@ -85,8 +85,7 @@ def _check_libs():
 
 
 def check_mime_type(mime):
-    types = {'vorbis': 'audio/x-vorbis', 'flac': 'audio/x-flac', 'wav' : 'audio/x-wav',
-        'mp3': 'audio/mpeg', 'aac': 'audio/x-m4a'}
+    types = cli_mime_types
     mime = types.get(mime, mime)
     if mime not in list(types.values()):
         print(('Cannot use "%s" mime type.' % mime))
@@ -115,19 +114,95 @@ def parse_command_line():
             'them. This indicates \n command line batch mode '
             'and disables the graphical user interface.'))
     parser.add_option('-m', '--mime-type', dest="cli-output-type",
+        action='append',
         help=_('Set the output MIME type for batch mode. The default '
             'is %s. Note that you probably want to set the output '
-            'suffix as well.') % settings['cli-output-type'])
+            'suffix as well. Repeat -m and -s to convert to several '
+            'formats at once.') % settings['cli-output-type'])
     parser.add_option('-q', '--quiet', action="store_true", dest="quiet",
         help=_("Be quiet. Don't write normal output, only errors."))
     parser.add_option('-d', '--debug', action="store_true", dest="debug",
         help=_('Displays additional debug information'))
     parser.add_option('-s', '--suffix', dest="cli-output-suffix",
+        action='append',
         help=_('Set the output filename suffix for batch mode.'
             'The default is %s . Note that the suffix does not '
             'affect\n the output MIME type.') % settings['cli-output-suffix'])
     parser.add_option('-j', '--jobs', action='store', type='int', dest='forced-jobs',
         metavar='NUM', help=_('Force number of concurrent conversions.'))
+    parser.add_option('--adaptive-jobs', action='store_true',
+        dest='adaptive-jobs', help=_('Adjust the number of concurrent '
+            'conversions to the CPU usage, the disk waits and the '
+            'throughput while converting, starting from the number of '
+            'jobs.'))
+    parser.add_option('--min-jobs', action='store', type='int',
+        dest='min-jobs', metavar='NUM', help=_('Lowest number of '
+            'concurrent conversions with --adaptive-jobs. The default is 1.'))
+    parser.add_option('--max-jobs', action='store', type='int',
+        dest='max-jobs', metavar='NUM', help=_('Highest number of '
+            'concurrent conversions with --adaptive-jobs. The default is '
+            'twice the number of CPUs.'))
+    parser.add_option('--worker-processes', action='store_true',
+        dest='worker-processes', help=_('Run each conversion in a separate '
+            'worker process, so a crashing decoder only fails one file.'))
+    parser.add_option('--stall-timeout', action='store', type='int',
+        dest='stall-timeout', metavar='SECONDS', help=_('Stop a conversion '
+            'which made no progress for this many seconds, and count it '
+            'as an error.'))
+    parser.add_option('--reuse-pipelines', action='store_true',
+        dest='reuse-pipelines', help=_('Reuse the GStreamer pipelines of '
+            'finished conversions instead of creating one per file. Faster '
+            'for many short files.'))
+    parser.add_option('--trim-pipeline', action='store_true',
+        dest='trim-pipeline', help=_('Leave out the audiorate, audioconvert '
+            'and audioresample elements the input format found in the '
+            'file header does not need.'))
+    parser.add_option('--encoder-queue', action='store', type='int',
+        dest='encoder-queue', metavar='MS', help=_('Encode in a separate '
+            'thread, with a queue holding up to this many milliseconds of '
+            'decoded audio. Faster with slow encoders when there are fewer '
+            'jobs than CPUs.'))
+    parser.add_option('--passthrough', action='store_true',
+        dest='passthrough', help=_('Copy the files which already are in '
+            'the output format, with the same sample width or MP3 bitrate, '
+            'instead of converting them again.'))
+    parser.add_option('--longest-first', action='store_true',
+        dest='longest-first', help=_('Read the duration of all input files '
+            'first, and start the longest conversions first.'))
+    parser.add_option('--split-long-files', action='store_true',
+        dest='split-long-files', help=_('Convert the files much longer than '
+            'the others in segments, in parallel, and join them. For WAV, '
+            'Ogg Vorbis and Opus output. Ogg segments are chained streams '
+            'whose boundaries can be heard.'))
+    parser.add_option('--no-cache', action='store_false',
+        dest='metadata-cache', help=_('Do not use the types, durations and '
+            'tags of the files read in previous runs, nor save them.'))
+    parser.add_option('--incremental', action='store_true',
+        dest='incremental', help=_('Skip the files converted before with the '
+            'same settings, and not changed since. Replace the outputs of '
+            'the others.'))
+    parser.add_option('--journal', dest='journal', metavar='FILE',
+        help=_('Record the conversions in FILE, to resume the batch with '
+            '--resume if it is interrupted.'))
+    parser.add_option('--resume', dest='resume', metavar='FILE',
+        help=_('Skip the files converted in the batch recorded in FILE, and '
+            'remove the temporary files it left. Convert the files it did '
+            'not finish when no file is given, or all the files and the '
+            'manifest of a --streaming or --manifest batch again.'))
+    parser.add_option('--streaming', action='store_true',
+        dest='streaming', help=_('Create the conversions as jobs are free '
+            'to run them, reading the folders given as they are converted. '
+            'Starts sooner and uses less memory with many files, but '
+            'disables --longest-first and --split-long-files.'))
+    parser.add_option('--manifest', dest='manifest', metavar='FILE',
+        help=_('Also convert the files listed in FILE, or in stdin for -. '
+            'One path per line, NUL separated paths, JSON lines with a path '
+            'string or an object, or CSV, with path, output, format and '
+            'priority fields.'))
+    parser.add_option('--manifest-format', dest='manifest-format',
+        type='choice', choices=('auto', 'lines', 'nul', 'jsonl', 'csv'),
+        help=_('Format of the manifest: lines, nul, jsonl or csv. Guessed '
+            'from its name and first bytes by default.'))
     parser.add_option('--help-gst', action="store_true", dest="_unused",
         help=_('Shows GStreamer Options'))
     return parser
@@ -140,7 +215,7 @@ soundconverter.NAME = NAME
 soundconverter.VERSION = VERSION
 soundconverter.GLADEFILE = GLADEFILE
 
-from soundconverter.settings import settings
+from soundconverter.settings import settings, cli_mime_types
 
 parser = parse_command_line()
 # remove gstreamer arguments so only gstreamer sees them.
@@ -155,7 +230,15 @@ for k in dir(options):
         continue
     settings[k] = getattr(options, k)
 
-settings['cli-output-type'] = check_mime_type(settings['cli-output-type'])
+# -m and -s can be repeated, one pair per output format
+for k in ('cli-output-type', 'cli-output-suffix'):
+    if isinstance(settings[k], str):
+        settings[k] = [settings[k]]
+settings['cli-output-type'] = list(map(check_mime_type,
+                                       settings['cli-output-type']))
+if len(settings['cli-output-type']) != len(settings['cli-output-suffix']):
+    print('Give as many suffixes (-s) as MIME types (-m).')
+    raise SystemExit
 
 _check_libs()
 if settings['forced-jobs']:
@@ -167,6 +250,36 @@ from soundconverter.fileoperations import filename_to_uri
 
 files = list(map(filename_to_uri, files))
 
+if settings['journal'] or settings['resume']:
+    from soundconverter.journal import journal
+    # --journal defaults to the journal resumed
+    journal.open(settings['journal'] or settings['resume'],
+                 settings['resume'] or None)
+    if settings['resume'] and not files and not settings['manifest']:
+        try:
+            files, manifest_path, manifest_format = \
+                journal.get_resumed_inputs()
+        except ValueError as error:
+            print('Cannot resume without the files to convert: %s' % error)
+            raise SystemExit
+        if manifest_path:
+            settings['manifest'] = manifest_path
+            settings['manifest-format'] = manifest_format
+    journal.started(files, settings['streaming'], settings['manifest'],
+                    settings['manifest-format'])
+
+manifest = None
+if settings['manifest']:
+    from soundconverter.manifest import read_manifest
+    try:
+        manifest = read_manifest(settings['manifest'],
+                                 settings['manifest-format'])
+    except OSError as error:
+        print('Cannot read the manifest: %s' % error)
+        raise SystemExit
+    if settings['mode'] == 'gui':
+        settings['mode'] = 'batch'
+
 try:
     from soundconverter.ui import gui_main
 except:
@@ -176,13 +289,15 @@ except:
 if settings['mode'] == 'gui':
     gui_main(NAME, VERSION, GLADEFILE, files)
 elif settings['mode'] == 'tags':
+    if manifest:
+        files += [record['uri'] for record in manifest]
     if not files:
         print('nothing to do...')
     cli_tags_main(files)
 else:
-    if not files:
+    if not files and not manifest:
         print('nothing to do...')
-    cli_convert_main(files)
+    cli_convert_main(files, manifest)
 
 
 
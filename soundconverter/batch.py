@@ -20,37 +20,63 @@
 # USA
 
 
+import os
 import sys
 import gi
-import time
-from gi.repository import GLib
+from gettext import gettext as _
+from gi.repository import GLib, Gio
 
 from soundconverter.soundfile import SoundFile
 from soundconverter import error
-from soundconverter.settings import settings
-from soundconverter.gstreamer import TagReader
+from soundconverter.settings import settings, cli_mime_types
+from soundconverter.gstreamer import Prober
+from soundconverter.cache import metadata_cache
+from soundconverter.journal import journal
+from soundconverter.fileoperations import vfs_walk, beautify_uri
+from soundconverter.fileoperations import vfs_exists, vfs_unlink, vfs_rename
 from soundconverter.namegenerator import TargetNameGenerator
-from soundconverter.queue import TaskQueue
-from soundconverter.gstreamer import Converter
-from soundconverter.fileoperations import unquote_filename
+from soundconverter.queue import TaskQueue, JobsController, Watchdog
+from soundconverter.workers import WorkerPool, WorkerTask
+from soundconverter.gstreamer import Converter, schedule_by_duration
+from soundconverter.gstreamer import pipeline_pool
+from soundconverter.gstreamer import is_up_to_date, record_outputs
+from soundconverter.gstreamer import is_accepted_type, is_blacklisted
+from soundconverter.sniffer import classify, read_header
+from soundconverter.utils import debug
 
 def cli_tags_main(input_files):
     error.set_error_handler(error.ErrorPrinter())
     loop = GLib.MainLoop()
-    context = loop.get_context()
-    for input_file in input_files:
-        input_file = SoundFile(input_file)
-        if not settings['quiet']:
-            print(input_file.filename)
-        t = TagReader(input_file)
-        t.start()
-        while t.running:
-            time.sleep(0.01)
-            context.iteration(True)
-            
+
+    read = set()
+
+    def tags_read(task):
+        read.add(task)
+
+    def print_tags():
+        # probes finish in any order, print the files as they were given
         if not settings['quiet']:
-            for key in sorted(input_file.tags):
-                print(('     %s: %s' % (key, input_file.tags[key])))
+            for task in probers:
+                if task not in read:
+                    continue
+                sound_file = task.sound_file
+                print(sound_file.filename)
+                for key in sorted(sound_file.tags):
+                    print(('     %s: %s' % (key, sound_file.tags[key])))
+        loop.quit()
+
+    queue = TaskQueue()
+    probers = []
+    for input_file in input_files:
+        t = Prober(SoundFile(input_file))
+        t.add_listener('finished', tags_read)
+        probers.append(t)
+        queue.add_task(t)
+
+    queue.queue_ended = print_tags
+    queue.start()
+    loop.run()
+    metadata_cache.commit()
 
 
 class CliProgress:
@@ -68,64 +94,225 @@ class CliProgress:
     def clear(self):
         sys.stdout.write('\b \b' * len(self.current_text))
         sys.stdout.flush()
+        self.current_text = ''
+
+
+def is_audio_file(uri):
+    """Tell if the file at uri, found in a folder, may be converted.
+
+    Like in FileList, the type of a local file is found from its first
+    bytes. When they are not enough, its type is guessed from its name
+    too, so covers, playlists and text files are skipped. Remote files
+    are not read here, their conversion tells if they are audio files."""
+    if is_blacklisted(uri):
+        return False
+    if not uri.startswith('file://'):
+        return True
+    header = read_header(uri)
+    mime_type = classify(header)
+    if mime_type is None:
+        mime_type, uncertain = Gio.content_type_guess(uri, header)
+        if uncertain:
+            return True
+    if not is_accepted_type(mime_type):
+        debug('mime type skipped: %s (%s)' % (mime_type, beautify_uri(uri)))
+        return False
+    return True
+
+
+def iter_input_files(uris):
+    """Yield the uri of each file to convert and its base path: the uris
+    of files, and of the audio files below the uris of folders."""
+    for uri in uris:
+        file_type = Gio.file_parse_name(uri).query_file_type(
+            Gio.FileQueryInfoFlags.NONE, None)
+        if file_type != Gio.FileType.DIRECTORY:
+            yield uri, None
+            continue
+        base = os.path.dirname(uri.rstrip('/')) + '/'
+        for child in vfs_walk(uri):
+            if not child.endswith('~SC~') and is_audio_file(child):
+                yield child, base
 
 
-def cli_convert_main(input_files):
+def cli_convert_main(input_files, manifest=None):
+    """Convert the files at input_files and below them, and those of the
+    records of a manifest."""
     loop = GLib.MainLoop()
-    context = loop.get_context()
     error.set_error_handler(error.ErrorPrinter())
 
-    output_type = settings['cli-output-type']
-    output_suffix = settings['cli-output-suffix']
-
-    generator = TargetNameGenerator()
-    generator.suffix = output_suffix
+    # one target name generator per output format
+    outputs = []
+    for output_type, output_suffix in zip(settings['cli-output-type'],
+                                          settings['cli-output-suffix']):
+        generator = TargetNameGenerator()
+        generator.suffix = output_suffix
+        outputs.append((generator, output_type))
 
     progress = CliProgress()
+    # the final names of the outputs of each task, which writes them to
+    # temporary files first
+    targets = {}
+    # the tasks which failed, to exit with an error
+    failed = []
+
+    def task_finished(task):
+        names = targets.pop(task)
+        failure = task.error
+        if not failure:
+            try:
+                for (output_filename, output_type), name in zip(task.outputs,
+                                                                names):
+                    # the file converted before stays until replaced
+                    vfs_rename(output_filename, name, overwrite=True)
+            except GLib.GError as e:
+                failure = str(e)
+        if failure:
+            failed.append(task)
+            # do not leave partial files behind
+            for output_filename, output_type in task.outputs:
+                if vfs_exists(output_filename):
+                    vfs_unlink(output_filename)
+        elif settings['incremental']:
+            record_outputs(task, names)
+        journal.finished(task, names, failure)
+        if settings['quiet']:
+            return
+        progress.clear()
+        filename = task.sound_file.filename_for_display
+        if failure:
+            print(_('%s: %s') % (filename, failure))
+        else:
+            print(_('%s: OK') % filename)
 
+    pool = WorkerPool() if settings['worker-processes'] else None
     queue = TaskQueue()
-    for input_file in input_files:
-        input_file = SoundFile(input_file)
-        output_name = generator.get_target_name(input_file)
-        c = Converter(input_file, output_name, output_type)
+    if settings['adaptive-jobs']:
+        queue.jobs_controller = JobsController(queue)
+    if settings['stall-timeout']:
+        queue.watchdog = Watchdog(queue, settings['stall-timeout'])
+
+    def make_task(uri, base=None, task_outputs=None):
+        """Return the task converting the file at uri, None if it is already
+        converted.
+
+        task_outputs is a list of (target, output_type), where target is a
+        target name generator or a filename, the outputs of all files by
+        default."""
+        input_file = SoundFile(uri, base)
+        names = [(target if isinstance(target, str) else
+                  target.get_target_name(input_file), output_type)
+                 for target, output_type in task_outputs or outputs]
+        # write to temporary files, renamed when the conversion succeeds
+        (output_name, output_type), *others = names
+        c = Converter(input_file, output_name + '~SC~', output_type)
+        for output_name, output_type in others:
+            c.add_output(output_name + '~SC~', output_type)
         c.overwrite = True
-        c.init()
-        c.start()
-        while c.running:
-            if c.get_duration():
-                percent = min(100, 100.0* (c.get_position() / c.get_duration()))
-                percent = '%.1f %%' % percent
-            else:
-                percent = '/-\|' [int(time.time()) % 4]
-            progress.show('%s: %s' % (unquote_filename(c.sound_file.filename[-65:]), percent ))
-            time.sleep(0.01)
-            context.iteration(True)
-        print()
-
-    previous_filename = None
-    
-    '''
-    queue.start()
-    
-    #running, progress = queue.get_progress(perfile)
-    while queue.running:
-        t = None #queue.get_current_task()
-        if t and not settings['quiet']:
-            if previous_filename != t.sound_file.get_filename_for_display():
-                if previous_filename:
-                    print _('%s: OK') % previous_filename
-                previous_filename = t.sound_file.get_filename_for_display()
-
-            percent = 0
-            if t.get_duration():
-                percent = '%.1f %%' % ( 100.0* (t.get_position() / t.get_duration() ))
-            else:
-                percent = '/-\|' [int(time.time()) % 4]
-            progress.show('%s: %s' % (t.sound_file.get_filename_for_display()[-65:], percent ))
-        time.sleep(0.10)
-        context.iteration(True)
-    '''
+        if journal.is_completed(c):
+            if not settings['quiet']:
+                print(_('%s: already converted') %
+                      input_file.filename_for_display)
+            return None
+        if settings['incremental'] and \
+                not journal.was_interrupted(input_file.uri) and \
+                not journal.has_failed(input_file.uri) and \
+                is_up_to_date(c, [name for name, output_type in names]):
+            if not settings['quiet']:
+                print(_('%s: up to date') % input_file.filename_for_display)
+            return None
+        if pool:
+            task = WorkerTask(c, pool)
+        else:
+            c.init()
+            task = c
+        targets[task] = [name for name, output_type in names]
+        task.add_listener('finished', task_finished)
+        journal.queued(task)
+        return task
+
+    def make_manifest_task(record):
+        """Return the task converting the file of a manifest record, to
+        its output and format if it gives them."""
+        output_type = record['format']
+        if output_type:
+            output_type = cli_mime_types.get(output_type, output_type)
+            if output_type not in cli_mime_types.values():
+                print(_('%s: cannot use "%s" mime type') %
+                      (beautify_uri(record['uri']), record['format']))
+                return None
+        if record['output']:
+            task_outputs = [(record['output'],
+                             output_type or outputs[0][1])]
+        elif output_type:
+            task_outputs = [output for output in outputs
+                            if output[1] == output_type]
+            if not task_outputs:
+                print(_('%s: no suffix (-s) given for %s') %
+                      (beautify_uri(record['uri']), output_type))
+                return None
+        else:
+            task_outputs = None
+        return make_task(record['uri'], task_outputs=task_outputs)
+
+    tasks = ((make_task(uri, base), 0)
+             for uri, base in iter_input_files(input_files))
+    if settings['streaming']:
+        # the files are found and their converters created as the
+        # conversions start
+        queue.add_task_source(tasks)
+    else:
+        for task, priority in tasks:
+            if task:
+                queue.add_task(task, priority)
+    if manifest:
+        # manifests can be very long, always read them as the
+        # conversions start
+        queue.add_task_source(
+            (make_manifest_task(record), record['priority'])
+            for record in manifest)
+
+    def source_failed(failure):
+        # the files found or listed before are still converted
+        progress.clear()
+        print(_('Cannot read the files to convert: %s') % failure)
+
+    queue.source_failed = source_failed
+
+    def show_progress():
+        if queue.running and not settings['quiet']:
+            progress.show(get_queue_progress(queue))
+        return True
+
+    queue.queue_ended = loop.quit
+    if (settings['longest-first'] or settings['split-long-files']) and \
+            not settings['streaming']:
+        schedule_by_duration(queue, queue.start)
+    else:
+        queue.start()
+    GLib.timeout_add(100, show_progress)
+    loop.run()
+
+    if pool:
+        pool.stop()
+    pipeline_pool.clear()
+    metadata_cache.commit()
+    journal.close()
     if not settings['quiet']:
         progress.clear()
+    if failed or queue.source_errors:
+        sys.exit(1)
 
 
+def get_queue_progress(queue):
+    """Return a one line summary of the progress of a queue of converters."""
+    total = queue.finished_tasks + len(queue.running_tasks) + \
+        len(queue.waiting_tasks) + queue.get_sources_length()
+    done = float(queue.finished_tasks)
+    for task in queue.running_tasks:
+        duration = task.get_duration()
+        if duration:
+            done += min(max(task.get_position() / duration, 0.0), 1.0)
+    percent = 100.0 * done / total if total else 0
+    return '%d/%d files, %d running: %.1f %%' % (
+        queue.finished_tasks, total, len(queue.running_tasks), percent)
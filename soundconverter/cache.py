@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# SoundConverter - GNOME application for converting between audio formats.
+# Copyright 2004 Lars Wirzenius
+# Copyright 2005-2017 Gautier Portet
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""
+Metadata of the probed files, kept between runs.
+
+The type, duration and tags of a file are stored in an SQLite database
+with its size and modification time, and used again as long as they do
+not change. The source and settings of converted files are stored too,
+to find the outputs which are up to date.
+"""
+
+import os
+import json
+import time
+import atexit
+import sqlite3
+
+from gi.repository import Gio, GLib
+
+from soundconverter.settings import settings
+from soundconverter.utils import log, debug
+
+
+class MetadataCache:
+    """An SQLite database of the metadata of files, by uri.
+
+    It holds at most max_entries files, the ones used the longest time ago
+    are removed first, and at most max_outputs converted files, the ones
+    converted the longest time ago are removed first."""
+
+    max_entries = 500000
+    max_outputs = 500000
+    # changes written at once
+    batch_size = 1000
+
+    def __init__(self, path=None):
+        self.path = path
+        self.connection = None
+        self.entries = 0
+        self.outputs = 0
+        self.changes = 0
+        # uris of the entries used since the last commit
+        self.touched = set()
+        atexit.register(self.close)
+
+    def get_default_path(self):
+        return os.path.join(GLib.get_user_cache_dir(), 'soundconverter',
+                            'metadata.sqlite')
+
+    def open(self):
+        if self.connection:
+            return self.connection
+        path = self.path or self.get_default_path()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS metadata (
+            uri TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime INTEGER,
+            mime_type TEXT,
+            duration REAL,
+            tags TEXT,
+            used REAL)''')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS metadata_used ON metadata (used)')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS outputs (
+            uri TEXT PRIMARY KEY,
+            source TEXT,
+            size INTEGER,
+            mtime INTEGER,
+            settings TEXT)''')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS outputs_source ON outputs (source)')
+        self.entries = self.count('metadata')
+        self.outputs = self.count('outputs')
+        return self.connection
+
+    def get(self, uri, size, mtime):
+        """Return (mime_type, duration, tags) of the file at uri if its
+        size and mtime did not change, None otherwise."""
+        row = self.open().execute(
+            'SELECT mime_type, duration, tags FROM metadata '
+            'WHERE uri = ? AND size = ? AND mtime = ?',
+            (uri, size, mtime)).fetchone()
+        if row is None:
+            return None
+        # written with the next commit
+        self.touched.add(uri)
+        if len(self.touched) >= self.batch_size:
+            self.commit()
+        mime_type, duration, tags = row
+        return mime_type, duration, json.loads(tags)
+
+    def count(self, table):
+        count, = self.connection.execute(
+            'SELECT COUNT(*) FROM %s' % table).fetchone()
+        return count
+
+    def exists(self, table, uri):
+        return self.open().execute('SELECT 1 FROM %s WHERE uri = ?' % table,
+                                   (uri,)).fetchone() is not None
+
+    def put(self, uri, size, mtime, mime_type, duration, tags):
+        new = not self.exists('metadata', uri)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (uri, size, mtime, mime_type, duration, json.dumps(tags),
+             time.time()))
+        if new:
+            self.entries += 1
+            if self.entries > self.max_entries:
+                self.evict()
+        self.changed()
+
+    def get_output(self, uri):
+        """Return (source, size, mtime, settings) of the source the file at
+        uri was converted from, None if unknown."""
+        return self.open().execute(
+            'SELECT source, size, mtime, settings FROM outputs WHERE uri = ?',
+            (uri,)).fetchone()
+
+    def get_outputs_of(self, source, size, mtime, settings_hash):
+        """Return the uris of the files converted from the file at source,
+        of the given size and mtime, with the settings of settings_hash."""
+        rows = self.open().execute(
+            'SELECT uri FROM outputs WHERE source = ? AND size = ? AND '
+            'mtime = ? AND settings = ?',
+            (source, size, mtime, settings_hash)).fetchall()
+        return [uri for uri, in rows]
+
+    def put_output(self, uri, source, size, mtime, settings_hash):
+        new = not self.exists('outputs', uri)
+        # replacing a row gives it a new rowid, the last one
+        self.connection.execute(
+            'INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)',
+            (uri, source, size, mtime, settings_hash))
+        if new:
+            self.outputs += 1
+            if self.outputs > self.max_outputs:
+                self.evict_outputs()
+        self.changed()
+
+    def evict(self):
+        """Remove the tenth of the entries used the longest time ago."""
+        count = self.entries - self.max_entries + self.max_entries // 10
+        self.write_used()
+        self.connection.execute(
+            'DELETE FROM metadata WHERE uri IN ('
+            'SELECT uri FROM metadata ORDER BY used, rowid LIMIT ?)', (count,))
+        self.entries = self.count('metadata')
+        debug('metadata cache: %d entries left' % self.entries)
+
+    def evict_outputs(self):
+        """Remove the tenth of the converted files recorded the longest
+        time ago."""
+        count = self.outputs - self.max_outputs + self.max_outputs // 10
+        self.connection.execute(
+            'DELETE FROM outputs WHERE uri IN ('
+            'SELECT uri FROM outputs ORDER BY rowid LIMIT ?)', (count,))
+        self.outputs = self.count('outputs')
+        debug('metadata cache: %d outputs left' % self.outputs)
+
+    def changed(self):
+        self.changes += 1
+        if self.changes >= self.batch_size:
+            self.commit()
+
+    def write_used(self):
+        """Write when the entries used since the last commit were used."""
+        if self.touched:
+            now = time.time()
+            self.connection.executemany(
+                'UPDATE metadata SET used = ? WHERE uri = ?',
+                ((now, uri) for uri in self.touched))
+            self.touched = set()
+
+    def commit(self):
+        if self.connection and (self.changes or self.touched):
+            self.write_used()
+            self.connection.commit()
+            self.changes = 0
+
+    def close(self):
+        if self.connection:
+            self.commit()
+            self.connection.close()
+            self.connection = None
+
+    def get_file_key(self, uri):
+        """Return the size and modification time of the file at uri, None
+        if it cannot be read."""
+        try:
+            info = Gio.file_parse_name(uri).query_info(
+                'standard::size,time::modified',
+                Gio.FileQueryInfoFlags.NONE, None)
+        except GLib.GError:
+            return None
+        return info.get_size(), info.get_attribute_uint64('time::modified')
+
+    def lookup(self, sound_file):
+        """Fill the mime_type, duration and tags of sound_file from the
+        cache. Return False if they are not there."""
+        if not settings['metadata-cache']:
+            return False
+        key = self.get_file_key(sound_file.uri)
+        try:
+            found = key and self.get(sound_file.uri, *key)
+        except (sqlite3.Error, OSError) as error:
+            log('metadata cache disabled: %s' % error)
+            settings['metadata-cache'] = False
+            return False
+        if not found:
+            return False
+        sound_file.mime_type, sound_file.duration, tags = found
+        sound_file.tags.update(tags)
+        return True
+
+    def store(self, sound_file):
+        """Remember the mime_type, duration and tags of sound_file."""
+        if not settings['metadata-cache']:
+            return
+        key = self.get_file_key(sound_file.uri)
+        if not key:
+            return
+        try:
+            self.put(sound_file.uri, key[0], key[1], sound_file.mime_type,
+                     sound_file.duration, sound_file.tags)
+        except (sqlite3.Error, OSError) as error:
+            log('metadata cache disabled: %s' % error)
+            settings['metadata-cache'] = False
+
+    def is_up_to_date(self, source, target, settings_hash):
+        """Tell if the file at target was converted from the file at source
+        as it is now, with the same settings. When the conversion is not
+        recorded, tell if target is newer than source."""
+        source_key = self.get_file_key(source)
+        target_key = self.get_file_key(target)
+        if not source_key or not target_key:
+            return False
+        if settings['metadata-cache']:
+            try:
+                recorded = self.get_output(target)
+            except (sqlite3.Error, OSError) as error:
+                log('metadata cache disabled: %s' % error)
+                settings['metadata-cache'] = False
+                recorded = None
+            if recorded:
+                return tuple(recorded) == (source,) + source_key + \
+                    (settings_hash,)
+        return target_key[1] >= source_key[1]
+
+    def get_source(self, target):
+        """Return the uri of the file target was converted from, None if
+        it is not recorded."""
+        if not settings['metadata-cache']:
+            return None
+        try:
+            recorded = self.get_output(target)
+        except (sqlite3.Error, OSError) as error:
+            log('metadata cache disabled: %s' % error)
+            settings['metadata-cache'] = False
+            return None
+        return recorded[0] if recorded else None
+
+    def find_outputs(self, source, settings_hash):
+        """Return the uris of the files recorded as converted from the file
+        at source as it is now, with the settings of settings_hash."""
+        if not settings['metadata-cache']:
+            return []
+        key = self.get_file_key(source)
+        if not key:
+            return []
+        try:
+            return self.get_outputs_of(source, key[0], key[1], settings_hash)
+        except (sqlite3.Error, OSError) as error:
+            log('metadata cache disabled: %s' % error)
+            settings['metadata-cache'] = False
+            return []
+
+    def record_output(self, source, target, settings_hash):
+        """Remember that target was converted from source with the settings
+        of settings_hash."""
+        if not settings['metadata-cache']:
+            return
+        key = self.get_file_key(source)
+        if not key:
+            return
+        try:
+            self.put_output(target, source, key[0], key[1], settings_hash)
+        except (sqlite3.Error, OSError) as error:
+            log('metadata cache disabled: %s' % error)
+            settings['metadata-cache'] = False
+
+
+metadata_cache = MetadataCache()
@@ -20,9 +20,10 @@
 # USA
 
 import os
+from collections import deque
 import urllib.request, urllib.parse, urllib.error
 import gi
-from gi.repository import Gio
+from gi.repository import Gio, GLib
 
 from soundconverter.utils import debug
 from soundconverter.error import show_error
@@ -35,23 +36,156 @@ def beautify_uri(uri):
     return unquote_filename(uri).split('file://')[-1]
 
 
+# the characters GLib does not escape in the path of a file:// uri, with
+# the letters, digits and '-._~'
+uri_path_safe = "/!$&'()*+,:=@"
+
+
+def path_to_uri(path):
+    """Return the uri of a local path, as Gio.File.get_uri() would."""
+    return 'file://' + urllib.parse.quote(os.fsencode(path), safe=uri_path_safe)
+
+
+def local_walk(path):
+    """Yield the uri of each regular file below the local folder path,
+    with os.scandir(), which mostly knows the type of files without
+    reading their inode."""
+    stack = [os.scandir(path)]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop().close()
+            continue
+        try:
+            if entry.is_dir():
+                stack.append(os.scandir(entry.path))
+            elif entry.is_file():
+                yield path_to_uri(entry.path)
+        except OSError as error:
+            debug('cannot read %s: %s' % (entry.path, error))
+
+
+def gio_walk(uri):
+    """Yield the uri of each regular file below the folder uri, reading
+    only the type and name of files."""
+    def enumerate_children(gfile):
+        return gfile.enumerate_children('standard::type,standard::name',
+                                        Gio.FileQueryInfoFlags.NONE, None)
+
+    stack = [enumerate_children(Gio.file_parse_name(uri))]
+    while stack:
+        enumerator = stack[-1]
+        try:
+            file_info = enumerator.next_file(None)
+        except GLib.GError as error:
+            debug('cannot read %s: %s' % (
+                enumerator.get_container().get_uri(), error))
+            file_info = None
+        if file_info is None:
+            stack.pop().close(None)
+            continue
+        child = enumerator.get_child(file_info)
+        file_type = file_info.get_file_type()
+        if file_type == Gio.FileType.DIRECTORY:
+            try:
+                stack.append(enumerate_children(child))
+            except GLib.GError as error:
+                debug('cannot read %s: %s' % (child.get_uri(), error))
+        elif file_type == Gio.FileType.REGULAR:
+            yield child.get_uri()
+
+
+class AsyncWalker:
+    """Lists the regular files below folders with asynchronous Gio calls,
+    for remote folders where each call waits for the server.
+
+    Up to max_folders folders are read at once, batch_size files at a
+    time. on_files is called with a list of uris as they are found, and
+    on_done when all folders are listed."""
+
+    max_folders = 8
+    batch_size = 500
+    attributes = 'standard::type,standard::name'
+
+    def __init__(self, on_files, on_done=None):
+        self.on_files = on_files
+        self.on_done = on_done
+        self.waiting = deque()
+        self.reading = 0
+        self.cancellable = Gio.Cancellable()
+
+    def start(self, uris):
+        self.waiting.extend(Gio.file_parse_name(uri) for uri in uris)
+        self.read_next()
+
+    def cancel(self):
+        self.waiting.clear()
+        self.cancellable.cancel()
+
+    def read_next(self):
+        while self.waiting and self.reading < self.max_folders:
+            self.reading += 1
+            gfile = self.waiting.popleft()
+            gfile.enumerate_children_async(
+                self.attributes, Gio.FileQueryInfoFlags.NONE,
+                GLib.PRIORITY_DEFAULT, self.cancellable, self.enumerated,
+                None)
+        if not self.reading and self.on_done:
+            self.on_done()
+            self.on_done = None
+
+    def enumerated(self, gfile, result, data):
+        try:
+            enumerator = gfile.enumerate_children_finish(result)
+        except GLib.GError as error:
+            debug('cannot read %s: %s' % (gfile.get_uri(), error))
+            self.folder_done()
+            return
+        enumerator.next_files_async(self.batch_size, GLib.PRIORITY_DEFAULT,
+                                    self.cancellable, self.got_files, None)
+
+    def got_files(self, enumerator, result, data):
+        try:
+            infos = enumerator.next_files_finish(result)
+        except GLib.GError as error:
+            debug('cannot read %s: %s' % (
+                enumerator.get_container().get_uri(), error))
+            infos = []
+        if not infos:
+            enumerator.close_async(GLib.PRIORITY_DEFAULT, None, None, None)
+            self.folder_done()
+            return
+        files = []
+        for info in infos:
+            file_type = info.get_file_type()
+            if file_type == Gio.FileType.DIRECTORY:
+                self.waiting.append(enumerator.get_child(info))
+            elif file_type == Gio.FileType.REGULAR:
+                files.append(enumerator.get_child(info).get_uri())
+        # ask for the next batch before handling this one
+        enumerator.next_files_async(self.batch_size, GLib.PRIORITY_DEFAULT,
+                                    self.cancellable, self.got_files, None)
+        if files:
+            self.on_files(files)
+        self.read_next()
+
+    def folder_done(self):
+        self.reading -= 1
+        self.read_next()
+
+
 def vfs_walk(uri):
-    """similar to os.path.walk, but with Gio.
+    """similar to os.walk, but with Gio.
 
     uri -- the base folder uri.
-    return a list of uri.
+    yield the uri of each regular file below it, depth first.
 
     """
-    filelist = []
-    dirlist = Gio.file_parse_name(uri).enumerate_children('*', Gio.FileMonitorFlags.NONE, None)
-    for file_info in dirlist:
-        name = file_info.get_name()
-        info = dirlist.get_child(file_info).query_file_type(Gio.FileMonitorFlags.NONE, None)
-        if info == Gio.FileType.DIRECTORY:
-            filelist.extend(vfs_walk(dirlist.get_child(file_info).get_uri()))
-        if info == Gio.FileType.REGULAR:
-            filelist.append(str(dirlist.get_child(file_info).get_uri()))
-    return filelist
+    path = Gio.file_parse_name(uri).get_path() \
+        if uri.startswith('file://') else None
+    if path:
+        return local_walk(path)
+    return gio_walk(uri)
 
 def vfs_getparent(path):
     """Get folder name."""
@@ -63,15 +197,18 @@ def vfs_unlink(filename):
     gfile = Gio.file_parse_name(filename)
     return gfile.delete(None)
 
-def vfs_rename(original, newname):
-    """Rename a gnomevfs file"""
+def vfs_rename(original, newname, overwrite=False):
+    """Rename a gnomevfs file. With overwrite, replace the file at newname,
+    atomically on the same filesystem."""
     gforiginal = Gio.file_parse_name(original)
     gfnew = Gio.file_parse_name(newname)
     debug('Creating folder \'%s\'?' % gfnew.get_parent().get_uri())
     if not gfnew.get_parent().query_exists(None):
         debug('Creating folder: \'%s\'' % gfnew.get_parent().get_uri())
         Gio.File.make_directory_with_parents(gfnew.get_parent(), None)
-    gforiginal.move(gfnew, Gio.FileCopyFlags.NONE, None, None, None)
+    flags = Gio.FileCopyFlags.OVERWRITE if overwrite else \
+        Gio.FileCopyFlags.NONE
+    gforiginal.move(gfnew, flags, None, None, None)
 
 def vfs_exists(filename):
     gfile = Gio.file_parse_name(filename)
@@ -21,21 +21,31 @@
 
 import os
 import sys
-from urllib.parse import urlparse
+import math
+import struct
+import threading
 from gettext import gettext as _
 
 import gi
 from gi.repository import Gst, Gtk, GLib, GObject, Gio
+gi.require_version('GstPbutils', '1.0')
+from gi.repository import GstPbutils
 
 from soundconverter.fileoperations import vfs_encode_filename, file_encode_filename
-from soundconverter.fileoperations import unquote_filename, vfs_unlink
+from soundconverter.fileoperations import vfs_unlink
 from soundconverter.fileoperations import vfs_rename
 from soundconverter.fileoperations import vfs_exists
 from soundconverter.fileoperations import beautify_uri
 from soundconverter.task import BackgroundTask
-from soundconverter.queue import TaskQueue
+from soundconverter.queue import TaskQueue, JobsController, Watchdog
+from soundconverter.workers import WorkerPool, WorkerTask, converter_options
+from soundconverter.workers import get_settings_hash
+from soundconverter.sniffer import sniff_file, read_header, find_wav_data
+from soundconverter.cache import metadata_cache
+from soundconverter.journal import journal
 from soundconverter.utils import debug, log, idle
 from soundconverter.settings import mime_whitelist, filename_blacklist
+from soundconverter.settings import settings
 from soundconverter.error import show_error
 
 try:
@@ -143,6 +153,139 @@ if 'mp4mux' not in available_elements:
     available_elements.discard('avenc_aac')
 
 
+class PipelinePool:
+    """Pipelines which reached EOS, kept in READY state to be reused for
+    the same command."""
+
+    def __init__(self):
+        self.idle = {}
+
+    def get_size(self):
+        jobs = settings['forced-jobs'] or settings['jobs'] or \
+            settings['cpu-count']
+        return max(jobs, settings['max-jobs'] or 0)
+
+    def get(self, command):
+        pipelines = self.idle.get(command)
+        if pipelines:
+            return pipelines.pop()
+        return None
+
+    def put(self, command, pipeline):
+        pipelines = self.idle.setdefault(command, [])
+        if len(pipelines) >= self.get_size():
+            pipeline.set_state(Gst.State.NULL)
+            return
+        pipeline.set_state(Gst.State.READY)
+        # drop the messages of the previous run
+        bus = pipeline.get_bus()
+        bus.set_flushing(True)
+        bus.set_flushing(False)
+        pipelines.append(pipeline)
+
+    def clear(self):
+        for pipelines in self.idle.values():
+            for pipeline in pipelines:
+                pipeline.set_state(Gst.State.NULL)
+        self.idle = {}
+
+
+pipeline_pool = PipelinePool()
+
+
+class BusDispatcher:
+    """Forwards the bus messages the pipelines handle to the main loop, in
+    batches, from a sync handler."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.scheduled = False
+        # statistics
+        self.seen = 0
+        self.forwarded = 0
+        self.batches = 0
+
+    def watch(self, task, bus):
+        bus.set_sync_handler(self.sync_handler, task)
+
+    def unwatch(self, bus):
+        bus.set_sync_handler(None)
+
+    def sync_handler(self, bus, message, task):
+        wanted = message.type & task.message_types
+        with self.lock:
+            self.seen += 1
+            if wanted:
+                self.forwarded += 1
+                self.pending.append((task, bus, message))
+                if not self.scheduled:
+                    self.scheduled = True
+                    GLib.idle_add(self.dispatch)
+        return Gst.BusSyncReply.DROP
+
+    def dispatch(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.scheduled = False
+            self.batches += 1
+        for task, bus, message in pending:
+            # skip the messages of a pipeline stopped in the meantime
+            if task.pipeline is not None:
+                task.on_message(bus, message)
+        return False
+
+
+bus_dispatcher = BusDispatcher()
+
+
+tag_whitelist = (
+    'album-artist',
+    'artist',
+    'album',
+    'title',
+    'track-number',
+    'track-count',
+    'genre',
+    'datetime',
+    'year',
+    'timestamp',
+    'disc-number',
+    'disc-count',
+)
+
+
+def get_tags(taglist):
+    """Return the tags of a GstTagList used in filename patterns, as a
+    dict."""
+    type_getters = {
+        GObject.TYPE_STRING: 'get_string',
+        GObject.TYPE_DOUBLE: 'get_double',
+        GObject.TYPE_FLOAT: 'get_float',
+        GObject.TYPE_INT: 'get_int',
+        GObject.TYPE_UINT: 'get_uint',
+    }
+    tags = {}
+
+    def append_tag(taglist, tag, unused_udata):
+        if tag not in tag_whitelist:
+            return
+
+        tag_type = Gst.tag_get_type(tag)
+        if tag_type in type_getters:
+            value = str(getattr(taglist, type_getters[tag_type])(tag)[1])
+            tags[tag] = value
+
+        if 'datetime' in tag:
+            dt = taglist.get_date_time(tag)[1]
+            tags['year'] = dt.get_year()
+            tags['date'] = dt.to_iso8601_string()[:10]
+
+    taglist.foreach(append_tag, None)
+    debug('   ', tags)
+    return tags
+
+
 class Pipeline(BackgroundTask):
     """A background task for running a GstPipeline."""
 
@@ -151,6 +294,11 @@ class Pipeline(BackgroundTask):
         self.pipeline = None
         self.sound_file = None
         self.command = []
+        # location property of named elements, set when playing
+        self.locations = {}
+        self.reusable = False
+        # the bus messages on_message() receives
+        self.message_types = Gst.MessageType.ERROR | Gst.MessageType.EOS
         self.parsed = False
         self.signals = []
         self.processing = False
@@ -195,6 +343,8 @@ class Pipeline(BackgroundTask):
     def restart(self):
         self.parsed = False
         self.duration = None
+        self.position = 0
+        self.decoded_bytes = 0
         self.finished()
         if vfs_exists(self.output_filename):
             vfs_unlink(self.output_filename)
@@ -264,17 +414,23 @@ class Pipeline(BackgroundTask):
     def play(self):
         if not self.parsed:
             command = ' ! '.join(self.command)
-            debug('launching: \'%s\'' % command)
             try:
-                self.pipeline = Gst.parse_launch(command)
+                if self.reusable:
+                    self.pipeline = pipeline_pool.get(command)
+                if self.pipeline:
+                    debug('reusing: \'%s\'' % command)
+                else:
+                    debug('launching: \'%s\'' % command)
+                    self.pipeline = Gst.parse_launch(command)
+                for name, location in self.locations.items():
+                    debug('   %s: %s' % (name, location))
+                    self.pipeline.get_by_name(name).set_property(
+                        'location', encode_filename(location))
                 bus = self.pipeline.get_bus()
                 assert not self.connected_signals
                 self.connected_signals = []
                 for name, signal, callback in self.signals:
-                    if name:
-                        element = self.pipeline.get_by_name(name)
-                    else:
-                        element = bus
+                    element = self.pipeline.get_by_name(name)
                     sid = element.connect(signal, callback)
                     self.connected_signals.append((element, sid,))
 
@@ -287,8 +443,7 @@ class Pipeline(BackgroundTask):
                 self.done()
                 return
 
-            bus.add_signal_watch()
-            self.watch_id = bus.connect('message', self.on_message)
+            bus_dispatcher.watch(self, bus)
 
         self.pipeline.set_state(Gst.State.PLAYING)
 
@@ -296,10 +451,11 @@ class Pipeline(BackgroundTask):
         if not self.pipeline:
             debug('pipeline already stopped!')
             return
-        self.pipeline.set_state(Gst.State.NULL)
-        bus = self.pipeline.get_bus()
-        bus.disconnect(self.watch_id)
-        bus.remove_signal_watch()
+        bus_dispatcher.unwatch(self.pipeline.get_bus())
+        if self.reusable and self.eos and not self.error:
+            pipeline_pool.put(' ! '.join(self.command), self.pipeline)
+        else:
+            self.pipeline.set_state(Gst.State.NULL)
         self.pipeline = None
 
     def get_position(self):
@@ -317,57 +473,6 @@ class Pipeline(BackgroundTask):
         except Gst.QueryError:
             self.sound_file.duration = None
 
-class TypeFinder(Pipeline):
-    def __init__(self, sound_file):
-        Pipeline.__init__(self)
-        self.sound_file = sound_file
-
-        command = '%s location="%s" ! decodebin name=decoder ! fakesink' % \
-                  (gstreamer_source, encode_filename(self.sound_file.uri))
-        self.add_command(command)
-        self.add_signal('decoder', 'pad-added', self.pad_added)
-        # 'typefind' is the name of the typefind element created inside
-        # decodebin. we can't use our own typefind before decodebin anymore,
-        # since its caps would've been the same as decodebin's sink caps.
-        self.add_signal('typefind', 'have-type', self.have_type)
-
-    def on_error(self, error):
-        self.error = error
-        log('ignored-error: %s (%s)' % (error, ' ! '.join(self.command)))
-
-    def set_found_type_hook(self, found_type_hook):
-        self.found_type_hook = found_type_hook
-    
-    def pad_added(self, decoder, pad):
-        """ called when a decoded pad is created """
-        self.query_duration()
-        self.done()
-
-    def have_type(self, typefind, probability, caps):
-        mime_type = caps.to_string()
-        debug('have_type:', mime_type, self.sound_file.filename_for_display)
-        self.sound_file.mime_type = None
-        for t in mime_whitelist:
-            if t in mime_type:
-                self.sound_file.mime_type = mime_type
-        if not self.sound_file.mime_type:
-            log('mime type skipped: %s' % mime_type)
-        for t in filename_blacklist:
-            if fnmatch(self.sound_file.uri, t):
-                self.sound_file.mime_type = None
-                log('filename blacklisted (%s): %s' % (t, self.sound_file.filename_for_display))
-        
-        return True
-
-    def finished(self):
-        Pipeline.finished(self)
-        if self.error:
-            return
-        if self.found_type_hook and self.sound_file.mime_type:
-            self.found_type_hook(self.sound_file, self.sound_file.mime_type)
-            self.sound_file.mime_type = True
-
-
 class Decoder(Pipeline):
     """A GstPipeline background task that decodes data and finds tags."""
 
@@ -375,79 +480,60 @@ class Decoder(Pipeline):
         Pipeline.__init__(self)
         self.sound_file = sound_file
         self.time = 0
+        # end of the last decoded buffer in seconds, and the decoded bytes,
+        # updated from the streaming thread
         self.position = 0
-
-        command = '%s location="%s" name=src ! decodebin name=decoder' % \
-                  (gstreamer_source, encode_filename(self.sound_file.uri))
-        self.add_command(command)
+        self.decoded_bytes = 0
+        # (pad, probe id) of the counting probes, removed when stopped so
+        # a reused pipeline is only counted once
+        self.probes = []
+
+        self.add_command('%s name=src ! decodebin name=decoder' %
+                         gstreamer_source)
+        self.locations['src'] = self.sound_file.uri
         self.add_signal('decoder', 'pad-added', self.pad_added)
+        self.message_types |= Gst.MessageType.TAG
 
     def have_type(self, typefind, probability, caps):
         pass
 
-    def query_position(self):
-        """
-        Ask for the stream position of the current pipeline.
-        """
-        try:
-            if self.pipeline:
-                self.position = max(0, self.pipeline.query_position(
-                    Gst.Format.TIME)[1] / Gst.SECOND)
-        except Gst.QueryError:
-            self.position = 0
+    def count_buffer(self, pad, info):
+        """Pad probe updating the position and decoded_bytes counters, so
+        reading the progress does not query the pipeline."""
+        buf = info.get_buffer()
+        if buf.pts != Gst.CLOCK_TIME_NONE:
+            end = buf.pts
+            if buf.duration != Gst.CLOCK_TIME_NONE:
+                end += buf.duration
+            self.position = end / Gst.SECOND
+        self.decoded_bytes += buf.get_size()
+        return Gst.PadProbeReturn.OK
 
     def found_tag(self, decoder, something, taglist):
         """
         Called when the decoder reads a tag.
         """
         debug('found_tags:', self.sound_file.filename_for_display)
-        taglist.foreach(self.append_tag, None)
-
-    def append_tag(self, taglist, tag, unused_udata):
-        tag_whitelist = (
-            'album-artist',
-            'artist',
-            'album',
-            'title',
-            'track-number',
-            'track-count',
-            'genre',
-            'datetime',
-            'year',
-            'timestamp',
-            'disc-number',
-            'disc-count',
-        )
-        if tag not in tag_whitelist:
-            return
-
-        tag_type = Gst.tag_get_type(tag)
-        type_getters = {
-            GObject.TYPE_STRING: 'get_string',
-            GObject.TYPE_DOUBLE: 'get_double',
-            GObject.TYPE_FLOAT: 'get_float',
-            GObject.TYPE_INT: 'get_int',
-            GObject.TYPE_UINT: 'get_uint',
-        }
-
-        tags = {}
-        if tag_type in type_getters:
-            value = str(getattr(taglist, type_getters[tag_type])(tag)[1])
-            tags[tag] = value
-
-        if 'datetime' in tag:
-            dt = taglist.get_date_time(tag)[1]
-            tags['year'] = dt.get_year()
-            tags['date'] = dt.to_iso8601_string()[:10]
-
-        debug('   ', tags)
-        self.sound_file.tags.update(tags)
+        self.sound_file.tags.update(get_tags(taglist))
 
     def pad_added(self, decoder, pad):
         """ called when a decoded pad is created """
+        if self.reusable and not pad.is_linked():
+            # a reused pipeline lost the link parse_launch made to decodebin
+            sinkpad = self.pipeline.find_unlinked_pad(Gst.PadDirection.SINK)
+            if sinkpad and pad.can_link(sinkpad):
+                pad.link(sinkpad)
+        self.probes.append((pad, pad.add_probe(Gst.PadProbeType.BUFFER,
+                                               self.count_buffer)))
         self.processing = True
         self.query_duration()
 
+    def cleanup(self):
+        for pad, probe_id in self.probes:
+            pad.remove_probe(probe_id)
+        self.probes = []
+        Pipeline.cleanup(self)
+
     def finished(self):
         Pipeline.finished(self)
 
@@ -462,40 +548,201 @@ class Decoder(Pipeline):
         return self.sound_file.duration
 
     def get_position(self):
-        """ return the current pipeline position in the stream """
-        self.query_position()
+        """ return the current position in the stream """
         return self.position
 
 
-class TagReader(Decoder):
-    """A GstPipeline background task for finding meta tags in a file."""
+def is_accepted_type(mime_type):
+    """Tell if a file of mime_type, as found by typefinding, can be
+    converted."""
+    return any(t in mime_type for t in mime_whitelist)
+
+
+def is_blacklisted(uri):
+    for t in filename_blacklist:
+        if fnmatch(uri, t):
+            log('filename blacklisted (%s): %s' % (t, beautify_uri(uri)))
+            return True
+    return False
+
+
+class DiscovererPool:
+    """GstDiscoverers for the Probers. A discoverer handles one file at a
+    time, so there is one for each running Prober."""
+
+    timeout = 10
+
+    def __init__(self):
+        self.idle = []
+
+    def get(self):
+        if self.idle:
+            return self.idle.pop()
+        discoverer = GstPbutils.Discoverer.new(self.timeout * Gst.SECOND)
+        discoverer.start()
+        return discoverer
+
+    def put(self, discoverer):
+        self.idle.append(discoverer)
+
+
+discoverer_pool = DiscovererPool()
+
+
+class Prober(BackgroundTask):
+    """A background task finding the type, duration and tags of a file
+    with a GstDiscoverer."""
 
     def __init__(self, sound_file):
-        Decoder.__init__(self, sound_file)
+        BackgroundTask.__init__(self)
+        self.sound_file = sound_file
+        self.error = None
+        self.discoverer = None
+        self.handler_id = None
+        self.found_type_hook = None
         self.found_tag_hook = None
-        self.found_tags = False
-        self.tagread = False
-        self.run_start_time = 0
-        self.add_command('fakesink')
-        self.add_signal(None, 'message::state-changed', self.on_state_changed)
-        self.tagread = False
+
+    def set_found_type_hook(self, found_type_hook):
+        self.found_type_hook = found_type_hook
 
     def set_found_tag_hook(self, found_tag_hook):
         self.found_tag_hook = found_tag_hook
 
-    def on_state_changed(self, bus, message):
-        prev, new, pending = message.parse_state_changed()
-        if new == Gst.State.PLAYING and not self.tagread:
-            self.tagread = True
-            debug('TagReading done...')
+    def started(self):
+        if is_blacklisted(self.sound_file.uri):
+            self.done()
+            return
+        if metadata_cache.lookup(self.sound_file):
+            debug('cached:', self.sound_file.filename_for_display)
             self.done()
+            return
+        self.discoverer = discoverer_pool.get()
+        self.handler_id = self.discoverer.connect('discovered',
+                                                  self.discovered)
+        if not self.discoverer.discover_uri_async(self.sound_file.uri):
+            self.release()
+            self.error = _('Cannot read \'%s\'') % \
+                self.sound_file.filename_for_display
+            self.done()
+
+    def release(self, discard=False):
+        self.discoverer.disconnect(self.handler_id)
+        if discard:
+            self.discoverer.stop()
+        else:
+            discoverer_pool.put(self.discoverer)
+        self.discoverer = None
+
+    def discovered(self, discoverer, info, error):
+        if info.get_uri() != self.sound_file.uri:
+            return
+        self.release()
+        if not self.running:
+            return
+        if info.get_result() != GstPbutils.DiscovererResult.OK:
+            self.error = error.message if error else str(info.get_result())
+            log('ignored-error: %s (%s)' % (
+                self.error, self.sound_file.filename_for_display))
+            self.done()
+            return
+
+        mime_type = info.get_stream_info().get_caps().to_string()
+        debug('have_type:', mime_type, self.sound_file.filename_for_display)
+        self.sound_file.mime_type = None
+        if info.get_audio_streams() and is_accepted_type(mime_type):
+            self.sound_file.mime_type = mime_type
+        if not self.sound_file.mime_type:
+            log('mime type skipped: %s' % mime_type)
+
+        duration = info.get_duration() / Gst.SECOND
+        if duration > 0:
+            self.sound_file.duration = duration
+        taglist = info.get_tags()
+        if taglist:
+            self.sound_file.tags.update(get_tags(taglist))
+        metadata_cache.store(self.sound_file)
+        self.done()
+
+    def aborted(self):
+        if self.discoverer:
+            # pending discoveries cannot be cancelled one by one
+            self.release(discard=True)
 
     def finished(self):
-        Pipeline.finished(self)
         self.sound_file.tags_read = True
+        if self.found_type_hook and self.sound_file.mime_type:
+            self.found_type_hook(self.sound_file, self.sound_file.mime_type)
         if self.found_tag_hook:
             GLib.idle_add(self.found_tag_hook, self)
 
+    def get_duration(self):
+        return self.sound_file.duration
+
+    def get_position(self):
+        return 0
+
+
+# raw audio formats accepted by the encoders, None for any
+encoder_formats = {
+    'audio/x-flac': ('S8', 'S16LE', 'S24_32LE'),
+    # the WAV encoder has its own audioconvert
+    'audio/x-wav': None,
+    'audio/x-vorbis': ('F32LE',),
+    'audio/mpeg': ('S16LE',),
+    'audio/ogg; codecs=opus': ('S16LE',),
+}
+
+# most channels accepted by the encoders, any number when None
+encoder_channels = {
+    'audio/x-flac': 8,
+    'audio/x-wav': None,
+    'audio/x-vorbis': 8,
+    'audio/mpeg': 2,
+    'audio/ogg; codecs=opus': 2,
+}
+
+# sample rates accepted by the encoders, all of them when not listed
+encoder_rates = {
+    'audio/mpeg': (8000, 11025, 12000, 16000, 22050, 24000, 32000,
+                   44100, 48000),
+    'audio/ogg; codecs=opus': (8000, 12000, 16000, 24000, 48000),
+}
+
+
+def get_raw_format(found):
+    """Return the raw audio format decoded from a file of the format
+    found by sniffer.sniff(), None if it depends on the decoder."""
+    mime_type = found['mime_type']
+    if mime_type == 'audio/x-wav' and found['pcm']:
+        return {8: 'U8', 16: 'S16LE', 24: 'S24LE',
+                32: 'S32LE'}.get(found['sample_width'])
+    if mime_type == 'audio/x-flac':
+        return {8: 'S8', 16: 'S16LE', 24: 'S24_32LE',
+                32: 'S32LE'}.get(found['sample_width'])
+    if mime_type == 'audio/x-vorbis':
+        return 'F32LE'
+    return None
+
+
+def schedule_by_duration(queue, callback):
+    """Read the durations of the files of a queue of converters, split or
+    sort them as the settings ask, then call callback()."""
+    readers = TaskQueue()
+    for task in queue.waiting_tasks:
+        if task.sound_file.duration is None:
+            readers.add_task(Prober(task.sound_file))
+
+    def readers_ended():
+        metadata_cache.commit()
+        if settings['split-long-files']:
+            split_long_files(queue)
+        if settings['longest-first']:
+            queue.sort_longest_first(lambda task: task.get_duration())
+        callback()
+
+    readers.queue_ended = readers_ended
+    readers.start()
+
 
 class Converter(Decoder):
     """A background task for converting files to another format."""
@@ -507,6 +754,7 @@ class Converter(Decoder):
 
         self.output_filename = output_filename
         self.output_type = output_type
+        self.outputs = [(output_filename, output_type)]
         self.vorbis_quality = 0.6
         self.aac_quality = 192
         self.mp3_bitrate = 192
@@ -521,9 +769,25 @@ class Converter(Decoder):
 
         self.overwrite = False
         self.delete_original = delete_original
+        self.reusable = settings['reuse-pipelines']
+        self.passthrough = settings['passthrough']
+        # milliseconds of audio queued for the encoder thread, 0 to decode
+        # and encode in the same thread
+        self.encoder_queue = settings['encoder-queue']
+        # add only the conversions needed by the input format
+        self.trim_pipeline = settings['trim-pipeline']
+        self.input_format = None
+        # size of the input file, when it is copied as it is
+        self.copy_size = None
 
         self.got_duration = False
 
+    def add_output(self, output_filename, output_type):
+        """Also write the decoded audio to output_filename, in output_type.
+
+        The file is decoded once and a tee feeds one encoder per output."""
+        self.outputs.append((output_filename, output_type))
+
     def init(self):
         self.encoders = {
             'audio/x-vorbis': self.add_oggvorbis_encoder,
@@ -534,52 +798,190 @@ class Converter(Decoder):
             'audio/ogg; codecs=opus': self.add_opus_encoder,
             'gst-profile': self.add_audio_profile,
         }
-        self.add_command('audiorate')
-        self.add_command('audioconvert')
-        self.add_command('audioresample')
 
-        # audio resampling support
-        if self.output_resample:
-            self.add_command('audio/x-raw,rate=%d' % self.resample_rate)
+        for output_filename, output_type in self.outputs:
+            gfile = Gio.file_parse_name(output_filename)
+            dirname = gfile.get_parent()
+            if dirname and not dirname.query_exists(None):
+                log('Creating folder: \'%s\'' % beautify_uri(dirname.get_uri()))
+                if not dirname.make_directory_with_parents():
+                    show_error('Error', _("Cannot create \'%s\' folder.") % beautify_uri(dirname))
+                    return
+            if self.overwrite and vfs_exists(output_filename):
+                log('overwriting \'%s\'' % beautify_uri(output_filename))
+                vfs_unlink(output_filename)
+
+        if self.can_copy():
+            # already in the output format, copy the file as it is
+            debug('copying: \'%s\'' % beautify_uri(self.sound_file.uri))
+            self.command = ['%s name=src' % gstreamer_source]
+            self.signals = [s for s in self.signals if s[0] != 'decoder']
+            self.add_command('%s name=sink' % gstreamer_sink)
+            self.locations['sink'] = self.output_filename
+            self.processing = True
+            # the progress is counted by a probe of this pipeline
+            self.reusable = False
+            try:
+                self.copy_size = get_file_size(self.sound_file.uri)
+            except GLib.GError:
+                self.copy_size = None
+            return
+
+        audiorate, audioconvert, audioresample = self.get_conversions()
+        if audiorate:
+            self.add_command('audiorate')
+        if audioconvert:
             self.add_command('audioconvert')
+        if audioresample:
             self.add_command('audioresample')
 
+        # audio resampling and downmixing support
+        caps = []
+        if self.output_resample:
+            caps.append('rate=%d' % self.resample_rate)
         if self.force_mono:
-            self.add_command('audio/x-raw,channels=1')
-            self.add_command('audioconvert')
+            caps.append('channels=1')
+        if caps:
+            self.add_command('audio/x-raw,%s' % ','.join(caps))
+
+        if len(self.outputs) == 1:
+            if self.encoder_queue:
+                self.add_command(self.get_queue())
+            self.add_command(self.encoders[self.output_type]())
+            self.add_command('%s name=sink' % gstreamer_sink)
+            self.locations['sink'] = self.output_filename
+            return
 
-        encoder = self.encoders[self.output_type]()
-        self.add_command(encoder)
+        # decode once, encode to each output
+        branches = ['tee name=outputs']
+        for i, (output_filename, output_type) in enumerate(self.outputs):
+            branches.append('outputs. ! %s ! %s ! %s name=sink%d' % (
+                self.get_queue(), self.encoders[output_type](),
+                gstreamer_sink, i))
+            self.locations['sink%d' % i] = output_filename
+        self.add_command(' '.join(branches))
+
+    def get_queue(self):
+        """Return a queue element, running the encoder after it in its own
+        thread. It holds at most encoder_queue milliseconds of audio."""
+        if not self.encoder_queue:
+            return 'queue'
+        return 'queue max-size-buffers=0 max-size-bytes=0 ' \
+            'max-size-time=%d' % (self.encoder_queue * Gst.MSECOND)
+
+    def get_input_format(self):
+        """Return the format found in the header of a local input file."""
+        if self.input_format is None:
+            self.input_format = {}
+            if self.sound_file.uri.startswith('file://'):
+                self.input_format = sniff_file(self.sound_file.uri) or {}
+        return self.input_format or None
+
+    def get_conversions(self):
+        """Tell which of audiorate, audioconvert and audioresample the
+        decoded audio needs before the encoder."""
+        found = self.trim_pipeline and len(self.outputs) == 1 and \
+            self.get_input_format()
+        raw_format = found and get_raw_format(found)
+        if not raw_format or self.output_type not in encoder_formats or \
+                not found.get('channels') or not found.get('rate'):
+            return True, True, True
+
+        # lossless files are sample accurate, there are no gaps to fill
+        audiorate = found['mime_type'] not in ('audio/x-wav', 'audio/x-flac')
+
+        formats = encoder_formats[self.output_type]
+        max_channels = encoder_channels[self.output_type]
+        audioconvert = (formats is not None and raw_format not in formats) \
+            or (max_channels is not None and found['channels'] > max_channels) \
+            or (self.force_mono and found['channels'] != 1)
+
+        rates = encoder_rates.get(self.output_type)
+        rate = self.resample_rate if self.output_resample else found['rate']
+        audioresample = rate != found['rate'] or \
+            bool(rates and rate not in rates)
+        # audioresample does not take every raw format
+        audioconvert = audioconvert or audioresample
+        return audiorate, bool(audioconvert), audioresample
+
+    def get_settings_hash(self):
+        return get_settings_hash(self)
 
-        gfile = Gio.file_parse_name(self.output_filename)
-        dirname = gfile.get_parent()
-        if dirname and not dirname.query_exists(None):
-            log('Creating folder: \'%s\'' % beautify_uri(dirname.get_uri()))
-            if not dirname.make_directory_with_parents():
-                show_error('Error', _("Cannot create \'%s\' folder.") % beautify_uri(dirname))
-                return
+    def play(self):
+        parsed = self.parsed
+        Decoder.play(self)
+        if self.copy_size is not None and not parsed and self.parsed:
+            # there is no decoded pad to count the progress on
+            pad = self.pipeline.get_by_name('src').get_static_pad('src')
+            pad.add_probe(Gst.PadProbeType.BUFFER, self.count_bytes)
+
+    def count_bytes(self, pad, info):
+        """Pad probe counting the bytes copied."""
+        self.decoded_bytes += info.get_buffer().get_size()
+        return Gst.PadProbeReturn.OK
 
-        self.add_command('%s location="%s"' % (
-            gstreamer_sink, encode_filename(self.output_filename)))
-        if self.overwrite and vfs_exists(self.output_filename):
-            log('overwriting \'%s\'' % beautify_uri(self.output_filename))
-            vfs_unlink(self.output_filename)
+    def get_position(self):
+        if self.copy_size is None:
+            return self.position
+        if not self.copy_size:
+            return 0
+        # without a duration the fraction copied still shows the progress
+        # to the Watchdog
+        duration = self.sound_file.duration or 1
+        return duration * min(self.decoded_bytes / self.copy_size, 1.0)
+
+    def can_copy(self):
+        """Tell if the input file already is in the output format, with
+        the same parameters, so it can be copied instead of converted."""
+        if not self.passthrough or len(self.outputs) > 1:
+            return False
+        found = self.get_input_format()
+        if not found or found['mime_type'] != self.output_type:
+            return False
+        if self.output_resample and found['rate'] != self.resample_rate:
+            return False
+        if self.force_mono and found['channels'] != 1:
+            return False
+        if self.output_type == 'audio/x-wav':
+            return found['pcm'] and \
+                found['sample_width'] == self.wav_sample_width
+        if self.output_type == 'audio/mpeg':
+            # the bitrate of the encoder is its quality in CBR mode
+            return self.mp3_mode == 'cbr' and found['mp3_mode'] == 'cbr' \
+                and found['bitrate'] == self.mp3_quality
+        # FLAC is lossless, its compression does not change the audio
+        return self.output_type == 'audio/x-flac'
+
+    def finish_split(self, error):
+        """End the conversion a SplitConversion did instead of this one."""
+        self.error = error
+        self.processing = not error
+        self.run_finish_time = time.time()
+        self.emit('finished')
+
+    def restart(self):
+        for output_filename, output_type in self.outputs[1:]:
+            if vfs_exists(output_filename):
+                vfs_unlink(output_filename)
+        Decoder.restart(self)
 
     def aborted(self):
-        # remove partial file
-        try:
-            vfs_unlink(self.output_filename)
-        except:
-            log('cannot delete: \'%s\'' % beautify_uri(self.output_filename))
-        return
+        # remove partial files
+        for output_filename, output_type in self.outputs:
+            try:
+                vfs_unlink(output_filename)
+            except:
+                log('cannot delete: \'%s\'' % beautify_uri(output_filename))
 
     def finished(self):
         Pipeline.finished(self)
 
         # Copy file permissions
-        if not Gio.file_parse_name(self.sound_file.uri).copy_attributes(
-                Gio.file_parse_name(self.output_filename), Gio.FileCopyFlags.NONE, None):
-            log('Cannot set permission on \'%s\'' % beautify_uri(self.output_filename))
+        source = Gio.file_parse_name(self.sound_file.uri)
+        for output_filename, output_type in self.outputs:
+            if not source.copy_attributes(Gio.file_parse_name(output_filename),
+                                          Gio.FileCopyFlags.NONE, None):
+                log('Cannot set permission on \'%s\'' % beautify_uri(output_filename))
 
         if self.delete_original and self.processing and not self.error:
             log('deleting: \'%s\'' % self.sound_file.uri)
@@ -668,6 +1070,471 @@ class Converter(Decoder):
         return pipeline
 
 
+def is_up_to_date(task, targets):
+    """Tell if the files at targets were converted from the file of a
+    task as it is now, with the same settings."""
+    settings_hash = task.get_settings_hash()
+    return all(metadata_cache.is_up_to_date(task.sound_file.uri, target,
+                                            settings_hash)
+               for target in targets)
+
+
+def has_recorded_outputs(task):
+    """Tell if all the outputs of a task were recorded as converted from
+    its file as it is now, with the same settings, and still exist. For
+    when their names depend on tags which are not read yet."""
+    outputs = metadata_cache.find_outputs(task.sound_file.uri,
+                                          task.get_settings_hash())
+    return len([uri for uri in outputs if vfs_exists(uri)]) >= \
+        len(task.outputs)
+
+
+def record_outputs(task, targets):
+    """Remember the source and settings of the files converted by a
+    task, for is_up_to_date()."""
+    settings_hash = task.get_settings_hash()
+    for target in targets:
+        metadata_cache.record_output(task.sound_file.uri, target,
+                                     settings_hash)
+
+
+# the shortest segment a file is split in, in seconds
+min_segment_duration = 300
+# room left for the header and the chunks of a WAV file, like tags
+wav_header_size = 65536
+
+
+def estimate_wav_size(task):
+    """Return about how many bytes of audio data the WAV output of a task
+    holds, from the duration of its file and the format found in its
+    header. 48 kHz and stereo are assumed when they are not known."""
+    found = task.get_input_format() or {}
+    rate = task.resample_rate if task.output_resample else \
+        found.get('rate') or 48000
+    channels = 1 if task.force_mono else found.get('channels') or 2
+    duration = task.get_duration() or 0
+    return int(duration * rate * channels * task.wav_sample_width // 8)
+
+
+def can_split(task):
+    """Tell if the output of a task can be written in segments which are
+    then joined: WAV data is appended, Ogg streams are chained."""
+    if not isinstance(task, Converter) or \
+            isinstance(task, SegmentConverter) or \
+            len(task.outputs) != 1 or \
+            task.output_type not in ('audio/x-wav', 'audio/x-vorbis',
+                                     'audio/ogg; codecs=opus') or \
+            task.can_copy():
+        return False
+    if task.output_type == 'audio/x-wav' and \
+            estimate_wav_size(task) > 0xffffffff - wav_header_size:
+        log('not splitting %s, the WAV file would be too large' %
+            task.sound_file.filename_for_display)
+        return False
+    return True
+
+
+def split_long_files(queue):
+    """Replace the conversions of the files longer than the share of a job
+    by SplitConversions."""
+    tasks = list(queue.waiting_tasks)
+    durations = [task.get_duration() or 0 for task in tasks]
+    share = max(sum(durations) / queue.jobs, min_segment_duration)
+    for task, duration in zip(tasks, durations):
+        count = min(math.ceil(duration / share), queue.jobs)
+        if count < 2 or not can_split(task):
+            continue
+        log('splitting %s in %d segments' % (
+            task.sound_file.filename_for_display, count))
+        priority = queue.waiting_tasks.get_priority(task)
+        queue.waiting_tasks.remove(task)
+        queue.waiting_tasks.append(SplitConversion(task, count), priority)
+
+
+class SegmentConverter(Converter):
+    """Converts the part of a file between start and stop, in seconds, to
+    a temporary file. stop is None for the end of the file."""
+
+    def __init__(self, converter, index, start, stop):
+        output_filename = '%s~part%d~SC~' % (converter.output_filename, index)
+        Converter.__init__(self, converter.sound_file, output_filename,
+                           converter.output_type)
+        for name in converter_options:
+            if name in ('output_filename', 'outputs', 'overwrite',
+                        'delete_original'):
+                continue
+            if hasattr(converter, name):
+                setattr(self, name, getattr(converter, name))
+        self.segment_start = start
+        self.segment_stop = stop
+        self.overwrite = True
+        self.passthrough = False
+        self.reusable = False
+        self.seeked = False
+        self.init()
+
+    def pad_added(self, decoder, pad):
+        # nothing before the start of the segment goes to the encoder
+        pad.add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.EVENT_FLUSH,
+                      self.drop_until_seeked)
+        Converter.pad_added(self, decoder, pad)
+        GLib.idle_add(self.seek, pad)
+
+    def drop_until_seeked(self, pad, info):
+        if info.type & Gst.PadProbeType.EVENT_FLUSH:
+            if info.get_event().type == Gst.EventType.FLUSH_STOP:
+                self.seeked = True
+            return Gst.PadProbeReturn.OK
+        if not self.seeked:
+            return Gst.PadProbeReturn.DROP
+        return Gst.PadProbeReturn.REMOVE
+
+    def seek(self, pad):
+        if not self.running:
+            return False
+        stop_type, stop = Gst.SeekType.NONE, -1
+        if self.segment_stop is not None:
+            stop_type = Gst.SeekType.SET
+            stop = int(self.segment_stop * Gst.SECOND)
+        event = Gst.Event.new_seek(1.0, Gst.Format.TIME,
+            Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE, Gst.SeekType.SET,
+            int(self.segment_start * Gst.SECOND), stop_type, stop)
+        if not pad.send_event(event):
+            self.error = _('Cannot seek in this file')
+            log('error: %s (%s)' % (self.error,
+                                    self.sound_file.filename_for_display))
+            self.done()
+        return False
+
+    def finished(self):
+        Pipeline.finished(self)
+
+    def get_position(self):
+        return max(0, Converter.get_position(self) - self.segment_start)
+
+    def get_duration(self):
+        stop = self.segment_stop
+        if stop is None:
+            stop = self.sound_file.duration or self.segment_start
+        return stop - self.segment_start
+
+
+class SplitConversion(BackgroundTask):
+    """The conversion of a file by SegmentConverters run with the jobs the
+    queue gives it, then joined by a SegmentJoiner."""
+
+    # the share of the progress of joining the segments
+    join_share = 0.1
+
+    def __init__(self, converter, count):
+        BackgroundTask.__init__(self)
+        self.converter = converter
+        self.sound_file = converter.sound_file
+        self.error = None
+        self.wanted_jobs = count
+        self.jobs = 1
+        self.paused = False
+        length = converter.get_duration() / count
+        self.segments = []
+        for i in range(count):
+            stop = (i + 1) * length if i < count - 1 else None
+            self.segments.append(SegmentConverter(converter, i, i * length,
+                                                  stop))
+        self.waiting = []
+        self.running_segments = set()
+        # seconds converted by the finished segments
+        self.converted = 0
+        self.joiner = None
+
+    def started(self):
+        self.waiting = list(self.segments)
+        self.start_segments()
+
+    def start_segments(self):
+        while self.waiting and len(self.running_segments) < self.jobs:
+            segment = self.waiting.pop(0)
+            segment.add_listener('finished', self.segment_finished)
+            self.running_segments.add(segment)
+            segment.start()
+            if self.paused:
+                segment.toggle_pause(True)
+
+    def segment_finished(self, segment):
+        if segment not in self.running_segments:
+            return
+        self.running_segments.discard(segment)
+        self.converted += segment.get_duration()
+        if segment.error:
+            self.error = segment.error
+            self.done()
+        elif self.waiting or self.running_segments:
+            self.start_segments()
+        else:
+            self.joiner = SegmentJoiner(self)
+            self.joiner.add_listener('finished', self.joined)
+            self.joiner.start()
+            if self.paused:
+                self.joiner.toggle_pause(True)
+
+    def joined(self, joiner):
+        self.error = joiner.error
+        self.done()
+
+    def stop(self):
+        """Stop the segments and the joiner still running."""
+        for segment in self.running_segments:
+            segment.abort()
+        self.running_segments = set()
+        self.waiting = []
+        if self.joiner and self.joiner.running:
+            self.joiner.abort()
+
+    def remove_segments(self):
+        for segment in self.segments:
+            if vfs_exists(segment.output_filename):
+                vfs_unlink(segment.output_filename)
+
+    def toggle_pause(self, paused):
+        self.paused = paused
+        for segment in self.running_segments:
+            segment.toggle_pause(paused)
+        if self.joiner:
+            self.joiner.toggle_pause(paused)
+
+    def aborted(self):
+        self.stop()
+        self.remove_segments()
+
+    def finished(self):
+        # also when ended by the Watchdog
+        self.stop()
+        self.remove_segments()
+        converter = self.converter
+        if self.error and vfs_exists(converter.output_filename):
+            vfs_unlink(converter.output_filename)
+        converter.finish_split(self.error)
+
+    def get_duration(self):
+        return self.converter.get_duration()
+
+    def get_position(self):
+        """Return the position of the conversion, joining the segments
+        being its last join_share."""
+        duration = self.get_duration() or 0
+        if self.joiner:
+            joined = self.joiner.copied / self.joiner.total \
+                if self.joiner.total else 0
+            return duration * (1 - self.join_share + self.join_share * joined)
+        position = self.converted + sum(segment.get_position()
+                                        for segment in self.running_segments)
+        return min(position, duration) * (1 - self.join_share)
+
+
+def get_file_size(uri):
+    info = Gio.file_parse_name(uri).query_info(
+        'standard::size', Gio.FileQueryInfoFlags.NONE, None)
+    return info.get_size()
+
+
+def plan_wav(uris, headers, first_size):
+    """Return the parts of a WAV file joining the data of the WAV files at
+    uris, from their headers: bytes, or (uri, offset, size) to copy."""
+    layouts = []
+    for uri, header in zip(uris, headers):
+        found = find_wav_data(header)
+        if not found:
+            raise ValueError(_('Cannot find the audio data of \'%s\'')
+                             % beautify_uri(uri))
+        layouts.append(found)
+    data_size = sum(size for offset, size in layouts)
+    offset, size = layouts[0]
+    head = headers[0][:offset]
+    # chunks are padded to an even size
+    tail_offset = offset + 8 + size + size % 2
+    tail_size = max(0, first_size - tail_offset)
+    riff_size = len(head) - 8 + 8 + data_size + data_size % 2 + tail_size
+    if riff_size > 0xffffffff:
+        raise ValueError(_('The WAV file would be too large'))
+
+    parts = [b'RIFF' + struct.pack('<I', riff_size) + head[8:] +
+             b'data' + struct.pack('<I', data_size)]
+    for uri, (offset, size) in zip(uris, layouts):
+        parts.append((uri, offset + 8, size))
+    if data_size % 2:
+        parts.append(b'\0')
+    if tail_size:
+        parts.append((uris[0], tail_offset, tail_size))
+    return parts
+
+
+class SegmentJoiner(BackgroundTask):
+    """Writes the output file of a SplitConversion from the files of its
+    segments, with asynchronous reads and writes of a chunk at a time."""
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, split):
+        BackgroundTask.__init__(self)
+        self.split = split
+        self.sound_file = split.sound_file
+        self.error = None
+        # bytes, or (uri, offset, size) to copy to the output
+        self.parts = []
+        self.copied = 0
+        self.total = 0
+        self.input = None
+        self.remaining = 0
+        self.output = None
+        self.cancellable = Gio.Cancellable()
+        self.paused = False
+        # the next step, when paused
+        self.resume = None
+
+    def started(self):
+        try:
+            self.plan()
+        except (GLib.GError, ValueError) as error:
+            self.fail(error)
+            return
+        gfile = Gio.file_parse_name(self.split.converter.output_filename)
+        gfile.replace_async(None, False, Gio.FileCreateFlags.NONE,
+                            GLib.PRIORITY_DEFAULT, self.cancellable,
+                            self.output_opened)
+
+    def plan(self):
+        uris = [segment.output_filename for segment in self.split.segments]
+        if self.split.converter.output_type != 'audio/x-wav':
+            # Ogg streams can be chained
+            self.parts = [(uri, 0, get_file_size(uri)) for uri in uris]
+        else:
+            self.parts = plan_wav(uris, [read_header(uri, 65536)
+                                         for uri in uris],
+                                  get_file_size(uris[0]))
+        self.total = sum(part[2] for part in self.parts
+                         if not isinstance(part, bytes))
+
+    def step(self, function):
+        """Call the next step, or keep it for when the joiner is resumed."""
+        if not self.running:
+            return
+        if self.paused:
+            self.resume = function
+        else:
+            function()
+
+    def output_opened(self, gfile, result):
+        try:
+            self.output = gfile.replace_finish(result)
+        except GLib.GError as error:
+            self.fail(error)
+            return
+        self.step(self.next_part)
+
+    def next_part(self):
+        if not self.parts:
+            self.output.close_async(GLib.PRIORITY_DEFAULT, self.cancellable,
+                                    self.output_closed)
+            return
+        part = self.parts.pop(0)
+        if isinstance(part, bytes):
+            self.write(part)
+            return
+        uri, offset, self.remaining = part
+        Gio.file_parse_name(uri).read_async(
+            GLib.PRIORITY_DEFAULT, self.cancellable, self.input_opened,
+            offset)
+
+    def input_opened(self, gfile, result, offset):
+        try:
+            self.input = gfile.read_finish(result)
+            self.input.seek(offset, GLib.SeekType.SET, None)
+        except GLib.GError as error:
+            self.fail(error)
+            return
+        self.step(self.read_chunk)
+
+    def read_chunk(self):
+        self.input.read_bytes_async(min(self.chunk_size, self.remaining),
+                                    GLib.PRIORITY_DEFAULT, self.cancellable,
+                                    self.chunk_read)
+
+    def chunk_read(self, stream, result):
+        try:
+            data = stream.read_bytes_finish(result).get_data()
+            if not data:
+                raise ValueError(_('Unexpected end of file'))
+        except (GLib.GError, ValueError) as error:
+            self.fail(error)
+            return
+        self.remaining -= len(data)
+        self.copied += len(data)
+        self.write(data)
+
+    def write(self, data):
+        self.output.write_all_async(data, GLib.PRIORITY_DEFAULT,
+                                    self.cancellable, self.written)
+
+    def written(self, stream, result):
+        try:
+            stream.write_all_finish(result)
+        except GLib.GError as error:
+            self.fail(error)
+            return
+        if self.input and self.remaining:
+            self.step(self.read_chunk)
+            return
+        if self.input:
+            self.input.close(None)
+            self.input = None
+        self.step(self.next_part)
+
+    def output_closed(self, stream, result):
+        self.output = None
+        try:
+            stream.close_finish(result)
+        except GLib.GError as error:
+            self.fail(error)
+            return
+        self.done()
+
+    def fail(self, error):
+        if not self.running:
+            # cancelled by abort()
+            return
+        self.error = str(error)
+        log('cannot join segments: %s' % self.error)
+        self.close()
+        self.done()
+
+    def close(self):
+        self.cancellable.cancel()
+        for stream in (self.input, self.output):
+            if stream:
+                try:
+                    stream.close(None)
+                except GLib.GError:
+                    # a cancelled operation is still pending
+                    pass
+        self.input = self.output = None
+
+    def toggle_pause(self, paused):
+        self.paused = paused
+        if not paused and self.resume:
+            function, self.resume = self.resume, None
+            self.step(function)
+
+    def aborted(self):
+        self.close()
+
+    def get_duration(self):
+        return self.sound_file.duration
+
+    def get_position(self):
+        if not self.total:
+            return 0
+        return (self.sound_file.duration or 0) * self.copied / self.total
+
+
 class ConverterQueue(TaskQueue):
     """Background task for converting many files."""
 
@@ -675,6 +1542,11 @@ class ConverterQueue(TaskQueue):
         TaskQueue.__init__(self)
         self.window = window
         self.overwrite_action = None
+        self.worker_pool = None
+        if settings['adaptive-jobs']:
+            self.jobs_controller = JobsController(self)
+        if settings['stall-timeout']:
+            self.watchdog = Watchdog(self, settings['stall-timeout'])
         self.reset_counters()
 
     def reset_counters(self):
@@ -686,19 +1558,36 @@ class ConverterQueue(TaskQueue):
         global user_canceled_codec_installation
         user_canceled_codec_installation = True
 
-    def add(self, sound_file):
-        # generate a temporary filename from source name and output suffix
-        output_filename = self.window.prefs.generate_temp_filename(sound_file)
-
-        if vfs_exists(output_filename):
-            # always overwrite temporary files
-            vfs_unlink(output_filename)
-
-        path = urlparse(output_filename)[2]
-        path = unquote_filename(path)
-
-        c = Converter(sound_file, output_filename,
-                      self.window.prefs.settings.get_string('output-mime-type'),
+    def add(self, sound_file, priority=0, output_types=None):
+        """Add a conversion of sound_file to the queue, to output_types or
+        to the format of the preferences."""
+        task = self.make_task(sound_file, output_types)
+        if task:
+            self.add_task(task, priority)
+
+    def add_lazily(self, sound_files):
+        """Add the conversions of sound_files to the queue, creating each
+        converter only when a job is free to run it."""
+        self.add_task_source(
+            (self.make_task(sound_file) for sound_file in sound_files),
+            len(sound_files))
+
+    def make_task(self, sound_file, output_types=None):
+        """Return the task converting sound_file, None if it is already
+        converted."""
+        if not output_types:
+            output_types = [self.window.prefs.settings.get_string('output-mime-type')]
+
+        # generate temporary filenames from source name
+        output_filenames = []
+        for output_type in output_types:
+            output_filename = self.window.prefs.generate_temp_filename(sound_file)
+            if vfs_exists(output_filename):
+                # always overwrite temporary files
+                vfs_unlink(output_filename)
+            output_filenames.append(output_filename)
+
+        c = Converter(sound_file, output_filenames[0], output_types[0],
                       self.window.prefs.settings.get_boolean('delete-original'),
                       self.window.prefs.settings.get_boolean('output-resample'),
                       self.window.prefs.settings.get_int('resample-rate'),
@@ -719,9 +1608,69 @@ class ConverterQueue(TaskQueue):
         mode = self.window.prefs.settings.get_string('mp3-mode')
         c.set_mp3_mode(mode)
         c.set_mp3_quality(self.window.prefs.settings.get_int(quality[mode]))
-        c.init()
-        c.add_listener('finished', self.on_task_finished)
-        self.add_task(c)
+        for output_filename, output_type in zip(output_filenames[1:],
+                                                output_types[1:]):
+            c.add_output(output_filename, output_type)
+        if journal.is_completed(c):
+            log('already converted: %s' % sound_file.filename_for_display)
+            return None
+        if settings['incremental'] and \
+                not journal.was_interrupted(sound_file.uri) and \
+                not journal.has_failed(sound_file.uri) and \
+                self.is_up_to_date(c, output_types):
+            log('up to date: %s' % sound_file.filename_for_display)
+            return None
+        if settings['worker-processes']:
+            if not self.worker_pool:
+                self.worker_pool = WorkerPool()
+            task = WorkerTask(c, self.worker_pool)
+        else:
+            c.init()
+            task = c
+        task.add_listener('finished', self.on_task_finished)
+        journal.queued(task)
+        return task
+
+    def is_up_to_date(self, task, output_types):
+        """Tell if the outputs of a task were converted before from its
+        file as it is now, with the same settings."""
+        sound_file = task.sound_file
+        if not sound_file.tags_read and metadata_cache.lookup(sound_file):
+            sound_file.tags_read = True
+        if not sound_file.tags_read:
+            return has_recorded_outputs(task)
+        targets = [self.get_target(sound_file, output_type)
+                   for output_type in output_types]
+        return all(replace for target, replace in targets) and \
+            is_up_to_date(task, [target for target, replace in targets])
+
+    def get_target(self, sound_file, output_type):
+        """Return the name of the output of sound_file in output_type, and
+        whether it replaces a file converted from sound_file before."""
+        newname = self.window.prefs.generate_filename(sound_file,
+                                                      output_type=output_type)
+        # safe mode. generate a filename until we find a free one
+        p, e = os.path.splitext(newname)
+        p = p.replace('%', '%%')
+        p = p + ' (%d)' + e
+        i = 1
+        while vfs_exists(newname):
+            if settings['incremental'] and (
+                    not settings['metadata-cache'] or
+                    metadata_cache.get_source(newname) == sound_file.uri):
+                return newname, True
+            newname = p % i
+            i += 1
+        return newname, False
+
+    def source_failed(self, error):
+        self.errors.append(str(error))
+        self.error_count += 1
+
+    def stop_workers(self):
+        if self.worker_pool:
+            self.worker_pool.stop()
+            self.worker_pool = None
 
     def get_progress(self, per_file_progress):
         tasks = self.running_tasks
@@ -749,8 +1698,8 @@ class ConverterQueue(TaskQueue):
                 taskprogress = min(max(taskprogress, 0.0), 1.0)
                 prolist.append(taskprogress)
                 per_file_progress[task.sound_file] = taskprogress
-        for task in self.waiting_tasks:
-            prolist.append(0.0)
+        prolist.extend([0.0] * (len(self.waiting_tasks) +
+                                self.get_sources_length()))
 
         progress = sum(prolist) / len(prolist) if prolist else 0
         progress = min(max(progress, 0.0), 1.0)
@@ -759,35 +1708,46 @@ class ConverterQueue(TaskQueue):
     def on_task_finished(self, task):
         task.sound_file.progress = 1.0
 
-        if task.error:
-            debug('error in task, skipping rename:', task.output_filename)
-            if vfs_exists(task.output_filename):
-                vfs_unlink(task.output_filename)
-            self.errors.append(task.error)
+        if not task.error:
+            duration = task.get_duration()
+            if duration:
+                self.duration_processed += duration
+
+        targets = []
+        for output_filename, output_type in task.outputs:
+            targets.append(self.output_finished(task, output_filename,
+                                                output_type))
+        if all(targets):
+            journal.finished(task, targets)
+        else:
+            journal.finished(task, [], task.error or self.errors[-1])
+
+    def output_finished(self, task, output_filename, output_type):
+        """Rename the temporary file of one output of a task, or count its
+        error. Return the new name, None if there was an error."""
+        if task.error or not vfs_exists(output_filename):
+            debug('error in task, skipping rename:', output_filename)
+            if vfs_exists(output_filename):
+                vfs_unlink(output_filename)
+            self.errors.append(task.error or _('Cannot write \'%s\'') %
+                               beautify_uri(output_filename))
             self.error_count += 1
-            return
-
-        duration = task.get_duration()
-        if duration:
-            self.duration_processed += duration
-
-        # rename temporary file 
-        newname = self.window.prefs.generate_filename(task.sound_file)
-        debug(beautify_uri(task.output_filename), '->', beautify_uri(newname))
+            return None
 
-        # safe mode. generate a filename until we find a free one
-        p, e = os.path.splitext(newname)
-        p = p.replace('%', '%%')
-        p = p + ' (%d)' + e
-        i = 1
-        while vfs_exists(newname):
-            newname = p % i
-            i += 1
+        # rename temporary file. The output converted before from the same
+        # file is replaced only once the new one is in place
+        newname, replace = self.get_target(task.sound_file, output_type)
+        debug(beautify_uri(output_filename), '->', beautify_uri(newname))
 
-        task.error = vfs_rename(task.output_filename, newname)
-        if task.error:
-            self.errors.append(task.error)
+        try:
+            vfs_rename(output_filename, newname, overwrite=replace)
+        except GLib.GError as error:
+            self.errors.append(str(error))
             self.error_count += 1
+            return None
+        if settings['incremental']:
+            record_outputs(task, [newname])
+        return newname
 
     def finished(self):
         # This must be called with emit_async
@@ -803,6 +1763,9 @@ class ConverterQueue(TaskQueue):
         self.window.set_status(msg)
         if not self.window.is_active():
             notification(msg) # this must move
+        self.stop_workers()
+        # the next batch may use other settings, so other pipelines
+        pipeline_pool.clear()
         self.reset_counters()
 
     def format_time(self, seconds):
@@ -822,9 +1785,14 @@ class ConverterQueue(TaskQueue):
 
     def abort(self):
         TaskQueue.abort(self)
+        self.stop_workers()
+        pipeline_pool.clear()
         self.window.set_sensitive()
         self.reset_counters()
-    
-    def start(self):
-        #self.waiting_tasks.sort(key=Converter.get_duration,reverse=True)
-        TaskQueue.start(self)
+
+    def started(self):
+        if (settings['longest-first'] or settings['split-long-files']) and \
+                not self.sources:
+            schedule_by_duration(self, lambda: TaskQueue.started(self))
+        else:
+            TaskQueue.started(self)
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# SoundConverter - GNOME application for converting between audio formats.
+# Copyright 2004 Lars Wirzenius
+# Copyright 2005-2017 Gautier Portet
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""
+A record of the conversions of a batch, to resume it after a crash.
+
+The journal is a text file with one JSON object per line, only ever
+appended to. A line is written when a batch starts, with the files and
+folders given and the manifest, when a file is queued, with the files its
+conversion writes, and when its conversion is finished, with the outputs
+and the hash of the settings.
+"""
+
+import os
+import json
+
+from gi.repository import Gio, GLib
+
+from soundconverter.fileoperations import vfs_exists, vfs_unlink
+from soundconverter.utils import log, debug
+
+
+def remove_parts(uris):
+    """Remove the files of the segments of the outputs at uris."""
+    # list each folder once
+    folders = {}
+    for uri in uris:
+        gfile = Gio.file_parse_name(uri)
+        folder = folders.setdefault(gfile.get_parent().get_uri(), set())
+        folder.add(gfile.get_basename())
+    for folder, names in folders.items():
+        parent = Gio.file_parse_name(folder)
+        try:
+            enumerator = parent.enumerate_children(
+                'standard::name', Gio.FileQueryInfoFlags.NONE, None)
+            for info in enumerator:
+                name = info.get_name()
+                if name.endswith('~SC~') and '~part' in name and \
+                        name[:name.rindex('~part')] in names:
+                    debug('removing', name)
+                    parent.get_child(name).delete(None)
+        except GLib.GError as error:
+            log('cannot remove the segments in %s: %s' % (folder, error))
+
+
+class Journal:
+    """The journal of the conversions of a batch."""
+
+    def __init__(self):
+        self.file = None
+        # source uri: files written by its conversion, of the files queued
+        # and not finished
+        self.pending = {}
+        # source uri: [targets, settings hash], of the files converted
+        self.completed = {}
+        # source uris of the files which failed to convert
+        self.failed = {}
+        # the inputs of the last batch started
+        self.inputs = None
+
+    def open(self, path, resume_path=None):
+        """Append to the journal at path. If resume_path is given, read the
+        journal there first, which may be the same one, and remove the
+        temporary files of the conversions which did not finish."""
+        if resume_path:
+            self.load(resume_path)
+            self.remove_temporary_files()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def load(self, path):
+        try:
+            f = open(path, encoding='utf-8')
+        except FileNotFoundError:
+            log('no journal at %s, starting a new one' % path)
+            return
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of a run which crashed can be cut
+                    continue
+                if entry['event'] == 'started':
+                    self.inputs = entry
+                    continue
+                source = entry['source']
+                if entry['event'] == 'queued':
+                    self.pending[source] = entry['outputs']
+                    continue
+                self.pending.pop(source, None)
+                if entry['error']:
+                    self.completed.pop(source, None)
+                    self.failed[source] = True
+                else:
+                    self.completed[source] = [entry['targets'],
+                                              entry['settings']]
+                    self.failed.pop(source, None)
+
+    def write(self, entry, sync=False):
+        if not self.file:
+            return
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def started(self, uris, streaming=False, manifest=None,
+                manifest_format=None):
+        """Record the files and folders a batch converts, and its manifest.
+        The files of a batch which creates its conversions as they start are
+        only queued then, so resuming it reads its inputs again."""
+        if manifest and manifest != '-':
+            manifest = os.path.abspath(manifest)
+        self.write({
+            'event': 'started',
+            'inputs': uris,
+            'streaming': streaming,
+            'manifest': manifest,
+            'manifest-format': manifest_format,
+        }, sync=True)
+
+    def queued(self, task):
+        """Record that the conversion of a task is queued."""
+        self.write({
+            'event': 'queued',
+            'source': task.sound_file.uri,
+            'outputs': [output_filename for output_filename, output_type
+                        in task.outputs],
+        })
+
+    def finished(self, task, targets, error=None):
+        """Record the outcome of the conversion of a task, and the final
+        names of its outputs."""
+        self.write({
+            'event': 'finished',
+            'source': task.sound_file.uri,
+            'targets': targets,
+            'settings': task.get_settings_hash(),
+            'error': str(error) if error else None,
+        }, sync=True)
+
+    def is_completed(self, task):
+        """Tell if the file of a task was converted with the same settings,
+        and its outputs still exist."""
+        entry = self.completed.get(task.sound_file.uri)
+        if not entry:
+            return False
+        targets, settings_hash = entry
+        return settings_hash == task.get_settings_hash() and \
+            all(vfs_exists(target) for target in targets)
+
+    def was_interrupted(self, uri):
+        """Tell if the conversion of the file at uri was queued and did not
+        finish."""
+        return uri in self.pending
+
+    def has_failed(self, uri):
+        """Tell if the last conversion of the file at uri failed."""
+        return uri in self.failed
+
+    def get_unfinished(self):
+        """Return the uris of the files queued which were not converted."""
+        return list(self.pending) + [uri for uri in self.failed
+                                     if uri not in self.pending]
+
+    def get_resumed_inputs(self):
+        """Return the uris of the files and folders to convert to resume the
+        batch, its manifest and the format of the manifest.
+
+        These are the inputs of the last batch when it was streaming or read
+        a manifest, as it may not have queued all its files, and only the
+        files it did not convert otherwise. Raise ValueError if its manifest
+        was read from stdin, which cannot be read again."""
+        entry = self.inputs
+        if not entry or not (entry['streaming'] or entry['manifest']):
+            return self.get_unfinished(), None, None
+        if entry['manifest'] == '-':
+            raise ValueError('the manifest of the batch was read from stdin')
+        return entry['inputs'], entry['manifest'], entry['manifest-format']
+
+    def remove_temporary_files(self):
+        """Remove what the conversions which did not finish wrote: the
+        temporary files, and the files of the segments of the outputs."""
+        outputs = [output_filename for filenames in self.pending.values()
+                   for output_filename in filenames]
+        for output_filename in outputs:
+            if output_filename.endswith('~SC~') and \
+                    vfs_exists(output_filename):
+                vfs_unlink(output_filename)
+        remove_parts(outputs)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+journal = Journal()
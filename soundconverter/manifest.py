@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# SoundConverter - GNOME application for converting between audio formats.
+# Copyright 2004 Lars Wirzenius
+# Copyright 2005-2017 Gautier Portet
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""
+Lists of files to convert, read from a file or from stdin.
+
+A manifest is one of:
+ - lines: one path or uri per line,
+ - nul: paths separated by NUL characters, as printed by `find -print0`,
+ - jsonl: one JSON object per line, with a 'path' and optionally an
+   'output' path, a 'format' (a MIME type or a shortcut like 'mp3') and
+   a 'priority', or a JSON string with only the path,
+ - csv: a header line naming the same columns, then one file per line.
+
+The manifest is read as the records are used, so the first files can be
+converted before the end of a long manifest is read.
+"""
+
+import io
+import os
+import sys
+import csv
+import json
+
+from soundconverter.fileoperations import filename_to_uri
+from soundconverter.utils import log
+
+manifest_formats = ('auto', 'lines', 'nul', 'jsonl', 'csv')
+
+# bytes read at once from NUL separated manifests
+chunk_size = 65536
+
+
+def open_manifest(path):
+    """Return the binary stream of the manifest at path, stdin for '-'."""
+    if path == '-':
+        return sys.stdin.buffer
+    return open(path, 'rb')
+
+
+def guess_format(path, stream):
+    """Find the format of a manifest from its name or its first bytes."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.jsonl', '.json'):
+        return 'jsonl'
+    if extension == '.csv':
+        return 'csv'
+    start = stream.peek(chunk_size)[:chunk_size]
+    if b'\0' in start:
+        return 'nul'
+    if start.lstrip().startswith(b'{'):
+        return 'jsonl'
+    return 'lines'
+
+
+def read_lines(stream):
+    for number, line in enumerate(stream, 1):
+        line = line.rstrip(b'\r\n')
+        if line:
+            yield number, {'path': os.fsdecode(line)}
+
+
+def read_nul(stream):
+    number = 0
+    rest = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        *paths, rest = (rest + chunk).split(b'\0')
+        if not chunk:
+            # the last path may not be terminated
+            paths.append(rest)
+        for path in paths:
+            number += 1
+            if path:
+                yield number, {'path': os.fsdecode(path)}
+        if not chunk:
+            return
+
+
+def read_jsonl(stream):
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line.decode('utf-8'))
+        except ValueError as error:
+            log('manifest line %d: %s' % (number, error))
+            continue
+        if isinstance(record, str):
+            record = {'path': record}
+        yield number, record
+
+
+def read_csv(stream):
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    try:
+        reader = csv.DictReader(text)
+        for record in reader:
+            # empty columns are not given
+            yield reader.line_num, dict((key, value) for key, value
+                                        in record.items() if value)
+    finally:
+        # leave the stream to read_manifest() to close, also when the
+        # records are not all read
+        text.detach()
+
+
+readers = {
+    'lines': read_lines,
+    'nul': read_nul,
+    'jsonl': read_jsonl,
+    'csv': read_csv,
+}
+
+
+def check_record(record):
+    """Return the record of a manifest with the uris of its paths, and its
+    priority as a number. Raise ValueError if it is not valid."""
+    if not isinstance(record, dict) or not record.get('path'):
+        raise ValueError('no path')
+    return {
+        'uri': filename_to_uri(record['path']),
+        'output': filename_to_uri(record['output'])
+        if record.get('output') else None,
+        'format': record.get('format') or None,
+        'priority': int(record.get('priority') or 0),
+    }
+
+
+def read_manifest(path, manifest_format='auto'):
+    """Open the manifest at path, and return an iterator over its records,
+    dicts of 'uri', 'output', 'format' and 'priority'."""
+    stream = open_manifest(path)
+    if manifest_format == 'auto':
+        manifest_format = guess_format(path, stream)
+    return iter_records(stream, manifest_format)
+
+
+def iter_records(stream, manifest_format):
+    """Yield the valid records read from stream, skipping the others."""
+    try:
+        for number, record in readers[manifest_format](stream):
+            try:
+                yield check_record(record)
+            except (ValueError, TypeError) as error:
+                log('manifest line %d skipped: %s' % (number, error))
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
@@ -20,11 +20,302 @@
 # USA
 
 import time
+import heapq
+import itertools
+from collections import deque
+from gettext import gettext as _
+from gi.repository import GLib
 from soundconverter.task import BackgroundTask
 from soundconverter.settings import settings
 from soundconverter.utils import log
 
 
+def estimate_makespan(durations, jobs):
+    """Return the time needed to run tasks of the given durations when each
+    one is started, in order, as soon as one of the jobs slots is free."""
+    slots = [0.0] * max(1, jobs)
+    for duration in durations:
+        heapq.heappush(slots, heapq.heappop(slots) + duration)
+    return max(slots)
+
+
+def read_cpu_times():
+    """Return the (busy, iowait, total) CPU time counters of the machine,
+    or None if /proc/stat is not available."""
+    try:
+        with open('/proc/stat') as stat:
+            fields = stat.readline().split()
+    except IOError:
+        return None
+    if not fields or fields[0] != 'cpu':
+        return None
+    # user nice system idle iowait irq softirq steal
+    values = [int(value) for value in fields[1:9]]
+    idle = values[3]
+    iowait = values[4] if len(values) > 4 else 0
+    total = sum(values)
+    return total - idle - iowait, iowait, total
+
+
+class JobsController:
+
+    """Adjust the number of concurrent tasks of a queue to the CPU usage,
+    the iowait and the throughput while it runs."""
+
+    interval = 3
+    saturated = 0.95
+    # the share of the time waiting for the disks above which running
+    # more tasks only makes them seek more
+    iowait_high = 0.2
+    # the throughput falls when it is below this share of the last one
+    falling = 0.8
+    hold_intervals = 5
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.min_jobs = settings['min-jobs'] or 1
+        self.max_jobs = settings['max-jobs'] or 2 * settings['cpu-count']
+        self.last_cpu = None
+        self.last_time = None
+        # the positions of the tasks at the last sample
+        self.positions = {}
+        self.last_throughput = 0
+        self.last_jobs = None
+        self.last_busy = False
+        self.increased = False
+        self.hold = 0
+        self.source_id = None
+        # the jobs of the queue before they were adjusted
+        self.configured_jobs = None
+        self.warned = False
+
+    def start(self):
+        self.stop()
+        self.configured_jobs = self.queue.jobs
+        self.last_cpu = read_cpu_times()
+        if self.last_cpu is None:
+            self.warn()
+        self.last_time = time.time()
+        self.positions = {}
+        self.last_throughput = 0
+        self.last_jobs = None
+        self.last_busy = False
+        self.increased = False
+        self.hold = 0
+        self.source_id = GLib.timeout_add_seconds(self.interval, self.update)
+
+    def stop(self):
+        """Stop adjusting the jobs, and give the queue its jobs back."""
+        if self.source_id:
+            GLib.source_remove(self.source_id)
+            self.source_id = None
+        if self.configured_jobs is not None:
+            self.queue.jobs = self.configured_jobs
+            self.configured_jobs = None
+
+    def warn(self):
+        if not self.warned:
+            log('adaptive jobs disabled: cannot read the CPU usage')
+            self.warned = True
+
+    def get_throughput(self):
+        """Return the seconds of audio processed per second by the tasks
+        since the last call, including those which finished since."""
+        now = time.time()
+        elapsed = now - self.last_time
+        self.last_time = now
+        positions = dict((task, task.get_position())
+                         for task in self.queue.running_tasks
+                         if hasattr(task, 'get_position'))
+        processed = 0.0
+        for task, last in self.positions.items():
+            if task not in positions:
+                # finished since the last call
+                processed += max(0, task.get_position() - last)
+        for task, position in positions.items():
+            processed += max(0, position - self.positions.get(task, 0))
+        self.positions = positions
+        return processed / elapsed if elapsed > 0 else 0.0
+
+    def set_jobs(self, jobs, reason):
+        jobs = min(max(jobs, self.min_jobs), self.max_jobs)
+        if jobs == self.queue.jobs:
+            return False
+        log('adaptive jobs: %d -> %d (%s)' % (self.queue.jobs, jobs, reason))
+        self.queue.jobs = jobs
+        self.queue.start_next_task()
+        return True
+
+    def update(self):
+        if not self.queue.running:
+            self.source_id = None
+            return False
+        if self.queue.paused:
+            return True
+
+        cpu = read_cpu_times()
+        if cpu is None or self.last_cpu is None:
+            self.warn()
+            self.source_id = None
+            return False
+        busy, iowait, total = [a - b for a, b in zip(cpu, self.last_cpu)]
+        self.last_cpu = cpu
+        if total <= 0:
+            return True
+        usage = float(busy) / total
+        iowait = float(iowait) / total
+        throughput = self.get_throughput()
+        reason = 'cpu %d%%, iowait %d%%, %.1fx realtime' % (
+            usage * 100, iowait * 100, throughput)
+
+        jobs = self.queue.jobs
+        # all the jobs are used, and tasks wait for one
+        busy = bool(self.queue.waiting_tasks) and \
+            self.queue.get_used_jobs() >= jobs
+        increased = False
+        if self.increased and throughput < self.last_throughput * 1.05:
+            # the last increase did not help, go back and stay there
+            self.set_jobs(jobs - 1, reason)
+            self.hold = self.hold_intervals
+        elif iowait > self.iowait_high:
+            self.set_jobs(jobs - 1, reason)
+        elif usage > self.saturated and jobs > settings['cpu-count']:
+            self.set_jobs(jobs - 1, reason)
+        elif busy and self.last_busy and jobs == self.last_jobs and \
+                throughput < self.last_throughput * self.falling:
+            # the tasks slow each other down
+            if self.set_jobs(jobs - 1, reason):
+                self.hold = self.hold_intervals
+        elif self.hold:
+            self.hold -= 1
+        elif usage < self.saturated and busy:
+            increased = self.set_jobs(jobs + 1, reason)
+
+        self.increased = increased
+        self.last_throughput = throughput
+        self.last_jobs = jobs
+        self.last_busy = busy
+        return True
+
+
+class Watchdog:
+
+    """End with an error the tasks of a queue whose position did not change
+    for timeout seconds."""
+
+    def __init__(self, queue, timeout):
+        self.queue = queue
+        self.timeout = timeout
+        self.positions = {}
+        self.stalled_tasks = []
+        self.source_id = None
+
+    def start(self):
+        self.stop()
+        self.positions = {}
+        self.stalled_tasks = []
+        self.source_id = GLib.timeout_add_seconds(
+            min(max(1, self.timeout // 4), 5), self.check)
+
+    def stop(self):
+        if self.source_id:
+            GLib.source_remove(self.source_id)
+            self.source_id = None
+
+    def check(self):
+        if not self.queue.running:
+            self.source_id = None
+            return False
+        if self.queue.paused:
+            # start counting again when resumed
+            self.positions = {}
+            return True
+        now = time.time()
+        positions = {}
+        for task in self.queue.running_tasks:
+            if not task.running:
+                continue
+            position = task.get_position()
+            last = self.positions.get(task)
+            if last is None or last[0] != position:
+                positions[task] = (position, now)
+            elif now - last[1] >= self.timeout:
+                self.stop_task(task)
+            else:
+                positions[task] = last
+        self.positions = positions
+        return True
+
+    def stop_task(self, task):
+        sound_file = getattr(task, 'sound_file', None)
+        log('no progress for %ds, stopping: %s' % (self.timeout,
+            sound_file.filename_for_display if sound_file else task))
+        task.error = _('No progress for %d seconds') % self.timeout
+        self.stalled_tasks.append(task)
+        task.done()
+
+
+class WaitingTasks:
+
+    """The tasks waiting in a TaskQueue, highest priority first, then in
+    the order they were added."""
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, task):
+        return task in self.entries
+
+    def __iter__(self):
+        """Iterate over the tasks, in the order they will be popped."""
+        return (entry[2] for entry in sorted(self.heap) if entry[2] is not None)
+
+    def new_entry(self, task, priority):
+        if task in self.entries:
+            self.remove(task)
+        entry = [-priority, next(self.counter), task]
+        self.entries[task] = entry
+        return entry
+
+    def append(self, task, priority=0):
+        heapq.heappush(self.heap, self.new_entry(task, priority))
+
+    def extend(self, tasks, priority=0):
+        for task in tasks:
+            self.heap.append(self.new_entry(task, priority))
+        heapq.heapify(self.heap)
+
+    def remove(self, task):
+        entry = self.entries.pop(task)
+        entry[2] = None
+
+    def popleft(self):
+        while self.heap:
+            task = heapq.heappop(self.heap)[2]
+            if task is not None:
+                del self.entries[task]
+                return task
+        raise IndexError('pop from an empty queue')
+
+    def get_priority(self, task):
+        return -self.entries[task][0]
+
+    def sort(self, key, reverse=False):
+        """Sort the tasks of each priority by key."""
+        priorities = dict((task, self.get_priority(task)) for task in self.entries)
+        tasks = sorted(self.entries, key=key, reverse=reverse)
+        self.heap = []
+        self.entries = {}
+        for task in tasks:
+            self.heap.append(self.new_entry(task, priorities[task]))
+        heapq.heapify(self.heap)
+
+
 class TaskQueue(BackgroundTask):
 
     """A queue of tasks.
@@ -40,46 +331,133 @@ class TaskQueue(BackgroundTask):
         q.start()
 
     The task queue behaves as a single task. It will execute the
-    tasks in order and start the next one when the previous finishes."""
+    tasks in order and start the next one when the previous finishes.
+    Tasks of a higher priority start first."""
 
     def __init__(self):
         BackgroundTask.__init__(self)
-        self.waiting_tasks = []
-        self.running_tasks = []
+        self.waiting_tasks = WaitingTasks()
+        self.running_tasks = set()
+        # the jobs used by running tasks besides their first one
+        self.extra_jobs = {}
+        self.sources = deque()
+        # the errors which ended task sources
+        self.source_errors = []
         self.finished_tasks = 0
         self.start_time = None
         self.count = 0
         self.paused = False
+        self.makespan = None
+        self.jobs_controller = None
+        self.watchdog = None
         self.jobs = settings['forced-jobs'] or settings['jobs']
         self.jobs = self.jobs or settings['cpu-count']
 
-    def add_task(self, task):
-        """Add a task to the queue."""
-        self.waiting_tasks.append(task)
+    def add_task(self, task, priority=0):
+        """Add a task to the queue.
+
+        Tasks of higher priority are started first."""
+        self.waiting_tasks.append(task, priority)
         #if self.start_time and not self.running_tasks:
         if self.start_time:
             # add a task to a stalled taskqueue, shake it!
             self.start_next_task()
 
+    def add_tasks(self, tasks, priority=0):
+        """Add several tasks of the same priority to the queue at once."""
+        self.waiting_tasks.extend(tasks, priority)
+        if self.start_time:
+            self.start_next_task()
+
+    def add_task_source(self, tasks, length=None, priority=0):
+        """Add the tasks of an iterable, taken from it when a job is free.
+        It may yield None, or (task, priority)."""
+        self.sources.append([iter(tasks), length, priority])
+        if self.start_time:
+            self.start_next_task()
+
+    def read_sources(self):
+        """Take tasks from the task sources until as many tasks as there
+        are jobs are waiting."""
+        while self.sources and len(self.waiting_tasks) < self.jobs:
+            source = self.sources[0]
+            tasks, length, priority = source
+            try:
+                task = next(tasks)
+            except StopIteration:
+                self.sources.popleft()
+                continue
+            except Exception as error:
+                # like a folder which cannot be read, or an invalid
+                # manifest. The tasks already taken from it still run.
+                log('cannot read the tasks to run: %r' % error)
+                self.sources.popleft()
+                self.source_errors.append(error)
+                self.source_failed(error)
+                continue
+            if length:
+                source[1] -= 1
+            if isinstance(task, tuple):
+                task, task_priority = task
+            else:
+                task_priority = priority
+            if task is not None:
+                self.waiting_tasks.append(task, task_priority)
+
+    def get_sources_length(self):
+        """Return the number of tasks left in the task sources, as far as
+        it is known."""
+        return sum(length or 0 for tasks, length, priority in self.sources)
+
+    def reprioritize(self, task, priority):
+        """Change the priority of a waiting task.
+
+        Return False if the task is not waiting anymore."""
+        if task not in self.waiting_tasks:
+            return False
+        self.waiting_tasks.append(task, priority)
+        return True
+
+    def sort_longest_first(self, get_duration):
+        """Reorder the waiting tasks of each priority to start the longest
+        ones first."""
+        def duration(task):
+            return get_duration(task) or 0
+        durations = [duration(task) for task in self.waiting_tasks]
+        self.waiting_tasks.sort(key=duration, reverse=True)
+        self.makespan = (estimate_makespan(durations, self.jobs),
+            estimate_makespan(sorted(durations, reverse=True), self.jobs))
+
+    def get_used_jobs(self):
+        """Return the number of jobs used by the running tasks."""
+        return len(self.running_tasks) + sum(self.extra_jobs.values())
+
     def start_next_task(self):
+        self.read_sources()
         if not self.waiting_tasks:
             if not self.running_tasks:
                 self.done()
             return
 
-        to_start = self.jobs - len(self.running_tasks)
-        for i in range(to_start):
+        while self.get_used_jobs() < self.jobs:
             try:
-                task = self.waiting_tasks.pop(0)
+                task = self.waiting_tasks.popleft()
             except IndexError:
                 return
-            self.running_tasks.append(task)
+            wanted_jobs = getattr(task, 'wanted_jobs', 1)
+            if wanted_jobs > 1:
+                task.jobs = min(wanted_jobs,
+                                self.jobs - self.get_used_jobs())
+                self.extra_jobs[task] = task.jobs - 1
+            self.running_tasks.add(task)
             task.add_listener('finished', self.task_finished)
             task.start()
             if self.paused:
                 task.toggle_pause(True)
             self.count += 1
-        total = len(self.waiting_tasks) + self.finished_tasks
+        self.read_sources()
+        total = len(self.waiting_tasks) + self.get_sources_length() + \
+            self.finished_tasks
         self.progress = float(self.finished_tasks) / total if total else 0
 
     def started(self):
@@ -90,34 +468,58 @@ class TaskQueue(BackgroundTask):
         self.count = 0
         self.paused = False
         self.finished_tasks = 0
+        self.source_errors = []
         self.start_time = time.time()
+        if self.jobs_controller:
+            self.jobs_controller.start()
+        if self.watchdog:
+            self.watchdog.start()
         self.start_next_task()
 
     def finished(self):
         """ BackgroundTask finish callback """
-        log('Queue done in %.3fs (%s tasks)' % (time.time() - self.start_time,
-                self.count))
+        msg = 'Queue done in %.3fs (%s tasks)' % (time.time() - self.start_time,
+                self.count)
+        if self.makespan:
+            msg += ', longest first: estimated %.1fs instead of %.1fs' % (
+                self.makespan[1], self.makespan[0])
+        if self.watchdog and self.watchdog.stalled_tasks:
+            msg += ', %d stalled' % len(self.watchdog.stalled_tasks)
+        log(msg)
+        self.makespan = None
+        if self.jobs_controller:
+            self.jobs_controller.stop()
+        if self.watchdog:
+            self.watchdog.stop()
         self.queue_ended()
         self.count = 0
         self.start_time = None
-        self.running_tasks = []
-        self.waiting_tasks = []
+        self.running_tasks = set()
+        self.extra_jobs = {}
+        self.waiting_tasks = WaitingTasks()
+        self.sources = deque()
         self.running = False
 
     def task_finished(self, task=None):
         if not self.running_tasks:
             return
-        if task in self.running_tasks:
-            self.running_tasks.remove(task)
+        self.running_tasks.discard(task)
+        self.extra_jobs.pop(task, None)
         self.finished_tasks += 1
         self.start_next_task()
 
     def abort(self):
         for task in self.running_tasks:
             task.abort()
+        if self.jobs_controller:
+            self.jobs_controller.stop()
+        if self.watchdog:
+            self.watchdog.stop()
         BackgroundTask.abort(self)
-        self.running_tasks = []
-        self.waiting_tasks = []
+        self.running_tasks = set()
+        self.extra_jobs = {}
+        self.waiting_tasks = WaitingTasks()
+        self.sources = deque()
         self.running = False
         self.start_time = None
 
@@ -130,6 +532,10 @@ class TaskQueue(BackgroundTask):
     def queue_ended(self):
         pass
 
+    # The following is called when a task source raised an exception
+    def source_failed(self, error):
+        pass
+
     # The following when progress changed
     def progress_hook(self, progress):
         pass
@@ -91,6 +91,15 @@ filepattern = (
     ('AC3',          '*.ac3')
 )
 
+# the output MIME types of the command line, by shortcut
+cli_mime_types = {
+    'vorbis': 'audio/x-vorbis',
+    'flac': 'audio/x-flac',
+    'wav': 'audio/x-wav',
+    'mp3': 'audio/mpeg',
+    'aac': 'audio/x-m4a',
+}
+
 
 # application-wide settings
 settings = {
@@ -102,4 +111,22 @@ settings = {
     'jobs': None,
     'cpu-count': cpu_count(),
     'forced-jobs': None,
+    'longest-first': False,
+    'adaptive-jobs': False,
+    'min-jobs': None,
+    'max-jobs': None,
+    'worker-processes': False,
+    'stall-timeout': 0,
+    'reuse-pipelines': False,
+    'trim-pipeline': False,
+    'passthrough': False,
+    'split-long-files': False,
+    'encoder-queue': 0,
+    'metadata-cache': True,
+    'incremental': False,
+    'journal': '',
+    'resume': '',
+    'streaming': False,
+    'manifest': '',
+    'manifest-format': 'auto',
 }
@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# SoundConverter - GNOME application for converting between audio formats.
+# Copyright 2004 Lars Wirzenius
+# Copyright 2005-2017 Gautier Portet
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""
+Find the format of a sound file from its first bytes, without GStreamer.
+
+The format is a dict with the output MIME type the file matches, as in
+the 'output-mime-type' setting, and the parameters found in the header.
+"""
+
+import struct
+
+from gi.repository import Gio, GLib
+
+from soundconverter.utils import debug
+
+header_size = 4096
+
+
+def read_header(uri, size=header_size, offset=0):
+    """Return the first size bytes of the file at uri, or those from
+    offset, b'' if it cannot be read."""
+    try:
+        stream = Gio.File.new_for_uri(uri).read(None)
+        if offset:
+            stream.seek(offset, GLib.SeekType.SET, None)
+        data = stream.read_bytes(size, None).get_data()
+        stream.close(None)
+        return data
+    except GLib.GError as error:
+        debug('cannot read header of %s: %s' % (uri, error))
+        return b''
+
+
+# the SubFormat of WAVE_FORMAT_EXTENSIBLE integer PCM files
+ksdataformat_subtype_pcm = b'\x01\0\0\0\0\0\x10\0\x80\0\0\xaa\0\x38\x9b\x71'
+
+
+def sniff_wav(data):
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return None
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk, size = struct.unpack('<4sI', data[offset:offset + 8])
+        if chunk == b'fmt ' and offset + 24 <= len(data):
+            tag, channels, rate = struct.unpack('<HHI', data[offset + 8:offset + 16])
+            sample_width, = struct.unpack('<H', data[offset + 22:offset + 24])
+            pcm = tag == 1
+            if tag == 0xfffe:
+                # WAVE_FORMAT_EXTENSIBLE, the SubFormat tells the encoding
+                pcm = data[offset + 32:offset + 48] == ksdataformat_subtype_pcm
+            return {
+                'mime_type': 'audio/x-wav',
+                'pcm': pcm,
+                'channels': channels,
+                'rate': rate,
+                'sample_width': sample_width,
+            }
+        offset += 8 + size + size % 2
+    return None
+
+
+def find_wav_data(data):
+    """Return the offset and size of the data chunk of a WAV file starting
+    with data, None if not found in data."""
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return None
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk, size = struct.unpack('<4sI', data[offset:offset + 8])
+        if chunk == b'data':
+            return offset, size
+        offset += 8 + size + size % 2
+    return None
+
+
+def sniff_flac(data):
+    if data[:4] != b'fLaC' or len(data) < 26:
+        return None
+    # the STREAMINFO block always comes first
+    info, = struct.unpack('>Q', data[18:26])
+    return {
+        'mime_type': 'audio/x-flac',
+        'rate': info >> 44,
+        'channels': ((info >> 41) & 0x7) + 1,
+        'sample_width': ((info >> 36) & 0x1f) + 1,
+    }
+
+
+def sniff_ogg(data):
+    if data[:4] != b'OggS' or len(data) < 27:
+        return None
+    # the first page holds the identification header of the codec
+    segments = data[26]
+    packet = data[27 + segments:]
+    if packet[:7] == b'\x01vorbis' and len(packet) >= 16:
+        channels, rate = struct.unpack('<BI', packet[11:16])
+        return {
+            'mime_type': 'audio/x-vorbis',
+            'channels': channels,
+            'rate': rate,
+        }
+    if packet[:8] == b'OpusHead' and len(packet) >= 16:
+        channels = packet[9]
+        rate, = struct.unpack('<I', packet[12:16])
+        return {
+            'mime_type': 'audio/ogg; codecs=opus',
+            'channels': channels,
+            'rate': rate,
+        }
+    return None
+
+
+mp3_rates = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000),
+             0: (11025, 12000, 8000)}
+# layer III bitrates in kbit/s, of MPEG 1 and of MPEG 2 and 2.5
+mp3_bitrates = {
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+
+def skip_id3(data):
+    """Return the offset of the first byte after the ID3v2 tag."""
+    if data[:3] != b'ID3' or len(data) < 10:
+        return 0
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7f)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def sniff_mp3(data):
+    offset = skip_id3(data)
+    if offset + 4 > len(data):
+        return None
+    header, = struct.unpack('>I', data[offset:offset + 4])
+    if header >> 21 != 0x7ff:
+        return None
+    version = (header >> 19) & 3
+    layer = (header >> 17) & 3
+    rate_index = (header >> 10) & 3
+    if version == 1 or layer != 1 or rate_index == 3:
+        # reserved version, or not layer III
+        return None
+    channels = 1 if (header >> 6) & 3 == 3 else 2
+    rate = mp3_rates[version][rate_index]
+
+    bitrate_index = (header >> 12) & 0xf
+    if bitrate_index == 15:
+        return None
+    # 0 for the free format
+    bitrate = mp3_bitrates[3 if version == 3 else 2][bitrate_index]
+    if not offset and bitrate:
+        # without an ID3 tag, make sure this is not a random 0xfff by
+        # finding the next frame
+        size = (144 if version == 3 else 72) * bitrate * 1000 // rate
+        size += (header >> 9) & 1
+        next_frame = data[size:size + 2]
+        if len(next_frame) == 2 and (next_frame[0] != 0xff or
+                                     next_frame[1] & 0xe0 != 0xe0):
+            return None
+
+    # the Xing or Info header follows the side information
+    if version == 3:
+        side_info = 17 if channels == 1 else 32
+    else:
+        side_info = 9 if channels == 1 else 17
+    xing = offset + 4 + side_info
+    mode = 'cbr'
+    if data[xing:xing + 4] == b'Xing':
+        mode = 'vbr'
+        flags, = struct.unpack('>I', data[xing + 4:xing + 8] or b'\0' * 4)
+        lame = xing + 8 + 4 * bool(flags & 1) + 4 * bool(flags & 2) + \
+            100 * bool(flags & 4) + 4 * bool(flags & 8)
+        # the low bits of the LAME tag revision byte give the VBR method
+        if data[lame:lame + 4] == b'LAME' and len(data) > lame + 9:
+            if data[lame + 9] & 0xf in (2, 9):
+                mode = 'abr'
+    elif data[offset + 36:offset + 40] == b'VBRI':
+        mode = 'vbr'
+
+    return {
+        'mime_type': 'audio/mpeg',
+        'channels': channels,
+        'rate': rate,
+        'mp3_mode': mode,
+        # of the first frame, which is the bitrate of a CBR file
+        'bitrate': bitrate or None,
+    }
+
+
+sniffers = (sniff_wav, sniff_flac, sniff_ogg, sniff_mp3)
+
+
+def sniff(data):
+    """Return the format of a file starting with data, None if unknown."""
+    for sniffer in sniffers:
+        try:
+            found = sniffer(data)
+        except (struct.error, IndexError):
+            found = None
+        if found:
+            return found
+    return None
+
+
+def sniff_file(uri):
+    """Return the format of the file at uri, None if unknown.
+
+    Embedded covers often make the ID3v2 tag of an MP3 file larger than
+    header_size, then the header is read again from the end of the tag."""
+    data = read_header(uri)
+    offset = skip_id3(data)
+    if offset and len(data) == header_size and \
+            offset + header_size // 2 > len(data):
+        data = read_header(uri, header_size, offset)
+    return sniff(data)
+
+
+# the MIME types found by GStreamer typefinding for the formats of sniff()
+container_types = {
+    'audio/x-wav': 'audio/x-wav',
+    'audio/x-flac': 'audio/x-flac',
+    'audio/x-vorbis': 'application/ogg',
+    'audio/ogg; codecs=opus': 'application/ogg',
+    'audio/mpeg': 'audio/mpeg',
+}
+
+# other file types recognized by their first bytes
+magic_types = (
+    (0, b'OggS', 'application/ogg'),
+    (0, b'ID3', 'application/x-id3'),
+    (0, b'MAC ', 'application/x-ape'),
+    (0, b'.snd', 'audio/x-au'),
+    (0, b'FORM', 'audio/x-aiff'),
+    (0, b'#!AMR', 'audio/AMR'),
+    (0, b'\x30\x26\xb2\x75\x8e\x66\xcf\x11', 'video/x-ms-asf'),
+    (0, b'\x1a\x45\xdf\xa3', 'video/x-matroska'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'\x89PNG', 'image/png'),
+    (0, b'GIF8', 'image/gif'),
+    (0, b'%PDF', 'application/pdf'),
+    (0, b'PK\x03\x04', 'application/zip'),
+)
+
+m4a_brands = (b'M4A ', b'M4B ', b'M4P ')
+
+
+def classify(data):
+    """Return the MIME type of a file starting with data, like GStreamer
+    typefinding would, None if unknown."""
+    found = sniff(data)
+    if found:
+        return container_types[found['mime_type']]
+    if data[4:8] == b'ftyp':
+        if data[8:12] in m4a_brands:
+            return 'audio/x-m4a'
+        return 'video/quicktime'
+    if data[:4] == b'RIFF':
+        if data[8:12] == b'AVI ':
+            return 'video/x-msvideo'
+        return None
+    for offset, magic, mime_type in magic_types:
+        if data[offset:offset + len(magic)] == magic:
+            return mime_type
+    return None
@@ -35,8 +35,12 @@ from gi.repository import GLib
 
 from soundconverter.fileoperations import filename_to_uri, beautify_uri
 from soundconverter.fileoperations import unquote_filename, vfs_walk, vfs_exists
+from soundconverter.fileoperations import AsyncWalker
 from soundconverter.gstreamer import ConverterQueue
-from soundconverter.gstreamer import available_elements, TypeFinder, TagReader
+from soundconverter.gstreamer import available_elements, Prober
+from soundconverter.gstreamer import is_accepted_type, is_blacklisted
+from soundconverter.sniffer import classify, read_header
+from soundconverter.cache import metadata_cache
 from soundconverter.gstreamer import audio_profiles_list, audio_profiles_dict
 from soundconverter.soundfile import SoundFile
 from soundconverter.settings import locale_patterns_dict, custom_patterns, filepattern, settings
@@ -125,6 +129,10 @@ class FileList:
         self.window = window
         self.typefinders = TaskQueue()
         self.filelist = set()
+        # uris of the files being added which can be converted
+        self.accepted = set()
+        # the type found for each extension of the files which were probed
+        self.extensions = {}
 
         self.model = Gtk.ListStore(*MODEL)
 
@@ -169,6 +177,8 @@ class FileList:
 
         self.waiting_files = []
         self.waiting_files_last = 0
+        self.adding = False
+        self.walkers = []
 
     def drag_data_received(self, widget, context, x, y, selection,
                              mime_id, time):
@@ -197,6 +207,7 @@ class FileList:
     def add_uris(self, uris, base=None, extensions=None):
         start_t = time.time()
         files = []
+        extensions = tuple(extensions or ())
         self.window.set_status(_('Scanning files...'))
         self.window.progressbarstatus.show()
         self.files_to_add = 0
@@ -217,20 +228,21 @@ class FileList:
                     # if only one folder is passed to the function,
                     # use its parent as base path.
                     base = os.path.dirname(uri)
-                filelist = vfs_walk(uri)
-                accepted = []
-                if extensions:
-                    for f in filelist:
-                        for extension in extensions:
-                            if f.lower().endswith(extension):
-                                accepted.append(f)
-                    filelist = accepted
-                files.extend(filelist)
+                if not uri.startswith('file://'):
+                    # remote folders are listed in the background, their
+                    # files are added as they are found
+                    self.walk_async(uri, base or os.path.dirname(uri),
+                                    extensions)
+                    continue
+                for i, f in enumerate(vfs_walk(uri)):
+                    if not i % 1000:
+                        gtk_iteration()
+                    if extensions and not f.lower().endswith(extensions):
+                        continue
+                    files.append(f)
             else:
                 files.append(uri)
 
-        files = [f for f in files if not f.endswith('~SC~')]
-
         if not base:
             base = os.path.commonprefix(files)
             if base and not base.endswith('/'):
@@ -241,19 +253,65 @@ class FileList:
             base += '/'
 
         scan_t = time.time()
-        log('analysing file extensions')
+        self.add_files(files, base)
+        end_t = time.time()
+        debug('Added %d files in %.2fs (scan %.2fs, add %.2fs)' % (
+            len(files), end_t - start_t, scan_t - start_t, end_t-scan_t))
+
+    def walk_async(self, uri, base, extensions):
+        """List the folder at uri in the background, adding its files with
+        base as their base path."""
+        def found_files(files):
+            if extensions:
+                files = [f for f in files if f.lower().endswith(extensions)]
+            self.add_files(files, base + '/')
+
+        def walked():
+            log('walked: \'%s\'' % uri)
+            self.walkers.remove(walker)
+
+        walker = AsyncWalker(found_files, walked)
+        self.walkers.append(walker)
+        walker.start([uri])
+
+    def add_files(self, files, base):
+        """Add the sound files among files, with base as their base path.
+        The files given while others are added wait for them."""
+        if self.adding:
+            self.waiting_files.append((files, base))
+            return
+        self.adding = True
+        self.window.progressbarstatus.show()
+        if self.files_to_add is None:
+            GLib.timeout_add(100, self.update_progress)
+
+        files = [f for f in files if not f.endswith('~SC~')]
+        log('analysing file types')
         self.files_to_add = len(files)
         self.window.set_status(_('Adding Files...'))
-        
+
+        # the type of local files is found from their first bytes, for the
+        # others one file of each extension is probed
+        self.accepted = set()
         self.extensions = {}
-        extensions = {}
-        for f in files:
-            extensions[os.path.splitext(f)[1]] = f
-        for ext, filename in extensions.items():
-            sound_file = SoundFile(filename, base)
-            typefinder = TypeFinder(sound_file)
-            typefinder.set_found_type_hook(self.found_type)
-            self.typefinders.add_task(typefinder)
+        unknown = {}
+        for i, f in enumerate(files):
+            if not i % 100:
+                gtk_iteration()
+            mime_type = None
+            if f.startswith('file://'):
+                mime_type = classify(read_header(f))
+            if mime_type is None:
+                unknown.setdefault(os.path.splitext(f)[1], []).append(f)
+            elif is_accepted_type(mime_type) and not is_blacklisted(f):
+                self.accepted.add(f)
+            else:
+                log('mime type skipped: %s' % mime_type)
+        for ext, uris in unknown.items():
+            prober = Prober(SoundFile(uris[0], base))
+            prober.set_found_type_hook(self.found_type)
+            self.typefinders.add_task(prober)
+        log('%d file extensions to probe' % len(unknown))
 
         self.typefinders.queue_ended = self.typefinder_queue_ended
         self.typefinders.start()
@@ -262,30 +320,40 @@ class FileList:
             gtk_iteration()
             time.sleep(0.1)
 
-        log('adding: %d files' % len(files))
+        for ext in self.extensions:
+            self.accepted.update(f for f in unknown[ext]
+                                 if not is_blacklisted(f))
+
+        log('adding: %d files' % len(self.accepted))
         for f in files:
-            ext = os.path.splitext(f)[1]
-            if ext not in self.extensions:
+            if f not in self.accepted:
                 continue
             sound_file = SoundFile(f, base)
             if sound_file.uri in self.filelist:
                 log('file already present: \'%s\'' % sound_file.uri)
                 continue
             self.append_file(sound_file)
+            if self.window.converter.running:
+                # files added to a running batch are converted first
+                self.window.converter.add(sound_file, priority=1)
 
+        self.adding = False
+        if self.waiting_files:
+            GLib.idle_add(self.add_files, *self.waiting_files.pop(0))
+            return
         self.window.set_status()
         self.window.progressbarstatus.hide()
         self.files_to_add = None
-        end_t = time.time()
-        debug('Added %d files in %.2fs (scan %.2fs, add %.2fs)' % (
-            len(files), end_t - start_t, scan_t - start_t, end_t-scan_t))
 
     def typefinder_queue_ended(self):
+        metadata_cache.commit()
         if not self.waiting_files:
             self.window.set_status()
             self.window.progressbarstatus.hide()
 
     def abort(self):
+        for walker in self.walkers:
+            walker.cancel()
         self.typefinders.abort()
 
     def format_cell(self, sound_file):
@@ -658,8 +726,9 @@ class PreferencesDialog(GladeWindow):
                     self.get_bitrate_from_settings())
         self.aprox_bitrate.set_markup(markup)
 
-    def get_output_suffix(self):
-        output_type = self.settings.get_string('output-mime-type')
+    def get_output_suffix(self, output_type=None):
+        if output_type is None:
+            output_type = self.settings.get_string('output-mime-type')
         profile = self.settings.get_string('audio-profile')
         profile_ext = audio_profiles_dict[profile][1] if profile else ''
         output_suffix = {
@@ -675,9 +744,10 @@ class PreferencesDialog(GladeWindow):
             output_suffix = '.oga'
         return output_suffix
 
-    def generate_filename(self, sound_file, for_display=False):
+    def generate_filename(self, sound_file, for_display=False,
+                          output_type=None):
         generator = TargetNameGenerator()
-        generator.suffix = self.get_output_suffix()
+        generator.suffix = self.get_output_suffix(output_type)
 
         if not self.settings.get_boolean('same-folder-as-input'):
             folder = self.settings.get_string('selected-folder')
@@ -1073,9 +1143,9 @@ class SoundConverterWindow(GladeWindow):
 
     sensitive_names = ['remove', 'clearlist',
                        'toolbutton_clearlist', 'convert_button']
+    # files can still be added, and dropped on the list, while converting
     unsensitive_when_converting = ['remove', 'clearlist', 'prefs_button',
-            'toolbutton_addfile', 'toolbutton_addfolder', 'convert_button',
-            'toolbutton_clearlist', 'filelist', 'menubar']
+            'convert_button', 'toolbutton_clearlist', 'menubar']
 
     def __init__(self, builder):
         self.paused_time = 0
@@ -1262,11 +1332,17 @@ class SoundConverterWindow(GladeWindow):
         self.progressbar.set_text(_('Preparing conversion...'))
         files = self.filelist.get_files()
         total = len(files)
-        for i, sound_file in enumerate(files):
-            gtk_iteration()
-            self.pulse_progress = i/total  # TODO: still needed?
-            sound_file.progress = None
-            self.converter.add(sound_file)
+        if settings['streaming']:
+            # the converters are created as the conversions start
+            for sound_file in files:
+                sound_file.progress = None
+            self.converter.add_lazily(files)
+        else:
+            for i, sound_file in enumerate(files):
+                gtk_iteration()
+                self.pulse_progress = i/total  # TODO: still needed?
+                sound_file.progress = None
+                self.converter.add(sound_file)
         # all was OK
         self.set_status()
         self.pulse_progress = None
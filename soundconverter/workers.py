@@ -0,0 +1,385 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# SoundConverter - GNOME application for converting between audio formats.
+# Copyright 2004 Lars Wirzenius
+# Copyright 2005-2017 Gautier Portet
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""
+Conversions in worker processes.
+
+Each worker is a python process running its own GLib main loop and
+converters, so a crashing decoder only takes one conversion down with it,
+and the bus messages of the pipelines are not all dispatched by the main
+process. The main process and a worker exchange one JSON object per line
+on the stdin and stdout of the worker.
+"""
+
+import os
+import sys
+import json
+import signal
+import hashlib
+import subprocess
+from gettext import gettext as _
+
+import gi
+from gi.repository import GLib
+
+from soundconverter.task import BackgroundTask
+from soundconverter.settings import settings
+from soundconverter.utils import log, debug
+
+# Converter attributes sent to the worker
+converter_options = (
+    'output_filename',
+    'output_type',
+    'outputs',
+    'vorbis_quality',
+    'aac_quality',
+    'opus_quality',
+    'mp3_mode',
+    'mp3_quality',
+    'flac_compression',
+    'wav_sample_width',
+    'audio_profile',
+    'output_resample',
+    'resample_rate',
+    'force_mono',
+    'passthrough',
+    'trim_pipeline',
+    'encoder_queue',
+    'overwrite',
+    'delete_original',
+)
+
+
+# Converter attributes which do not change the audio of the output files
+unhashed_options = (
+    'output_filename',
+    'outputs',
+    'trim_pipeline',
+    'encoder_queue',
+    'overwrite',
+    'delete_original',
+)
+
+
+def get_settings_hash(converter):
+    """Return a hash of the options of a Converter which change its output
+    files."""
+    options = dict((name, getattr(converter, name, None))
+                   for name in converter_options
+                   if name not in unhashed_options)
+    # the output formats, without the (temporary) filenames
+    options['outputs'] = [output_type for output_filename, output_type
+                          in converter.outputs]
+    options = json.dumps(options, sort_keys=True)
+    return hashlib.sha1(options.encode('utf-8')).hexdigest()
+
+
+class LineReader:
+    """Call a callback with each JSON object read from a file descriptor,
+    from the main loop."""
+
+    def __init__(self, fd, on_message, on_eof):
+        self.fd = fd
+        self.on_message = on_message
+        self.on_eof = on_eof
+        self.buffer = b''
+        self.watch_id = GLib.io_add_watch(fd, GLib.PRIORITY_DEFAULT,
+            GLib.IOCondition.IN | GLib.IOCondition.HUP, self.on_input)
+
+    def on_input(self, fd, condition):
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            data = b''
+        if not data:
+            self.on_eof()
+            return False
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b'\n')
+        for line in lines:
+            if line:
+                self.on_message(json.loads(line.decode('utf-8')))
+        return True
+
+    def stop(self):
+        GLib.source_remove(self.watch_id)
+
+
+class Worker:
+    """A worker process, as seen from the main process."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.task = None
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [root] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'soundconverter.workers'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        self.reader = LineReader(self.process.stdout.fileno(),
+                                 self.on_message, self.on_eof)
+        self.send({'settings': settings})
+        debug('worker %d started' % self.process.pid)
+
+    def send(self, message):
+        try:
+            self.process.stdin.write(json.dumps(message).encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+        except (IOError, ValueError):
+            # the worker is gone, on_eof() will take care of it
+            pass
+
+    def convert(self, task):
+        self.task = task
+        self.send({'convert': task.job})
+
+    def on_message(self, message):
+        task = self.task
+        if task is None:
+            return
+        if 'finished' in message:
+            self.task = None
+            self.pool.worker_idle(self)
+        task.on_worker_message(message)
+
+    def on_eof(self):
+        status = self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+        task = self.task
+        self.task = None
+        self.pool.worker_exited(self)
+        if task:
+            if status < 0:
+                reason = _('worker process crashed (signal %d)') % -status
+            else:
+                reason = _('worker process exited (status %d)') % status
+            task.on_worker_message({'finished': True, 'error': reason})
+
+    def stop(self, kill=False):
+        self.reader.stop()
+        self.process.stdin.close()
+        if kill:
+            self.process.kill()
+        else:
+            self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+class WorkerPool:
+    """Worker processes running conversions for a queue, started when no
+    idle one is left."""
+
+    def __init__(self):
+        self.idle = []
+        self.busy = set()
+
+    def start_worker(self):
+        return Worker(self)
+
+    def submit(self, task):
+        worker = self.idle.pop() if self.idle else self.start_worker()
+        self.busy.add(worker)
+        worker.convert(task)
+        return worker
+
+    def worker_idle(self, worker):
+        self.busy.discard(worker)
+        self.idle.append(worker)
+
+    def worker_exited(self, worker):
+        log('worker %d exited' % worker.process.pid)
+        self.busy.discard(worker)
+        if worker in self.idle:
+            self.idle.remove(worker)
+
+    def kill(self, worker):
+        """Stop a worker which is stuck. The next task starts a new one."""
+        log('killing worker %d' % worker.process.pid)
+        worker.stop(kill=True)
+        self.busy.discard(worker)
+
+    def stop(self):
+        for worker in self.idle + list(self.busy):
+            worker.stop()
+        self.idle = []
+        self.busy = set()
+
+
+class WorkerTask(BackgroundTask):
+    """A background task running a Converter in a worker process.
+
+    It can be used in place of the Converter in a queue."""
+
+    def __init__(self, converter, pool):
+        BackgroundTask.__init__(self)
+        self.pool = pool
+        self.worker = None
+        self.sound_file = converter.sound_file
+        self.output_filename = converter.output_filename
+        self.outputs = converter.outputs
+        self.settings_hash = get_settings_hash(converter)
+        self.error = None
+        self.processing = False
+        self.position = 0
+        self.job = {
+            'uri': self.sound_file.uri,
+            'base_path': self.sound_file.base_path,
+            'options': dict((name, getattr(converter, name))
+                            for name in converter_options
+                            if hasattr(converter, name)),
+        }
+
+    def started(self):
+        self.worker = self.pool.submit(self)
+
+    def on_worker_message(self, message):
+        if 'duration' in message and message['duration']:
+            self.sound_file.duration = message['duration']
+        if 'position' in message:
+            self.position = message['position']
+        if 'tags' in message:
+            self.sound_file.tags.update(message['tags'])
+        if 'finished' in message:
+            self.worker = None
+            self.error = message.get('error')
+            self.processing = message.get('processing', False)
+            self.done()
+
+    def finished(self):
+        if self.worker:
+            # ended before the worker was done, e.g. by the Watchdog
+            self.pool.kill(self.worker)
+            self.worker = None
+
+    def toggle_pause(self, paused):
+        if self.worker:
+            self.worker.send({'pause': paused})
+
+    def abort(self):
+        if self.worker:
+            self.worker.send({'abort': True})
+        BackgroundTask.abort(self)
+
+    def get_duration(self):
+        return self.sound_file.duration
+
+    def get_position(self):
+        return self.position
+
+    def get_settings_hash(self):
+        return self.settings_hash
+
+
+class WorkerErrorPrinter:
+    """Error handler of the workers: the error is reported to the main
+    process with the result of the conversion, so just print it."""
+
+    def show_error(self, primary, secondary):
+        sys.stderr.write('\n\nError: %s\n%s\n' % (primary, secondary))
+
+
+class WorkerMain:
+    """The main loop of a worker process."""
+
+    def __init__(self, output):
+        from soundconverter import error
+        error.set_error_handler(WorkerErrorPrinter())
+        self.output = output
+        self.converter = None
+        self.loop = GLib.MainLoop()
+        self.reader = LineReader(sys.stdin.fileno(), self.on_message,
+                                 self.loop.quit)
+        GLib.timeout_add(500, self.send_progress)
+
+    def send(self, message):
+        self.output.write(json.dumps(message) + '\n')
+        self.output.flush()
+
+    def on_message(self, message):
+        if 'settings' in message:
+            settings.update(message['settings'])
+        if 'convert' in message:
+            self.convert(message['convert'])
+        if 'pause' in message and self.converter:
+            self.converter.toggle_pause(message['pause'])
+        if 'abort' in message and self.converter:
+            self.converter.abort()
+            self.converter = None
+            self.send({'finished': True, 'error': 'aborted'})
+
+    def convert(self, job):
+        from soundconverter.soundfile import SoundFile
+        from soundconverter.gstreamer import Converter
+        options = job['options']
+        sound_file = SoundFile(job['uri'], job['base_path'])
+        c = Converter(sound_file, options['output_filename'],
+                      options['output_type'])
+        for name, value in options.items():
+            setattr(c, name, value)
+        c.init()
+        c.add_listener('finished', self.converter_finished)
+        self.converter = c
+        c.start()
+
+    def send_progress(self):
+        if self.converter and self.converter.running:
+            self.send({
+                'position': self.converter.get_position(),
+                'duration': self.converter.get_duration(),
+            })
+        return True
+
+    def converter_finished(self, converter):
+        if converter is not self.converter:
+            return
+        self.converter = None
+        self.send({
+            'finished': True,
+            'error': str(converter.error) if converter.error else None,
+            'processing': converter.processing,
+            'duration': converter.get_duration(),
+            'tags': converter.sound_file.tags,
+        })
+
+    def run(self):
+        self.loop.run()
+
+
+def worker_main():
+    # keep stdout for the messages to the main process, everything else
+    # printed by the worker goes to stderr.
+    output = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    gi.require_version('Gst', '1.0')
+    gi.require_version('Gtk', '3.0')
+    from gi.repository import Gst
+    Gst.init(None)
+    WorkerMain(output).run()
+
+
+if __name__ == '__main__':
+    worker_main()
@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Benchmarks, not run by `make test`.
+# usage: PYTHONPATH=. python3 tests/benchmarks.py [name...]
+
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('Gtk', '3.0')
+from gi.repository import GLib, Gio, Gst
+Gst.init(None)
+
+from soundconverter.queue import TaskQueue
+from soundconverter.task import BackgroundTask
+from soundconverter.settings import settings
+from soundconverter.soundfile import SoundFile
+from soundconverter.fileoperations import filename_to_uri, vfs_walk, gio_walk
+from soundconverter.sniffer import classify, read_header
+from soundconverter.gstreamer import Converter, pipeline_pool, bus_dispatcher
+
+
+class NoopTask(BackgroundTask):
+    """A task that finishes as soon as it starts."""
+
+    def started(self):
+        self.done()
+
+
+def run_queue(queue):
+    loop = GLib.MainLoop()
+    queue.queue_ended = loop.quit
+    queue.start()
+    loop.run()
+
+
+def benchmark_queue():
+    """TaskQueue overhead per task should not grow with the queue size."""
+    for count in (1000, 10000, 100000, 200000):
+        queue = TaskQueue()
+        queue.jobs = 32
+        start = time.time()
+        queue.add_tasks(NoopTask() for i in range(count))
+        run_queue(queue)
+        duration = time.time() - start
+        print('%7d tasks: %.2fs, %.1fus per task' % (
+            count, duration, duration / count * 1000000))
+
+
+class BigTask(NoopTask):
+    """A task holding as much memory as a converter, roughly."""
+
+    def __init__(self):
+        NoopTask.__init__(self)
+        self.data = bytearray(10000)
+
+
+def benchmark_stream():
+    """Memory used by a queue of tasks created before it starts, and by a
+    queue taking them from a task source."""
+    count = 100000
+    for lazily in (False, True):
+        tracemalloc.start()
+        queue = TaskQueue()
+        queue.jobs = 32
+        start = time.time()
+        tasks = (BigTask() for i in range(count))
+        if lazily:
+            queue.add_task_source(tasks, count)
+        else:
+            queue.add_tasks(tasks)
+        run_queue(queue)
+        duration = time.time() - start
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('%d tasks, task source=%s: %.2fs, peak memory %.1f MB' % (
+            count, lazily, duration, peak / 1000000))
+
+
+def make_test_files(folder, count, seconds=1, suffix='.wav',
+                    encoder='wavenc'):
+    """Create count files of seconds of noise in folder."""
+    files = []
+    buffers = int(seconds * 44100 / 1024) + 1
+    for i in range(count):
+        filename = os.path.join(folder, '%05d%s' % (i, suffix))
+        pipeline = Gst.parse_launch(
+            'audiotestsrc wave=white-noise num-buffers=%d samplesperbuffer=1024 '
+            '! audio/x-raw,rate=44100,channels=2,format=S16LE ! %s '
+            '! filesink location="%s"' % (buffers, encoder, filename))
+        pipeline.set_state(Gst.State.PLAYING)
+        pipeline.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+            Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        pipeline.set_state(Gst.State.NULL)
+        files.append(filename_to_uri(filename))
+    return files
+
+
+def convert(uris, output_type, suffix, jobs=None, **attributes):
+    """Convert uris, setting attributes on each Converter. Return the
+    duration of the conversions."""
+    queue = TaskQueue()
+    queue.jobs = jobs or queue.jobs
+    for uri in uris:
+        c = Converter(SoundFile(uri), uri + suffix, output_type)
+        c.overwrite = True
+        for name, value in attributes.items():
+            setattr(c, name, value)
+        c.init()
+        queue.add_task(c)
+    start = time.time()
+    run_queue(queue)
+    return time.time() - start
+
+
+def benchmark_pipelines():
+    """Converting many one second files, with and without reusing the
+    pipelines."""
+    count = 10000
+    settings['quiet'] = True
+    with tempfile.TemporaryDirectory() as folder:
+        uris = make_test_files(folder, count)
+        for reuse in (False, True):
+            settings['reuse-pipelines'] = reuse
+            duration = convert(uris, 'audio/x-flac', '.flac')
+            pipeline_pool.clear()
+            print('%d one second files, reuse-pipelines=%s: %.2fs, '
+                  '%.2fms per file' % (count, reuse, duration,
+                                       duration / count * 1000))
+
+
+def benchmark_chain():
+    """Converting 44.1 kHz 16 bit FLAC to WAV, with the full
+    audiorate ! audioconvert ! audioresample chain and with only the
+    conversions the input needs."""
+    count = 200
+    settings['quiet'] = True
+    with tempfile.TemporaryDirectory() as folder:
+        uris = make_test_files(folder, count, seconds=30, suffix='.flac',
+                               encoder='flacenc')
+        for trim in (False, True):
+            duration = convert(uris, 'audio/x-wav', '.wav',
+                               trim_pipeline=trim)
+            print('%d 30 second files, trim_pipeline=%s: %.2fs, '
+                  '%.1fx realtime' % (count, trim, duration,
+                                      count * 30 / duration))
+
+
+def benchmark_bus():
+    """Main loop load with 64 concurrent jobs: bus messages posted by the
+    pipelines, and those dispatched from the main loop."""
+    count = 256
+    settings['quiet'] = True
+    with tempfile.TemporaryDirectory() as folder:
+        uris = make_test_files(folder, count, seconds=10)
+        start_cpu = time.process_time()
+        duration = convert(uris, 'audio/x-flac', '.flac', jobs=64)
+        cpu = time.process_time() - start_cpu
+        print('%d files, 64 jobs: %.2fs, %.2fs of CPU in the process' % (
+            count, duration, cpu))
+        print('%d messages, %d dispatched in %d main loop calls' % (
+            bus_dispatcher.seen, bus_dispatcher.forwarded,
+            bus_dispatcher.batches))
+
+
+def benchmark_sniff():
+    """Finding the type of files from their first bytes."""
+    count = 2000
+    with tempfile.TemporaryDirectory() as folder:
+        uris = make_test_files(folder, count, seconds=0.1)
+        start = time.time()
+        types = [classify(read_header(uri)) for uri in uris]
+        duration = time.time() - start
+        print('%d files classified in %.2fs, %d files per second' % (
+            count, duration, count / duration))
+        assert types == ['audio/x-wav'] * count
+
+
+def recursive_walk(uri):
+    """The previous vfs_walk, reading all the attributes of each file and
+    its type again."""
+    filelist = []
+    dirlist = Gio.file_parse_name(uri).enumerate_children(
+        '*', Gio.FileQueryInfoFlags.NONE, None)
+    for file_info in dirlist:
+        child = dirlist.get_child(file_info)
+        info = child.query_file_type(Gio.FileQueryInfoFlags.NONE, None)
+        if info == Gio.FileType.DIRECTORY:
+            filelist.extend(recursive_walk(child.get_uri()))
+        if info == Gio.FileType.REGULAR:
+            filelist.append(str(child.get_uri()))
+    return filelist
+
+
+def benchmark_walk():
+    """Listing a local tree of 300 folders of 1000 empty files."""
+    with tempfile.TemporaryDirectory() as folder:
+        for i in range(300):
+            subfolder = os.path.join(folder, 'artist %d' % i, 'album')
+            os.makedirs(subfolder)
+            for j in range(1000):
+                open(os.path.join(subfolder, '%03d track #%d.flac' % (j, j)),
+                     'w').close()
+        uri = filename_to_uri(folder)
+        expected = None
+        for name, walk in (('recursive Gio', recursive_walk),
+                           ('Gio', gio_walk), ('scandir', vfs_walk)):
+            start = time.time()
+            uris = sorted(walk(uri))
+            duration = time.time() - start
+            print('%s: %d files in %.2fs' % (name, len(uris), duration))
+            expected = expected or uris
+            assert uris == expected
+
+
+benchmarks = {
+    'walk': benchmark_walk,
+    'stream': benchmark_stream,
+    'sniff': benchmark_sniff,
+    'bus': benchmark_bus,
+    'chain': benchmark_chain,
+    'queue': benchmark_queue,
+    'pipelines': benchmark_pipelines,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(benchmarks):
+        print('%s:' % name)
+        benchmarks[name]()
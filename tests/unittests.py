@@ -1,14 +1,41 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import io
+import os
+import struct
+import tempfile
+import time
 import unittest
 from urllib.parse import unquote
+from gi.repository import Gio, GLib, Gst, GstPbutils
 import urllib.request, urllib.parse, urllib.error
 from soundconverter import *
 
 from soundconverter.namegenerator import TargetNameGenerator
 from soundconverter.soundfile import SoundFile
-from soundconverter.fileoperations import filename_to_uri
+from soundconverter.fileoperations import filename_to_uri, vfs_walk, gio_walk
+from soundconverter.fileoperations import AsyncWalker
+from soundconverter.queue import TaskQueue, Watchdog, estimate_makespan
+from soundconverter.queue import JobsController
+import soundconverter.queue
+from soundconverter.task import BackgroundTask
+from soundconverter.cache import MetadataCache
+from soundconverter.gstreamer import Converter, plan_wav, can_split
+from soundconverter.gstreamer import Pipeline, PipelinePool, pipeline_pool
+from soundconverter.gstreamer import Decoder
+from soundconverter.gstreamer import BusDispatcher
+from soundconverter.gstreamer import Prober, DiscovererPool, discoverer_pool
+from soundconverter.settings import settings
+from soundconverter.gstreamer import is_up_to_date, record_outputs
+import soundconverter.gstreamer
+import soundconverter.manifest
+from soundconverter.journal import Journal
+from soundconverter.workers import Worker, WorkerPool, WorkerTask
+from soundconverter.manifest import guess_format, readers
+from soundconverter.sniffer import sniff, sniff_file, find_wav_data, classify
+from soundconverter.batch import iter_input_files
+import soundconverter.batch
 
 
 def quote(ss):
@@ -17,6 +44,294 @@ def quote(ss):
     return urllib.parse.quote(ss)
 
 
+class FakeTask(BackgroundTask):
+    def __init__(self, duration):
+        BackgroundTask.__init__(self)
+        self.duration = duration
+        self.position = 0
+        self.error = None
+
+    def get_position(self):
+        return self.position
+
+    def done(self):
+        self.running = False
+
+
+class FakeBus:
+    def __init__(self):
+        self.flushing = []
+        self.sync_handler = None
+
+    def set_flushing(self, flushing):
+        self.flushing.append(flushing)
+
+    def set_sync_handler(self, handler, *data):
+        self.sync_handler = handler
+
+
+class FakeElement:
+    def __init__(self):
+        self.properties = {}
+        self.handlers = {}
+
+    def set_property(self, name, value):
+        self.properties[name] = value
+
+    def connect(self, signal, callback):
+        self.handlers[len(self.handlers) + 1] = (signal, callback)
+        return len(self.handlers)
+
+    def disconnect(self, handler_id):
+        del self.handlers[handler_id]
+
+
+class FakePad:
+    def __init__(self):
+        self.probes = {}
+        self.probe_ids = 0
+        self.peer = None
+
+    def is_linked(self):
+        return self.peer is not None
+
+    def can_link(self, pad):
+        return True
+
+    def link(self, pad):
+        self.peer = pad
+
+    def add_probe(self, mask, callback):
+        self.probe_ids += 1
+        self.probes[self.probe_ids] = callback
+        return self.probe_ids
+
+    def remove_probe(self, probe_id):
+        del self.probes[probe_id]
+
+
+class FakePipeline:
+    def __init__(self):
+        self.states = []
+        self.bus = FakeBus()
+        self.elements = {}
+
+    def set_state(self, state):
+        self.states.append(state)
+
+    def get_bus(self):
+        return self.bus
+
+    def get_by_name(self, name):
+        return self.elements.setdefault(name, FakeElement())
+
+    def find_unlinked_pad(self, direction):
+        return FakePad()
+
+
+class FakeBuffer:
+    def __init__(self, pts, duration, size):
+        self.pts = pts
+        self.duration = duration
+        self.size = size
+
+    def get_size(self):
+        return self.size
+
+
+class FakeProbeInfo:
+    def __init__(self, buf):
+        self.buf = buf
+
+    def get_buffer(self):
+        return self.buf
+
+
+class FakeMessage:
+    def __init__(self, message_type):
+        self.type = message_type
+
+
+class MessageTask:
+    def __init__(self, message_types):
+        self.message_types = message_types
+        self.pipeline = FakePipeline()
+        self.messages = []
+
+    def on_message(self, bus, message):
+        self.messages.append(message)
+
+
+class FakeDiscoverer:
+    def __init__(self):
+        self.disconnected = []
+        self.stopped = False
+
+    def disconnect(self, handler_id):
+        self.disconnected.append(handler_id)
+
+    def stop(self):
+        self.stopped = True
+
+
+class FakeDiscovererInfo:
+    def __init__(self, uri, caps='audio/x-flac', audio=True, duration=0,
+                 result=None):
+        self.uri = uri
+        self.caps = caps
+        self.audio = audio
+        self.duration = duration
+        self.result = result or GstPbutils.DiscovererResult.OK
+
+    def get_uri(self):
+        return self.uri
+
+    def get_result(self):
+        return self.result
+
+    def get_stream_info(self):
+        return self
+
+    def get_caps(self):
+        return self
+
+    def to_string(self):
+        return self.caps
+
+    def get_audio_streams(self):
+        return [self] if self.audio else []
+
+    def get_duration(self):
+        return self.duration
+
+    def get_tags(self):
+        return None
+
+
+class FakeError:
+    def __init__(self, message):
+        self.message = message
+
+
+def make_converter(output_type, found, **attributes):
+    c = Converter(SoundFile('file:///in'), 'file:///out', output_type)
+    c.input_format = found
+    for name, value in attributes.items():
+        setattr(c, name, value)
+    return c
+
+
+flac_44k_stereo = {'mime_type': 'audio/x-flac', 'rate': 44100,
+                   'channels': 2, 'sample_width': 16}
+flac_44k_51 = dict(flac_44k_stereo, channels=6)
+vorbis_48k = {'mime_type': 'audio/x-vorbis', 'rate': 48000, 'channels': 2}
+wav_22k = {'mime_type': 'audio/x-wav', 'pcm': True, 'rate': 22050,
+           'channels': 2, 'sample_width': 16}
+mp3_vbr = {'mime_type': 'audio/mpeg', 'rate': 44100, 'channels': 2,
+           'mp3_mode': 'vbr', 'bitrate': 128}
+mp3_cbr_320 = dict(mp3_vbr, mp3_mode='cbr', bitrate=320)
+
+
+class FakeProcess:
+    def __init__(self, status):
+        self.pid = 1
+        self.status = status
+        self.stdin = io.BytesIO()
+        self.stdout = io.BytesIO()
+
+    def wait(self):
+        return self.status
+
+
+class FakeWorker(Worker):
+    def __init__(self, pool, status=0):
+        self.pool = pool
+        self.task = None
+        self.process = FakeProcess(status)
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+class FakeWorkerPool(WorkerPool):
+    def __init__(self):
+        WorkerPool.__init__(self)
+        self.started = []
+
+    def start_worker(self):
+        worker = FakeWorker(self)
+        self.started.append(worker)
+        return worker
+
+
+class FakeFilesCache(MetadataCache):
+    """A cache of the metadata of files which only exist in keys."""
+
+    def __init__(self):
+        MetadataCache.__init__(self, ':memory:')
+        # uri: (size, mtime)
+        self.keys = {}
+
+    def get_file_key(self, uri):
+        return self.keys.get(uri)
+
+
+class JournalTask:
+    def __init__(self, uri):
+        self.sound_file = SoundFile(uri)
+        self.outputs = [(uri + '~1~SC~', 'audio/x-flac')]
+
+    def get_settings_hash(self):
+        return 'abc'
+
+
+class FakeConverter(BackgroundTask):
+    """A conversion writing nothing, which fails for the files named
+    fail.*"""
+    def __init__(self, sound_file, output_filename, output_type):
+        BackgroundTask.__init__(self)
+        self.sound_file = sound_file
+        self.outputs = []
+        self.error = None
+
+    def add_output(self, output_filename, output_type):
+        pass
+
+    def init(self):
+        pass
+
+    def get_settings_hash(self):
+        return 'abc'
+
+    def get_position(self):
+        return 0
+
+    def get_duration(self):
+        return None
+
+    def started(self):
+        if os.path.basename(self.sound_file.uri).startswith('fail.'):
+            self.error = 'cannot convert'
+        self.done()
+
+
+class FakeMainLoop:
+    """A main loop giving up after a few seconds if quit() is not called."""
+    def __init__(self):
+        self.quit_called = False
+
+    def run(self):
+        context = GLib.MainContext.default()
+        deadline = time.time() + 5
+        while not self.quit_called and time.time() < deadline:
+            if not context.iteration(False):
+                time.sleep(0.001)
+
+    def quit(self):
+        self.quit_called = True
+
+
 class FilenameToUriTest(unittest.TestCase):
     def test(self):
         for i in (
@@ -32,6 +347,40 @@ class FilenameToUriTest(unittest.TestCase):
         self.assertEqual(filename_to_uri(r'''/foo/bar-"'@#%&$"€'''), r'''file:///foo/bar-"'@%23%&$"€''')
 
 
+class VfsWalkTest(unittest.TestCase):
+    def testWalk(self):
+        with tempfile.TemporaryDirectory() as folder:
+            names = ['a', "b c#d;e[f]!$&'()+,=@%", 'é/g.flac']
+            expected = []
+            for name in names:
+                filename = os.path.join(folder, 'sub', name)
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                open(filename, 'w').close()
+                expected.append(Gio.File.new_for_path(filename).get_uri())
+            uri = filename_to_uri(folder)
+            self.assertEqual(sorted(vfs_walk(uri)), sorted(expected))
+            self.assertEqual(sorted(gio_walk(uri)), sorted(expected))
+
+
+class AsyncWalkerTest(unittest.TestCase):
+    def testAsyncWalk(self):
+        with tempfile.TemporaryDirectory() as folder:
+            expected = []
+            for i in range(20):
+                filename = os.path.join(folder, str(i % 3), '%d.ogg' % i)
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                open(filename, 'w').close()
+                expected.append(filename_to_uri(filename))
+            found = []
+            loop = GLib.MainLoop()
+            walker = AsyncWalker(found.extend, loop.quit)
+            walker.max_folders = 2
+            walker.batch_size = 4
+            walker.start([filename_to_uri(folder)])
+            loop.run()
+            self.assertEqual(sorted(found), sorted(expected))
+
+
 class TargetNameGeneratorTestCases(unittest.TestCase):
     def setUp(self):
         self.g = TargetNameGenerator()
@@ -323,5 +672,1102 @@ class TargetNameGeneratorTestCases(unittest.TestCase):
                              quote("/path%'#/to/Foo%'#Bar/Hi%'#Ho.ogg"))
 
 
+class CliConvertTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = dict(settings)
+        settings['quiet'] = True
+        settings['cli-output-type'] = ['audio/x-vorbis']
+        settings['cli-output-suffix'] = ['.ogg']
+        self.converter = soundconverter.batch.Converter
+        soundconverter.batch.Converter = FakeConverter
+        self.main_loop = GLib.MainLoop
+        self.loops = []
+        GLib.MainLoop = self.make_loop
+
+    def tearDown(self):
+        settings.clear()
+        settings.update(self.settings)
+        soundconverter.batch.Converter = self.converter
+        GLib.MainLoop = self.main_loop
+
+    def make_loop(self):
+        loop = FakeMainLoop()
+        self.loops.append(loop)
+        return loop
+
+    def testQueueEnded(self):
+        soundconverter.batch.cli_convert_main(
+            ['file:///music/a.wav', 'file:///music/b.wav'])
+        self.assertEqual(len(self.loops), 1)
+        self.assertTrue(self.loops[0].quit_called)
+
+    def testFailure(self):
+        with self.assertRaises(SystemExit) as context:
+            soundconverter.batch.cli_convert_main(
+                ['file:///music/a.wav', 'file:///music/fail.wav'])
+        self.assertEqual(context.exception.code, 1)
+        self.assertTrue(self.loops[0].quit_called)
+
+
+class TaskQueueTest(unittest.TestCase):
+    def testAddTasks(self):
+        q = TaskQueue()
+        tasks = [FakeTask(i) for i in range(10)]
+        q.add_tasks(iter(tasks))
+        self.assertEqual(list(q.waiting_tasks), tasks)
+        self.assertFalse(q.running_tasks)
+
+
+class LongestFirstTest(unittest.TestCase):
+    def testMakespan(self):
+        self.assertEqual(estimate_makespan([], 4), 0)
+        self.assertEqual(estimate_makespan([1, 1, 1, 1], 4), 1)
+        self.assertEqual(estimate_makespan([1, 1, 1, 1], 2), 2)
+        self.assertEqual(estimate_makespan([1, 1, 1, 3], 2), 4)
+        self.assertEqual(estimate_makespan([3, 1, 1, 1], 2), 3)
+
+    def testLongestFirst(self):
+        q = TaskQueue()
+        q.jobs = 2
+        for duration in (1, None, 1, 1, 3):
+            q.add_task(FakeTask(duration))
+        q.sort_longest_first(lambda task: task.duration)
+        self.assertEqual([t.duration for t in q.waiting_tasks],
+                         [3, 1, 1, 1, None])
+        self.assertEqual(q.makespan, (4, 3))
+
+    def testLongestFirstKeepsPriorities(self):
+        q = TaskQueue()
+        short, long_ = FakeTask(1), FakeTask(10)
+        urgent = FakeTask(2)
+        q.add_tasks([short, long_])
+        q.add_task(urgent, priority=1)
+        q.sort_longest_first(lambda task: task.duration)
+        self.assertEqual(list(q.waiting_tasks), [urgent, long_, short])
+
+
+class PriorityTest(unittest.TestCase):
+    def testPriority(self):
+        q = TaskQueue()
+        tasks = [FakeTask(i) for i in range(5)]
+        q.add_tasks(tasks)
+        urgent = FakeTask(5)
+        q.add_task(urgent, priority=10)
+        self.assertEqual(list(q.waiting_tasks), [urgent] + tasks)
+        self.assertTrue(q.reprioritize(tasks[3], 20))
+        self.assertEqual(len(q.waiting_tasks), 6)
+        order = [q.waiting_tasks.popleft() for i in range(6)]
+        self.assertEqual(order, [tasks[3], urgent, tasks[0], tasks[1],
+                                 tasks[2], tasks[4]])
+        self.assertFalse(q.reprioritize(tasks[3], 0))
+        self.assertRaises(IndexError, q.waiting_tasks.popleft)
+
+
+class TaskSourceTest(unittest.TestCase):
+    def testTaskSource(self):
+        q = TaskQueue()
+        q.jobs = 2
+        built = []
+
+        def source():
+            for i in range(10):
+                built.append(i)
+                yield FakeTask(i) if i % 3 else None
+
+        q.add_task_source(source(), length=10)
+        self.assertEqual(built, [])
+        q.start_next_task()
+        self.assertEqual(len(q.running_tasks), 2)
+        self.assertEqual(len(q.waiting_tasks), 2)
+        self.assertEqual(len(built), 6)
+        self.assertEqual(q.get_sources_length(), 4)
+        q.task_finished(next(iter(q.running_tasks)))
+        self.assertEqual(len(q.running_tasks), 2)
+        self.assertEqual(len(q.waiting_tasks), 2)
+        self.assertEqual(len(built), 8)
+
+    def testFailingTaskSource(self):
+        q = TaskQueue()
+        q.jobs = 2
+        failures = []
+        q.source_failed = failures.append
+        ended = []
+        q.done = lambda: ended.append(True)
+
+        def source():
+            yield FakeTask(0)
+            raise PermissionError('cannot read')
+
+        q.add_task_source(source())
+        q.add_task_source([FakeTask(1)])
+        q.start_next_task()
+        # the other sources are still read
+        self.assertEqual(len(q.running_tasks), 2)
+        self.assertFalse(q.sources)
+        self.assertEqual(len(failures), 1)
+        self.assertIsInstance(q.source_errors[0], PermissionError)
+        for task in list(q.running_tasks):
+            q.task_finished(task)
+        self.assertEqual(ended, [True])
+
+
+class JobsControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.read_cpu_times = soundconverter.queue.read_cpu_times
+        # busy, iowait, total
+        self.cpu = [0, 0, 0]
+        soundconverter.queue.read_cpu_times = lambda: tuple(self.cpu)
+        self.queue = TaskQueue()
+        self.queue.running = True
+        self.queue.jobs = 4
+        self.tasks = [FakeTask(100) for i in range(4)]
+        self.queue.running_tasks.update(self.tasks)
+        self.queue.add_task(FakeTask(100))
+        self.controller = JobsController(self.queue)
+        self.controller.min_jobs = 2
+        self.controller.max_jobs = 4
+        self.controller.start()
+
+    def tearDown(self):
+        self.controller.stop()
+        soundconverter.queue.read_cpu_times = self.read_cpu_times
+
+    def sample(self, busy, iowait, advance):
+        self.cpu = [self.cpu[0] + busy, self.cpu[1] + iowait,
+                    self.cpu[2] + 100]
+        for task in self.tasks:
+            task.position += advance
+        self.controller.last_time -= self.controller.interval
+        self.controller.update()
+
+    def testIowait(self):
+        self.sample(30, 50, 10)
+        self.assertEqual(self.queue.jobs, 3)
+        self.sample(30, 50, 10)
+        self.sample(30, 50, 10)
+        self.assertEqual(self.queue.jobs, 2)
+
+    def testStop(self):
+        self.queue.jobs_controller = self.controller
+        self.sample(30, 50, 10)
+        self.assertEqual(self.queue.jobs, 3)
+        source_id = self.controller.source_id
+        self.assertTrue(source_id)
+        # starting again removes the timeout of the last run
+        self.controller.start()
+        self.assertNotEqual(self.controller.source_id, source_id)
+        self.assertEqual(self.queue.jobs, 4)
+        self.sample(30, 50, 10)
+        self.assertEqual(self.queue.jobs, 3)
+        # the queue gets its jobs back when it finishes
+        self.queue.start_time = 0
+        self.queue.finished()
+        self.assertEqual(self.queue.jobs, 4)
+        self.assertEqual(self.controller.source_id, None)
+
+    def testNoCpuTimes(self):
+        soundconverter.queue.read_cpu_times = lambda: None
+        self.controller.start()
+        self.assertTrue(self.controller.warned)
+        source_id = self.controller.source_id
+        self.assertFalse(self.controller.update())
+        self.assertEqual(self.controller.source_id, None)
+        GLib.source_remove(source_id)
+
+    def testFallingThroughput(self):
+        self.sample(60, 0, 10)
+        self.assertAlmostEqual(self.controller.last_throughput, 40 / 3, 2)
+        self.assertEqual(self.queue.jobs, 4)
+        self.sample(60, 0, 5)
+        self.assertEqual(self.queue.jobs, 3)
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def make_task(self, pool):
+        c = Converter(SoundFile('file:///in.flac'), 'file:///out.ogg',
+                      'audio/x-vorbis')
+        task = WorkerTask(c, pool)
+        task.start()
+        task.started()
+        return task
+
+    def testMessages(self):
+        pool = FakeWorkerPool()
+        task = self.make_task(pool)
+        worker, = pool.started
+        self.assertEqual(worker.sent, [{'convert': task.job}])
+        self.assertEqual(task.job['options']['output_type'],
+                         'audio/x-vorbis')
+        worker.on_message({'position': 3, 'duration': 10})
+        self.assertEqual(task.get_position(), 3)
+        self.assertEqual(task.get_duration(), 10)
+        worker.on_message({'finished': True, 'error': None,
+                           'processing': True})
+        self.assertFalse(task.running)
+        self.assertEqual(task.error, None)
+        self.assertEqual(pool.idle, [worker])
+        # the idle worker runs the next task
+        self.make_task(pool)
+        self.assertEqual(pool.started, [worker])
+        self.assertEqual(pool.busy, {worker})
+
+    def testCrash(self):
+        pool = FakeWorkerPool()
+        task = self.make_task(pool)
+        worker, = pool.started
+        worker.process.status = -11
+        worker.on_eof()
+        self.assertFalse(task.running)
+        self.assertIn('11', task.error)
+        # the worker is not replaced until a task needs one
+        self.assertEqual(pool.idle, [])
+        self.assertEqual(pool.busy, set())
+        self.assertEqual(len(pool.started), 1)
+        self.make_task(pool)
+        self.assertEqual(len(pool.started), 2)
+
+
+class WatchdogTest(unittest.TestCase):
+    def testStall(self):
+        q = TaskQueue()
+        q.running = True
+        stuck, working = FakeTask(1), FakeTask(1)
+        for task in stuck, working:
+            task.running = True
+            q.running_tasks.add(task)
+        w = Watchdog(q, 0)
+        w.check()
+        working.position = 1
+        w.check()
+        self.assertEqual(w.stalled_tasks, [stuck])
+        self.assertFalse(stuck.running)
+        self.assertTrue(stuck.error)
+        self.assertTrue(working.running)
+        self.assertEqual(working.error, None)
+
+    def testStop(self):
+        q = TaskQueue()
+        q.watchdog = w = Watchdog(q, 10)
+        w.start()
+        source_id = w.source_id
+        self.assertTrue(source_id)
+        # starting again removes the timeout of the last run
+        w.start()
+        self.assertNotEqual(w.source_id, source_id)
+        q.abort()
+        self.assertEqual(w.source_id, None)
+
+
+class PipelinePoolTest(unittest.TestCase):
+    def tearDown(self):
+        pipeline_pool.clear()
+
+    def testReuse(self):
+        pool = PipelinePool()
+        pipeline = FakePipeline()
+        pool.put('a ! b', pipeline)
+        self.assertEqual(pipeline.states, [Gst.State.READY])
+        # the messages of the last run are dropped
+        self.assertEqual(pipeline.bus.flushing, [True, False])
+        self.assertEqual(pool.get('a ! c'), None)
+        self.assertIs(pool.get('a ! b'), pipeline)
+        self.assertEqual(pool.get('a ! b'), None)
+
+    def testFull(self):
+        pool = PipelinePool()
+        pool.get_size = lambda: 1
+        kept, extra = FakePipeline(), FakePipeline()
+        pool.put('a ! b', kept)
+        pool.put('a ! b', extra)
+        self.assertEqual(extra.states, [Gst.State.NULL])
+        self.assertIs(pool.get('a ! b'), kept)
+        self.assertEqual(pool.get('a ! b'), None)
+        pool.put('a ! b', kept)
+        pool.clear()
+        self.assertEqual(kept.states[-1], Gst.State.NULL)
+        self.assertEqual(pool.get('a ! b'), None)
+
+    def make_pipeline(self):
+        p = Pipeline()
+        p.add_command('src')
+        p.add_command('sink name=sink')
+        p.reusable = True
+        p.locations['sink'] = 'file:///tmp/out.ogg'
+        return p
+
+    def testPlayReused(self):
+        pipeline = FakePipeline()
+        pipeline_pool.put('src ! sink name=sink', pipeline)
+        p = self.make_pipeline()
+        p.play()
+        self.assertIs(p.pipeline, pipeline)
+        # the location of the new file is set
+        self.assertEqual(pipeline.elements['sink'].properties,
+                         {'location': 'file:///tmp/out.ogg'})
+        self.assertEqual(pipeline.states[-1], Gst.State.PLAYING)
+        self.assertTrue(pipeline.bus.sync_handler)
+        p.eos = True
+        p.stop_pipeline()
+        self.assertEqual(p.pipeline, None)
+        self.assertEqual(pipeline.bus.sync_handler, None)
+        self.assertIs(pipeline_pool.get('src ! sink name=sink'), pipeline)
+
+    def testErrorNotReused(self):
+        pipeline = FakePipeline()
+        pipeline_pool.put('src ! sink name=sink', pipeline)
+        p = self.make_pipeline()
+        p.play()
+        p.eos = True
+        p.error = 'failed'
+        p.stop_pipeline()
+        self.assertEqual(pipeline.states[-1], Gst.State.NULL)
+        self.assertEqual(pipeline_pool.get('src ! sink name=sink'), None)
+
+
+class MultipleOutputsTest(unittest.TestCase):
+    def testOutputs(self):
+        c = Converter(SoundFile('file:///tmp/in.flac'), 'file:///tmp/out.ogg',
+                      'audio/x-vorbis')
+        c.passthrough = False
+        c.encoder_queue = 0
+        c.add_output('file:///tmp/out.flac', 'audio/x-flac')
+        c.init()
+        # decoded once, then a tee feeds a queue and an encoder per output
+        self.assertEqual(len(c.command), 5)
+        self.assertTrue(c.command[0].startswith('giosrc name=src'))
+        self.assertEqual(c.command[1:4],
+                         ['audiorate', 'audioconvert', 'audioresample'])
+        tee = c.command[4]
+        self.assertTrue(tee.startswith('tee name=outputs outputs. ! queue ! '
+                                       'vorbisenc'))
+        self.assertEqual(tee.count('outputs. ! queue ! '), 2)
+        self.assertIn('outputs. ! queue ! flacenc', tee)
+        self.assertIn('giosink name=sink0', tee)
+        self.assertIn('giosink name=sink1', tee)
+        self.assertEqual(c.locations, {'src': 'file:///tmp/in.flac',
+                                       'sink0': 'file:///tmp/out.ogg',
+                                       'sink1': 'file:///tmp/out.flac'})
+
+    def testSingleOutput(self):
+        c = Converter(SoundFile('file:///tmp/in.flac'), 'file:///tmp/out.ogg',
+                      'audio/x-vorbis')
+        c.passthrough = False
+        c.encoder_queue = 0
+        c.init()
+        self.assertFalse([command for command in c.command
+                          if 'tee' in command])
+        self.assertEqual(c.command[-1], 'giosink name=sink')
+        self.assertEqual(c.locations['sink'], 'file:///tmp/out.ogg')
+
+
+class PassthroughTest(unittest.TestCase):
+    def testCanCopy(self):
+        # output type, input format, attributes, can copy
+        cases = (
+            ('audio/mpeg', mp3_cbr_320,
+             {'mp3_mode': 'cbr', 'mp3_quality': 320}, True),
+            ('audio/mpeg', mp3_cbr_320,
+             {'mp3_mode': 'cbr', 'mp3_quality': 128}, False),
+            ('audio/mpeg', mp3_cbr_320,
+             {'mp3_mode': 'cbr', 'mp3_quality': 320, 'passthrough': False},
+             False),
+            # the quality of VBR files cannot be checked
+            ('audio/mpeg', mp3_vbr, {'mp3_mode': 'vbr'}, False),
+            ('audio/mpeg', mp3_vbr, {'mp3_mode': 'cbr'}, False),
+            ('audio/x-vorbis', vorbis_48k, {}, False),
+            ('audio/x-flac', flac_44k_stereo, {}, True),
+            ('audio/x-flac', flac_44k_stereo, {'force_mono': True}, False),
+            ('audio/x-flac', flac_44k_stereo,
+             {'output_resample': True, 'resample_rate': 48000}, False),
+            ('audio/x-wav', wav_22k, {'wav_sample_width': 16}, True),
+            ('audio/x-wav', wav_22k, {'wav_sample_width': 24}, False),
+            ('audio/x-vorbis', flac_44k_stereo, {}, False),
+        )
+        for output_type, found, attributes, expected in cases:
+            attributes = dict({'passthrough': True}, **attributes)
+            c = make_converter(output_type, found, **attributes)
+            self.assertEqual(c.can_copy(), expected,
+                             (output_type, found, attributes))
+
+
+class ConverterPipelineTest(unittest.TestCase):
+    def testGetConversions(self):
+        # output type, input format, attributes,
+        # (audiorate, audioconvert, audioresample)
+        cases = (
+            ('audio/mpeg', flac_44k_stereo, {}, (False, False, False)),
+            # LAME takes 2 channels at most
+            ('audio/mpeg', flac_44k_51, {}, (False, True, False)),
+            # LAME only takes S16, Vorbis decodes to F32
+            ('audio/mpeg', vorbis_48k, {}, (True, True, False)),
+            ('audio/x-flac', flac_44k_51, {}, (False, False, False)),
+            # opusenc only takes S16 at its own rates
+            ('audio/ogg; codecs=opus', vorbis_48k, {}, (True, True, False)),
+            ('audio/ogg; codecs=opus', wav_22k, {}, (False, True, True)),
+            ('audio/x-vorbis', vorbis_48k, {}, (True, False, False)),
+            ('audio/x-wav', flac_44k_stereo, {'force_mono': True},
+             (False, True, False)),
+            ('audio/x-flac', wav_22k,
+             {'output_resample': True, 'resample_rate': 44100},
+             (False, True, True)),
+            # unknown format or channels
+            ('audio/mpeg', mp3_vbr, {}, (True, True, True)),
+            ('audio/mpeg', dict(flac_44k_stereo, channels=None), {},
+             (True, True, True)),
+            ('audio/x-m4a', flac_44k_stereo, {}, (True, True, True)),
+            # disabled
+            ('audio/mpeg', flac_44k_stereo, {'trim_pipeline': False},
+             (True, True, True)),
+        )
+        for output_type, found, attributes, expected in cases:
+            attributes = dict({'trim_pipeline': True}, **attributes)
+            c = make_converter(output_type, found, **attributes)
+            self.assertEqual(c.get_conversions(), expected,
+                             (output_type, found, attributes))
+
+    def testRemoteNotSniffed(self):
+        c = Converter(SoundFile('sftp://server/in.flac'), 'file:///out.flac',
+                      'audio/x-flac')
+        c.passthrough = True
+        c.trim_pipeline = True
+        self.assertEqual(c.get_input_format(), None)
+        self.assertFalse(c.can_copy())
+        self.assertEqual(c.get_conversions(), (True, True, True))
+
+
+class SegmentTest(unittest.TestCase):
+    def testWantedJobs(self):
+        q = TaskQueue()
+        q.jobs = 4
+        first, split = FakeTask(1), FakeTask(10)
+        split.wanted_jobs = 4
+        others = [FakeTask(1) for i in range(3)]
+        q.add_tasks([first, split])
+        q.add_tasks(others)
+        q.start_next_task()
+        # the split task is given the 3 jobs left
+        self.assertEqual(q.running_tasks, {first, split})
+        self.assertEqual(split.jobs, 3)
+        self.assertEqual(q.get_used_jobs(), 4)
+        # and counted once
+        q.task_finished(split)
+        self.assertEqual(q.finished_tasks, 1)
+        self.assertEqual(q.running_tasks, {first} | set(others))
+        self.assertEqual(q.get_used_jobs(), 4)
+
+    def testPlanWav(self):
+        fmt = b'fmt ' + struct.pack('<IHHIIHH', 16, 1, 1, 8000, 8000, 1, 8)
+        # odd data size, padded, then a LIST chunk
+        first = b'RIFF\0\0\0\0WAVE' + fmt + b'data' + \
+            struct.pack('<I', 3) + b'abc\0' + b'LIST' + \
+            struct.pack('<I', 4) + b'INFO'
+        second = b'RIFF\0\0\0\0WAVE' + fmt + b'data' + \
+            struct.pack('<I', 4) + b'defg'
+        uris = ['file:///0~SC~', 'file:///1~SC~']
+        parts = plan_wav(uris, [first, second], len(first))
+        header = parts[0]
+        self.assertEqual(header[:4], b'RIFF')
+        self.assertEqual(header[8:36], first[8:36])
+        self.assertEqual(header[36:], b'data' + struct.pack('<I', 7))
+        self.assertEqual(parts[1:], [(uris[0], 44, 3), (uris[1], 44, 4),
+                                     b'\0', (uris[0], 48, 12)])
+        size = sum(len(part) if isinstance(part, bytes) else part[2]
+                   for part in parts)
+        self.assertEqual(struct.unpack('<I', header[4:8])[0], size - 8)
+        self.assertRaises(ValueError, plan_wav, uris,
+                          [first, second[:36]], len(first))
+
+    def testCanSplit(self):
+        c = make_converter('audio/x-wav', flac_44k_stereo, passthrough=False)
+        c.sound_file.duration = 3600
+        self.assertTrue(can_split(c))
+        # 10 hours of 44.1 kHz stereo are more than 4 GiB of WAV
+        c.sound_file.duration = 36000
+        self.assertFalse(can_split(c))
+        c.force_mono = True
+        self.assertTrue(can_split(c))
+        c = make_converter('audio/x-vorbis', flac_44k_stereo,
+                           passthrough=False)
+        c.sound_file.duration = 36000
+        self.assertTrue(can_split(c))
+
+
+class EncoderQueueTest(unittest.TestCase):
+    def testEncoderQueue(self):
+        c = Converter(SoundFile('file:///tmp/in.flac'), 'file:///tmp/out.ogg',
+                      'audio/x-vorbis')
+        c.passthrough = False
+        c.encoder_queue = 0
+        self.assertEqual(c.get_queue(), 'queue')
+        c.encoder_queue = 200
+        expected = 'queue max-size-buffers=0 max-size-bytes=0 ' \
+            'max-size-time=%d' % (200 * Gst.MSECOND)
+        self.assertEqual(c.get_queue(), expected)
+        # before the encoder of a single output
+        c.init()
+        self.assertEqual(c.command[-3], expected)
+        self.assertTrue(c.command[-2].startswith('vorbisenc'))
+
+        # in each branch of the tee
+        c = Converter(SoundFile('file:///tmp/in.flac'), 'file:///tmp/out.ogg',
+                      'audio/x-vorbis')
+        c.passthrough = False
+        c.encoder_queue = 200
+        c.add_output('file:///tmp/out.flac', 'audio/x-flac')
+        c.init()
+        self.assertEqual(c.command[-1].count('outputs. ! %s ! ' % expected),
+                         2)
+
+        # without encoder-queue, a plain queue in each branch of the tee,
+        # and none for a single output
+        c = Converter(SoundFile('file:///tmp/in.flac'), 'file:///tmp/out.ogg',
+                      'audio/x-vorbis')
+        c.passthrough = False
+        c.encoder_queue = 0
+        c.add_output('file:///tmp/out.flac', 'audio/x-flac')
+        c.init()
+        self.assertEqual(c.command[-1].count('outputs. ! queue ! '), 2)
+        c = Converter(SoundFile('file:///tmp/in.flac'), 'file:///tmp/out.ogg',
+                      'audio/x-vorbis')
+        c.passthrough = False
+        c.encoder_queue = 0
+        c.init()
+        self.assertFalse([command for command in c.command
+                          if command.startswith('queue')])
+
+
+class BusDispatcherTest(unittest.TestCase):
+    def testDispatch(self):
+        dispatcher = BusDispatcher()
+        errors, all_types = MessageTask(1), MessageTask(1 | 2)
+        stopped = MessageTask(1)
+        messages = [FakeMessage(t) for t in (1, 2, 4)]
+        for task in errors, all_types, stopped:
+            for message in messages:
+                self.assertEqual(dispatcher.sync_handler(task.pipeline.bus,
+                                                         message, task),
+                                 Gst.BusSyncReply.DROP)
+        # a single idle callback for all of them
+        self.assertTrue(dispatcher.scheduled)
+        self.assertEqual(dispatcher.seen, 9)
+        self.assertEqual(dispatcher.forwarded, 4)
+        stopped.pipeline = None
+        dispatcher.dispatch()
+        self.assertFalse(dispatcher.scheduled)
+        self.assertEqual(dispatcher.batches, 1)
+        self.assertEqual(errors.messages, messages[:1])
+        self.assertEqual(all_types.messages, messages[:2])
+        self.assertEqual(stopped.messages, [])
+        self.assertEqual(dispatcher.pending, [])
+
+    def testWatch(self):
+        dispatcher = BusDispatcher()
+        task = MessageTask(1)
+        dispatcher.watch(task, task.pipeline.bus)
+        self.assertEqual(task.pipeline.bus.sync_handler,
+                         dispatcher.sync_handler)
+        dispatcher.unwatch(task.pipeline.bus)
+        self.assertEqual(task.pipeline.bus.sync_handler, None)
+
+
+class DecoderTest(unittest.TestCase):
+    def tearDown(self):
+        pipeline_pool.clear()
+
+    def testCountBuffer(self):
+        d = Decoder(SoundFile('file:///tmp/in.flac'))
+        for buf in (FakeBuffer(0, Gst.SECOND, 1000),
+                    FakeBuffer(Gst.SECOND, Gst.SECOND // 2, 500),
+                    # the position is kept without a timestamp
+                    FakeBuffer(Gst.CLOCK_TIME_NONE, Gst.CLOCK_TIME_NONE, 10)):
+            self.assertEqual(d.count_buffer(None, FakeProbeInfo(buf)),
+                             Gst.PadProbeReturn.OK)
+        self.assertEqual(d.get_position(), 1.5)
+        self.assertEqual(d.decoded_bytes, 1510)
+        # without a duration, the position is the start of the buffer
+        d.count_buffer(None, FakeProbeInfo(
+            FakeBuffer(2 * Gst.SECOND, Gst.CLOCK_TIME_NONE, 10)))
+        self.assertEqual(d.get_position(), 2)
+
+    def decode(self, pipeline, pad):
+        d = Decoder(SoundFile('file:///tmp/in.flac'))
+        d.sound_file.duration = 10
+        d.reusable = True
+        d.play()
+        self.assertIs(d.pipeline, pipeline)
+        d.pad_added(None, pad)
+        d.eos = True
+        return d
+
+    def testReusedProbe(self):
+        pipeline = FakePipeline()
+        command = 'giosrc name=src ! decodebin name=decoder'
+        pipeline_pool.put(command, pipeline)
+        pad = FakePad()
+        d = self.decode(pipeline, pad)
+        # the link parse_launch made is made again
+        self.assertTrue(pad.is_linked())
+        self.assertEqual(len(pad.probes), 1)
+        d.finished()
+        self.assertEqual(pad.probes, {})
+        self.assertIs(pipeline_pool.get(command), pipeline)
+        pipeline_pool.put(command, pipeline)
+        d = self.decode(pipeline, pad)
+        self.assertEqual(len(pad.probes), 1)
+        d.finished()
+        self.assertEqual(pad.probes, {})
+
+
+class ProberTest(unittest.TestCase):
+    uri = 'file:///tmp/a.flac'
+
+    def setUp(self):
+        self.metadata_cache = settings['metadata-cache']
+        settings['metadata-cache'] = False
+
+    def tearDown(self):
+        settings['metadata-cache'] = self.metadata_cache
+        discoverer_pool.idle = []
+
+    def make_prober(self):
+        prober = Prober(SoundFile(self.uri))
+        prober.running = True
+        prober.discoverer = FakeDiscoverer()
+        prober.handler_id = 7
+        return prober
+
+    def testAudio(self):
+        prober = self.make_prober()
+        discoverer = prober.discoverer
+        info = FakeDiscovererInfo(self.uri, duration=90 * Gst.SECOND)
+        prober.discovered(discoverer, info, None)
+        self.assertEqual(prober.sound_file.mime_type, 'audio/x-flac')
+        self.assertEqual(prober.sound_file.duration, 90)
+        self.assertEqual(prober.error, None)
+        self.assertFalse(prober.running)
+        # the discoverer is kept for the next file
+        self.assertEqual(discoverer.disconnected, [7])
+        self.assertEqual(discoverer_pool.idle, [discoverer])
+
+    def testNotAudio(self):
+        prober = self.make_prober()
+        info = FakeDiscovererInfo(self.uri, 'image/jpeg', audio=False)
+        prober.discovered(prober.discoverer, info, None)
+        self.assertEqual(prober.sound_file.mime_type, None)
+        self.assertFalse(prober.running)
+
+    def testError(self):
+        prober = self.make_prober()
+        info = FakeDiscovererInfo(
+            self.uri, result=GstPbutils.DiscovererResult.MISSING_PLUGINS)
+        prober.discovered(prober.discoverer, info, FakeError('no decoder'))
+        self.assertEqual(prober.error, 'no decoder')
+        self.assertEqual(prober.sound_file.mime_type, None)
+        self.assertFalse(prober.running)
+
+    def testOtherFile(self):
+        prober = self.make_prober()
+        discoverer = prober.discoverer
+        info = FakeDiscovererInfo('file:///tmp/b.flac')
+        prober.discovered(discoverer, info, None)
+        self.assertTrue(prober.running)
+        self.assertIs(prober.discoverer, discoverer)
+        self.assertEqual(discoverer.disconnected, [])
+
+    def testAborted(self):
+        prober = self.make_prober()
+        discoverer = prober.discoverer
+        prober.aborted()
+        # pending discoveries cannot be cancelled, it is not reused
+        self.assertTrue(discoverer.stopped)
+        self.assertEqual(discoverer_pool.idle, [])
+
+    def testPool(self):
+        pool = DiscovererPool()
+        discoverer = FakeDiscoverer()
+        pool.put(discoverer)
+        self.assertIs(pool.get(), discoverer)
+        self.assertEqual(pool.idle, [])
+
+
+class SnifferTest(unittest.TestCase):
+    def testWav(self):
+        fmt = struct.pack('<HHIIHH', 1, 2, 44100, 176400, 4, 16)
+        data = b'RIFF\0\0\0\0WAVE' + b'fmt ' + struct.pack('<I', 16) + fmt
+        found = sniff(data)
+        self.assertEqual(found['mime_type'], 'audio/x-wav')
+        self.assertEqual(found['sample_width'], 16)
+        self.assertEqual(found['rate'], 44100)
+        self.assertTrue(found['pcm'])
+
+    def testWavExtensible(self):
+        fmt = struct.pack('<HHIIHHHHI', 0xfffe, 2, 48000, 384000, 8, 32,
+                          22, 32, 3)
+        header = b'RIFF\0\0\0\0WAVE' + b'fmt ' + struct.pack('<I', 40) + fmt
+        pcm = b'\x01\0\0\0\0\0\x10\0\x80\0\0\xaa\0\x38\x9b\x71'
+        found = sniff(header + pcm)
+        self.assertTrue(found['pcm'])
+        self.assertEqual(found['sample_width'], 32)
+        # IEEE float
+        found = sniff(header + b'\x03' + pcm[1:])
+        self.assertFalse(found['pcm'])
+        self.assertEqual(soundconverter.gstreamer.get_raw_format(found), None)
+
+    def testWavData(self):
+        fmt = struct.pack('<HHIIHH', 1, 1, 8000, 16000, 2, 16)
+        data = b'RIFF\0\0\0\0WAVE' + b'fmt ' + struct.pack('<I', 16) + fmt
+        data += b'LIST' + struct.pack('<I', 3) + b'abc\0'
+        data += b'data' + struct.pack('<I', 1000)
+        self.assertEqual(find_wav_data(data), (48, 1000))
+        self.assertEqual(find_wav_data(data[:40]), None)
+
+    def testOgg(self):
+        page = b'OggS' + b'\0' * 22 + b'\x01\x1e'
+        vorbis = b'\x01vorbis' + b'\0' * 4 + struct.pack('<BI', 2, 48000)
+        self.assertEqual(sniff(page + vorbis)['mime_type'], 'audio/x-vorbis')
+        opus = b'OpusHead\x01\x01\0\0' + struct.pack('<I', 48000)
+        found = sniff(page + opus)
+        self.assertEqual(found['mime_type'], 'audio/ogg; codecs=opus')
+        self.assertEqual(found['channels'], 1)
+
+    def testMp3(self):
+        # MPEG1 layer III, 128 kbit/s, 44.1 kHz, stereo
+        frame = b'\xff\xfb\x90\x00' + b'\0' * 32
+        id3 = b'ID3\x03\0\0\0\0\0\x0a' + b'\0' * 10
+        found = sniff(id3 + frame + b'Info' + b'\0' * 200)
+        self.assertEqual(found['mime_type'], 'audio/mpeg')
+        self.assertEqual(found['rate'], 44100)
+        self.assertEqual(found['mp3_mode'], 'cbr')
+        self.assertEqual(found['bitrate'], 128)
+        self.assertEqual(sniff(frame + b'Xing' + b'\0' * 200)['mp3_mode'],
+                         'vbr')
+
+    def testLargeId3(self):
+        # a tag with a cover larger than the header
+        tag = b'\0' * 10000
+        size = bytes((len(tag) >> shift) & 0x7f for shift in (21, 14, 7, 0))
+        frame = b'\xff\xfb\x90\x00' + b'\0' * 32 + b'Info' + b'\0' * 200
+        with tempfile.NamedTemporaryFile(suffix='.mp3') as f:
+            f.write(b'ID3\x03\0\0' + size + tag + frame)
+            f.flush()
+            found = sniff_file(filename_to_uri(f.name))
+        self.assertEqual(found['mime_type'], 'audio/mpeg')
+        self.assertEqual(found['mp3_mode'], 'cbr')
+
+    def testClassify(self):
+        page = b'OggS' + b'\0' * 22 + b'\x01\x1e'
+        self.assertEqual(classify(page + b'\x80theora'), 'application/ogg')
+        self.assertEqual(classify(b'\0\0\0\x20ftypM4A \0\0\0\0'),
+                         'audio/x-m4a')
+        self.assertEqual(classify(b'\0\0\0\x20ftypisom'), 'video/quicktime')
+        self.assertEqual(classify(b'ID3\x04\0\0\0\0\x10\0'),
+                         'application/x-id3')
+        self.assertEqual(classify(b'\xff\xd8\xff\xe0\0\x10JFIF'),
+                         'image/jpeg')
+        # a frame sync followed by garbage is not an MP3 file
+        self.assertEqual(classify(b'\xff\xfb\x90\x00' + b'\x01' * 1000),
+                         None)
+
+    def testUnknown(self):
+        self.assertEqual(sniff(b''), None)
+        self.assertEqual(sniff(b'RIFF\0\0\0\0AVI '), None)
+        self.assertEqual(sniff(b'\0' * 100), None)
+
+    def testSkipOtherFiles(self):
+        fmt = struct.pack('<HHIIHH', 1, 2, 44100, 176400, 4, 16)
+        wav = b'RIFF\0\0\0\0WAVE' + b'fmt ' + struct.pack('<I', 16) + fmt
+        files = {
+            'a.wav': wav,
+            'cover.jpg': b'\xff\xd8\xff\xe0\0\x10JFIF',
+            'notes.txt': b'Recorded live\n',
+        }
+        with tempfile.TemporaryDirectory() as folder:
+            for name, data in files.items():
+                with open(os.path.join(folder, name), 'wb') as f:
+                    f.write(data)
+            found = [uri for uri, base in
+                     iter_input_files([filename_to_uri(folder)])]
+            self.assertEqual(found,
+                             [filename_to_uri(os.path.join(folder, 'a.wav'))])
+
+
+class MetadataCacheTest(unittest.TestCase):
+    def testGetPut(self):
+        cache = MetadataCache(':memory:')
+        cache.put('file:///a.ogg', 100, 5, 'application/ogg', 1.5,
+                  {'artist': 'Foo'})
+        self.assertEqual(cache.get('file:///a.ogg', 100, 5),
+                         ('application/ogg', 1.5, {'artist': 'Foo'}))
+        # changed file
+        self.assertEqual(cache.get('file:///a.ogg', 101, 5), None)
+        self.assertEqual(cache.get('file:///a.ogg', 100, 6), None)
+        self.assertEqual(cache.get('file:///b.ogg', 100, 5), None)
+        cache.close()
+
+    def testEvict(self):
+        cache = MetadataCache(':memory:')
+        cache.max_entries = 10
+        for i in range(11):
+            cache.put('file:///%d.ogg' % i, i, i, None, None, {})
+        self.assertEqual(cache.entries, 9)
+        self.assertEqual(cache.get('file:///0.ogg', 0, 0), None)
+        self.assertTrue(cache.get('file:///10.ogg', 10, 10))
+        cache.close()
+
+    def testUsedIsBatched(self):
+        cache = MetadataCache(':memory:')
+        cache.put('file:///a.ogg', 100, 5, None, None, {})
+        cache.commit()
+
+        def used():
+            return cache.connection.execute(
+                'SELECT used FROM metadata').fetchone()[0]
+
+        before = used()
+        self.assertTrue(cache.get('file:///a.ogg', 100, 5))
+        # a hit writes nothing until the next commit
+        self.assertEqual(used(), before)
+        self.assertEqual(cache.changes, 0)
+        cache.commit()
+        self.assertGreaterEqual(used(), before)
+        self.assertEqual(cache.touched, set())
+        cache.close()
+
+    def testReplaceIsNotCounted(self):
+        cache = MetadataCache(':memory:')
+        cache.max_entries = 10
+        for i in range(20):
+            cache.put('file:///a.ogg', i, i, None, None, {})
+        self.assertEqual(cache.entries, 1)
+        cache.close()
+
+
+class UpToDateTest(unittest.TestCase):
+    def setUp(self):
+        self.metadata_cache = soundconverter.gstreamer.metadata_cache
+        self.cache = FakeFilesCache()
+        soundconverter.gstreamer.metadata_cache = self.cache
+        self.task = JournalTask('file:///a.flac')
+
+    def tearDown(self):
+        soundconverter.gstreamer.metadata_cache = self.metadata_cache
+        self.cache.close()
+
+    def testNotRecorded(self):
+        self.cache.keys['file:///a.flac'] = (100, 5)
+        self.assertFalse(is_up_to_date(self.task, ['file:///a.mp3']))
+        # older than the source
+        self.cache.keys['file:///a.mp3'] = (50, 4)
+        self.assertFalse(is_up_to_date(self.task, ['file:///a.mp3']))
+        self.cache.keys['file:///a.mp3'] = (50, 6)
+        self.assertTrue(is_up_to_date(self.task, ['file:///a.mp3']))
+
+    def testRecorded(self):
+        targets = ['file:///a.mp3', 'file:///a.ogg']
+        self.cache.keys.update({'file:///a.flac': (100, 5),
+                                'file:///a.mp3': (50, 6),
+                                'file:///a.ogg': (50, 6)})
+        record_outputs(self.task, targets)
+        self.assertTrue(is_up_to_date(self.task, targets))
+        # other settings
+        self.task.get_settings_hash = lambda: 'def'
+        self.assertFalse(is_up_to_date(self.task, targets))
+        del self.task.get_settings_hash
+        # the source changed, even if the outputs are newer
+        self.cache.keys['file:///a.flac'] = (101, 5)
+        self.assertFalse(is_up_to_date(self.task, targets))
+        record_outputs(self.task, targets)
+        self.assertTrue(is_up_to_date(self.task, targets))
+        # an output was removed
+        del self.cache.keys['file:///a.ogg']
+        self.assertFalse(is_up_to_date(self.task, targets))
+
+    def testFindOutputs(self):
+        self.cache.keys['file:///a.flac'] = (100, 5)
+        record_outputs(self.task, ['file:///Unknown Artist/a.mp3'])
+        record_outputs(JournalTask('file:///b.flac'), ['file:///b.mp3'])
+        self.assertEqual(self.cache.find_outputs('file:///a.flac', 'abc'),
+                         ['file:///Unknown Artist/a.mp3'])
+        self.assertEqual(self.cache.find_outputs('file:///a.flac', 'def'), [])
+        self.assertEqual(self.cache.get_source('file:///Unknown Artist/a.mp3'),
+                         'file:///a.flac')
+        self.assertEqual(self.cache.get_source('file:///a.mp3'), None)
+        # the source changed
+        self.cache.keys['file:///a.flac'] = (101, 5)
+        self.assertEqual(self.cache.find_outputs('file:///a.flac', 'abc'), [])
+
+    def testOutputs(self):
+        cache = MetadataCache(':memory:')
+        self.assertEqual(cache.get_output('file:///a.mp3'), None)
+        cache.put_output('file:///a.mp3', 'file:///a.flac', 100, 5, 'abc')
+        self.assertEqual(cache.get_output('file:///a.mp3'),
+                         ('file:///a.flac', 100, 5, 'abc'))
+        cache.put_output('file:///a.mp3', 'file:///a.flac', 100, 6, 'abc')
+        self.assertEqual(cache.get_output('file:///a.mp3')[2], 6)
+        cache.close()
+
+    def testEvictOutputs(self):
+        cache = MetadataCache(':memory:')
+        cache.max_outputs = 10
+        for i in range(11):
+            cache.put_output('file:///%d.mp3' % i, 'file:///%d.flac' % i,
+                             i, i, 'abc')
+        cache.put_output('file:///5.mp3', 'file:///5.flac', 5, 6, 'abc')
+        self.assertEqual(cache.outputs, 9)
+        self.assertEqual(cache.get_output('file:///0.mp3'), None)
+        self.assertTrue(cache.get_output('file:///10.mp3'))
+        cache.close()
+
+    def testSettingsHash(self):
+        c = make_converter('audio/mpeg', flac_44k_stereo)
+        settings_hash = c.get_settings_hash()
+        c.encoder_queue = 100
+        c.trim_pipeline = not c.trim_pipeline
+        c.output_filename = 'file:///other'
+        self.assertEqual(c.get_settings_hash(), settings_hash)
+        c.passthrough = not c.passthrough
+        self.assertNotEqual(c.get_settings_hash(), settings_hash)
+
+
+class JournalTest(unittest.TestCase):
+    def testLoad(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'journal')
+            journal = Journal()
+            journal.open(path)
+            tasks = [JournalTask('file:///%d.wav' % i) for i in range(4)]
+            for task in tasks:
+                journal.queued(task)
+            journal.finished(tasks[0], ['file:///0.flac'])
+            journal.finished(tasks[1], [], 'failed')
+            journal.close()
+            # a line cut by a crash
+            with open(path, 'a') as f:
+                f.write('{"event": "fini')
+
+            journal = Journal()
+            journal.load(path)
+            self.assertEqual(journal.completed,
+                             {'file:///0.wav': [['file:///0.flac'], 'abc']})
+            self.assertTrue(journal.was_interrupted('file:///2.wav'))
+            self.assertFalse(journal.was_interrupted('file:///0.wav'))
+            self.assertTrue(journal.has_failed('file:///1.wav'))
+            self.assertFalse(journal.has_failed('file:///0.wav'))
+            self.assertEqual(journal.get_unfinished(),
+                             ['file:///2.wav', 'file:///3.wav',
+                              'file:///1.wav'])
+
+    def testResumeToOtherJournal(self):
+        with tempfile.TemporaryDirectory() as folder:
+            old = os.path.join(folder, 'old')
+            new = os.path.join(folder, 'new')
+            journal = Journal()
+            journal.open(old)
+            task = JournalTask('file:///0.wav')
+            journal.queued(task)
+            journal.finished(task, ['file:///0.flac'])
+            journal.close()
+
+            journal = Journal()
+            journal.open(new, old)
+            self.assertIn('file:///0.wav', journal.completed)
+            journal.queued(JournalTask('file:///1.wav'))
+            journal.close()
+            with open(old) as f:
+                self.assertEqual(len(f.readlines()), 2)
+            with open(new) as f:
+                self.assertEqual(len(f.readlines()), 1)
+
+    def testResumedInputs(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'journal')
+            journal = Journal()
+            journal.open(path)
+            journal.started(['file:///music/'], streaming=True)
+            journal.queued(JournalTask('file:///music/0.wav'))
+            journal.close()
+            journal = Journal()
+            journal.load(path)
+            # the files not queued yet are found again
+            self.assertEqual(journal.get_resumed_inputs(),
+                             (['file:///music/'], None, None))
+
+            journal = Journal()
+            journal.open(path)
+            journal.started(['file:///0.wav'])
+            journal.queued(JournalTask('file:///0.wav'))
+            journal.close()
+            journal = Journal()
+            journal.load(path)
+            # only the files queued and not converted
+            self.assertEqual(journal.get_resumed_inputs(),
+                             (['file:///music/0.wav', 'file:///0.wav'],
+                              None, None))
+
+            journal = Journal()
+            journal.open(path)
+            journal.started([], manifest='-', manifest_format='lines')
+            journal.close()
+            journal = Journal()
+            journal.load(path)
+            self.assertRaises(ValueError, journal.get_resumed_inputs)
+
+
+class ManifestTest(unittest.TestCase):
+    def read(self, manifest_format, data):
+        stream = io.BufferedReader(io.BytesIO(data))
+        return [record for number, record in readers[manifest_format](stream)]
+
+    def testGuessFormat(self):
+        for data, expected in ((b'a.wav\0b.wav\0', 'nul'),
+                               (b'{"path": "a.wav"}\n', 'jsonl'),
+                               (b'a.wav\nb.wav\n', 'lines')):
+            stream = io.BufferedReader(io.BytesIO(data))
+            self.assertEqual(guess_format('-', stream), expected)
+            # nothing is consumed
+            self.assertEqual(stream.read(), data)
+        self.assertEqual(guess_format('list.csv', None), 'csv')
+
+    def testNul(self):
+        self.assertEqual(self.read('nul', b'a\nb.wav\0c.wav'),
+                         [{'path': 'a\nb.wav'}, {'path': 'c.wav'}])
+
+    def testJsonl(self):
+        data = (b'{"path": "a.wav", "format": "mp3", "priority": 2}\n'
+                b'\n"b.wav"\n')
+        self.assertEqual(self.read('jsonl', data), [
+            {'path': 'a.wav', 'format': 'mp3', 'priority': 2},
+            {'path': 'b.wav'}])
+
+    def testJsonlBrokenRecord(self):
+        logged = []
+        log = soundconverter.manifest.log
+        soundconverter.manifest.log = logged.append
+        try:
+            records = self.read('jsonl', b'{"path": \n"b.wav"}\n'
+                                         b'{"path": "c.wav"}\n')
+        finally:
+            soundconverter.manifest.log = log
+        # the lines of the record are skipped, not read as other records
+        self.assertEqual(records, [{'path': 'c.wav'}])
+        self.assertEqual(len(logged), 2)
+        self.assertTrue(logged[0].startswith('manifest line 1: '))
+
+    def testCsv(self):
+        data = b'path,output,priority\na.wav,,1\n"b, c.wav",b.mp3,\n'
+        self.assertEqual(self.read('csv', data), [
+            {'path': 'a.wav', 'priority': '1'},
+            {'path': 'b, c.wav', 'output': 'b.mp3'}])
+
+    def testCsvStoppedEarly(self):
+        stream = io.BufferedReader(io.BytesIO(b'path\na.wav\nb.wav\n'))
+        records = readers['csv'](stream)
+        next(records)
+        records.close()
+        del records
+        # the stream is left open for the caller
+        self.assertFalse(stream.closed)
+
+
 if __name__ == "__main__":
     unittest.main()